@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from pathlib import Path
+
+from PIL import Image
+
+from benchmarks.e2e_benchmark import DEFAULT_WORKFLOW_DIR
+from benchmarks.measure import git_revision
+from benchmarks.mock_comfyui import MockComfyUI
+from module.backend_pool import connect
+from module.image_transport import ImageTransport
+from module.workflow_manager import WorkflowManager
+from schemas.generate_settings import GenerateSettings
+
+# ComfyUI を模したサーバーを 1 ~ N 台起動し、BackendPool に常に backends × max_in_flight 件を積んだ状態で
+# 1 分あたりの生成数を計測する。--models を 2 以上にすると、チェックポイントの異なる workflow を交互に積み、
+# 読み込み済みの ComfyUI を優先する振り分けでモデルの読み込み回数が抑えられるかを確認する
+# $ cd src && python -m benchmarks.backend_pool_benchmark --backends 1 2 4 --delay 0.5 -o pool.json
+
+
+def create_workflows(workflow_dir: Path, models: int) -> list[dict]:
+    # チェックポイント名だけを変えた workflow を作る
+    workflow_manager = WorkflowManager(workflow_dir, ImageTransport("base64"))
+    with open(workflow_dir / "settings.json", "r") as f:
+        generate_settings = GenerateSettings(**json.load(f))
+    workflow = workflow_manager.create(
+        Image.new("RGB", (256, 256), "white"), generate_settings, steps=1
+    ).to_dict()
+    workflows = []
+    for i in range(models):
+        variant = json.loads(json.dumps(workflow))
+        for node in variant.values():
+            if node.get("class_type") == "CheckpointLoaderSimple":
+                node["inputs"]["ckpt_name"] = f"model_{i}.safetensors"
+        workflows.append(variant)
+    return workflows
+
+
+def run(
+    num_backends: int,
+    workflows: list[dict],
+    prompts: int,
+    max_in_flight: int,
+    delay: float,
+    model_load_delay: float,
+    timeout: float,
+) -> dict:
+    servers = [
+        MockComfyUI(
+            execution_delay=delay,
+            image_size=(256, 256),
+            model_load_delay=model_load_delay,
+        )
+        for _ in range(num_backends)
+    ]
+    for server in servers:
+        server.start()
+    client = connect([server.url for server in servers])
+    try:
+        in_flight: list[Future] = []
+        finished = 0
+        start = time.perf_counter()
+        for i in range(prompts):
+            while len(in_flight) >= max_in_flight * num_backends:
+                done, _ = wait(in_flight, timeout, return_when=FIRST_COMPLETED)
+                assert len(done) > 0, "timeout"
+                for future in done:
+                    future.result()
+                    in_flight.remove(future)
+                    finished += 1
+            # 同じ workflow を数件ずつまとめて積む (作業者が同じ workflow で続けて保存する状況)
+            workflow = workflows[(i // max(max_in_flight, 1)) % len(workflows)]
+            prompt_id = client.enqueue(workflow)
+            in_flight.append(client.submit_polling(prompt_id))
+        for future in in_flight:
+            future.result(timeout)
+            finished += 1
+        seconds = time.perf_counter() - start
+    finally:
+        client.close()
+        for server in servers:
+            server.stop()
+
+    per_backend = [
+        sum(record.status == "finished" for record in server.records.values())
+        for server in servers
+    ]
+    return {
+        "backends": num_backends,
+        "prompts": finished,
+        "seconds": round(seconds, 3),
+        "per_minute": round(finished / seconds * 60, 1),
+        "per_backend": per_backend,
+        "model_loads": sum(server.model_loads for server in servers),
+    }
+
+
+def main(args: argparse.Namespace):
+    workflows = create_workflows(args.workflow_dir, args.models)
+    results = []
+    for num_backends in args.backends:
+        result = run(
+            num_backends,
+            workflows,
+            args.prompts,
+            args.max_in_flight,
+            args.delay,
+            args.model_load_delay,
+            args.timeout,
+        )
+        results.append(result)
+        speedup = result["per_minute"] / results[0]["per_minute"]
+        print(
+            f"{num_backends:2d} backends: {result['per_minute']:7.1f} / min "
+            f"(x{speedup:.2f}), per backend {result['per_backend']}, "
+            f"model loads {result['model_loads']}"
+        )
+
+    if args.output is not None:
+        report = {
+            "revision": git_revision(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "config": {
+                "prompts": args.prompts,
+                "max_in_flight": args.max_in_flight,
+                "delay": args.delay,
+                "models": args.models,
+                "model_load_delay": args.model_load_delay,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=[1, 2, 4], type=int)
+    parser.add_argument("--prompts", default=40, type=int)
+    parser.add_argument("--max_in_flight", default=2, type=int)
+    parser.add_argument("--delay", default=0.5, type=float)
+    parser.add_argument("--models", default=1, type=int)
+    parser.add_argument("--model_load_delay", default=1.0, type=float)
+    parser.add_argument("--timeout", default=60.0, type=float)
+    parser.add_argument("-w", "--workflow_dir", default=DEFAULT_WORKFLOW_DIR, type=Path)
+    parser.add_argument("-o", "--output", default=None, type=Path)
+    main(parser.parse_args())
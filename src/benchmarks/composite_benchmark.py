@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.measure import measure, run_isolated
+from benchmarks.synthetic_psd import random_layer, save_psd
+from module.psd_compositor import PsdCompositor
+from utils.blend import BLEND_MODES, BlendEngine, BlendLayer
+from utils.util import parse_psd
+
+# PSD のパースからの合成 (parse) と、デコード済みレイヤーの合成のみ (blend) を
+# 従来の PIL の paste と合成エンジンで比較する。
+# blend_engine_modes は全レイヤーに合成モードと不透明度を設定し、NumPy の経路を通した場合の計測
+# $ cd src && python -m benchmarks.composite_benchmark --size 2048 --layers 100
+
+
+def create_psd(path: Path, size: int, num_layers: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    layers = [random_layer(rng, (size, size), f"layer_{i}") for i in range(num_layers)]
+    save_psd(path, (size, size), layers, with_composite=False)
+
+
+def decode_layers(psd_path: Path):
+    from psd_tools import PSDImage
+
+    psd = PSDImage.open(psd_path)
+    layers = []
+    for layer in psd.descendants():
+        if layer.is_group() or not layer.is_visible():
+            continue
+        image = layer.topil()
+        if image is not None:
+            layers.append((image.convert("RGBA"), layer.offset))
+    return psd.size, layers
+
+
+def pil_paste(size, layers):
+    image = Image.new("RGBA", size, (255, 255, 255, 255))
+    for layer_image, offset in layers:
+        image.paste(layer_image, offset, layer_image)
+    return image
+
+
+def engine_blend(engine: BlendEngine, canvas: Image.Image, layers: list[BlendLayer]):
+    canvas.paste((255, 255, 255), (0, 0, *canvas.size))
+    for layer in layers:
+        engine.blend(canvas, layer)
+    return canvas
+
+
+def run_case(case: str, psd_path: Path, repeat: int) -> dict:
+    if case == "parse_pil":
+        result = measure(lambda: parse_psd(psd_path), repeat)
+    elif case == "parse_engine":
+        result = measure(
+            lambda: PsdCompositor(input_mode="layers").composite(psd_path), repeat
+        )
+    elif case == "blend_pil":
+        size, layers = decode_layers(psd_path)
+        result = measure(lambda: pil_paste(size, layers), repeat)
+    elif case in ("blend_engine", "blend_engine_modes"):
+        size, layers = decode_layers(psd_path)
+        if case == "blend_engine":
+            blend_layers = [BlendLayer(image, offset) for image, offset in layers]
+        else:
+            blend_layers = [
+                BlendLayer(image, offset, 0.8, BLEND_MODES[i % len(BLEND_MODES)])
+                for i, (image, offset) in enumerate(layers)
+            ]
+        engine = BlendEngine()
+        canvas = Image.new("RGB", size, (255, 255, 255))
+        result = measure(lambda: engine_blend(engine, canvas, blend_layers), repeat)
+    else:
+        raise ValueError(f"unknown case: {case}")
+    return result.summary()
+
+
+def main(size: int, num_layers: int, repeat: int, output: Path | None):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        psd_path = Path(tmp_dir) / "benchmark.psd"
+        create_psd(psd_path, size, num_layers)
+        for case in [
+            "parse_pil",
+            "parse_engine",
+            "blend_pil",
+            "blend_engine",
+            "blend_engine_modes",
+        ]:
+            summary = run_isolated(run_case, case, psd_path, repeat)
+            results.append(
+                {"case": case, "size": size, "layers": num_layers, **summary}
+            )
+            print(
+                f"{case:18s} median {summary['median_ms']:8.1f} ms, "
+                f"peak rss +{summary['peak_rss_delta_bytes'] / 2**20:7.1f} MiB, "
+                f"tracemalloc {summary['tracemalloc_peak_bytes'] / 2**20:7.1f} MiB"
+            )
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=2048, type=int)
+    parser.add_argument("--layers", default=60, type=int)
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("-o", "--output", default=None, type=Path)
+    args = parser.parse_args()
+    main(args.size, args.layers, args.repeat, args.output)
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from benchmarks.measure import git_revision, latency_summary
+from benchmarks.mock_comfyui import MockComfyUI
+from benchmarks.synthetic_psd import psd_bytes, random_layer
+from module.inference_manager import InferenceManager
+
+# PSD の保存から UI に結果画像が表示されるまでを、実際の InferenceManager / Client / WorkflowManager で計測する
+# ComfyUI は benchmarks.mock_comfyui で置き換え、実行時間とキューの深さを指定する
+# 各段階の時間:
+#   settle: 保存 → 保存完了の検知, prepare: 検知 → /prompt の受信 (合成・リサイズ・エンコード・送信),
+#   queue: /prompt の受信 → 実行開始, execute: 実行時間,
+#   deliver: 結果画像の送信 → UI への反映 (受信・デコード・リサイズ), total: 保存 → UI への反映
+# $ cd src && python -m benchmarks.e2e_benchmark --delay 0.5 -o e2e.json
+
+STAGES = ("settle", "prepare", "queue", "execute", "deliver", "total")
+DEFAULT_WORKFLOW_DIR = Path(__file__).resolve().parents[2] / "workflows" / "img2img_xl"
+
+
+class Scenario(NamedTuple):
+    name: str
+    canvas_size: int
+    num_layers: int
+    # 1 回の計測で保存する回数と間隔。2 回以上の場合は生成中に次の保存が届く
+    saves: int = 1
+    save_interval: float = 0.0
+    # キャンバスに対するレイヤーの最大サイズの比率
+    layer_max_ratio: float = 0.6
+
+
+SCENARIOS = {
+    "single_save": Scenario("single_save", 1024, 20),
+    "burst": Scenario("burst", 1024, 20, saves=4, save_interval=0.6),
+    "large_canvas": Scenario("large_canvas", 4096, 10),
+    "many_layers": Scenario("many_layers", 2048, 200, layer_max_ratio=0.25),
+}
+
+
+def create_variants(scenario: Scenario, count: int, seed: int = 0) -> list[bytes]:
+    # 保存ごとに 1 枚だけレイヤーを描き替えた PSD を事前に作っておく
+    rng = np.random.default_rng(seed)
+    size = (scenario.canvas_size, scenario.canvas_size)
+    layers = [
+        random_layer(rng, size, f"layer_{i}", max_ratio=scenario.layer_max_ratio)
+        for i in range(scenario.num_layers)
+    ]
+    variants = []
+    for i in range(count):
+        index = i % len(layers)
+        layers[index] = random_layer(
+            rng, size, f"layer_{index}", max_ratio=scenario.layer_max_ratio
+        )
+        variants.append(psd_bytes(size, layers, with_composite=False))
+    return variants
+
+
+def wait_new_result(
+    inference_manager: InferenceManager, shown_version: int, timeout: float
+) -> Optional[int]:
+    # UI と同じく run() をポーリングし、新しい結果画像が公開されるのを待つ
+    # 表示された結果の番号を返し、timeout までに公開されなければ None を返す
+    previous_version = shown_version
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        _, status_update, _, shown_version = inference_manager.run(shown_version)
+        # 生成途中のプレビューは除き、最終的な結果画像のみを対象にする
+        if shown_version != previous_version and status_update["value"].startswith(
+            "status: finished"
+        ):
+            return shown_version
+        time.sleep(0.005)
+    return None
+
+
+def run_scenario(
+    scenario: Scenario,
+    server: MockComfyUI,
+    workflow_dir: Path,
+    iterations: int,
+    warmup: int,
+    timeout: float,
+    psd_input_mode: str,
+    image_transport: str,
+) -> dict:
+    variants = create_variants(scenario, (iterations + warmup) * scenario.saves + 1)
+    samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    superseded = 0
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        psd_path = Path(tmp_dir) / f"{scenario.name}.psd"
+        psd_path.write_bytes(variants.pop(0))
+        inference_manager = InferenceManager(
+            workflow_dir,
+            psd_path,
+            768,
+            768,
+            port_port=str(server.port),
+            psd_input_mode=psd_input_mode,
+            image_transport_mode=image_transport,
+            result_cache_dir=None,
+        )
+        ready_times: list[float] = []
+        inference_manager.file_watcher.add_callback(
+            lambda _: ready_times.append(time.perf_counter())
+        )
+
+        shown_version = -1
+        start = time.perf_counter()
+        try:
+            for iteration in range(iterations + warmup):
+                if iteration == warmup:
+                    start = time.perf_counter()
+                server.reset()
+                ready_times.clear()
+                for i in range(scenario.saves):
+                    if i > 0:
+                        time.sleep(scenario.save_interval)
+                    saved_at = time.perf_counter()
+                    psd_path.write_bytes(variants.pop(0))
+
+                result = wait_new_result(inference_manager, shown_version, timeout)
+                if result is not None:
+                    shown_version = result
+                displayed_at = time.perf_counter()
+                if iteration < warmup:
+                    continue
+                # 最後の保存に対応する (最後に受信した) プロンプトの記録を使う
+                records = sorted(
+                    server.records.values(), key=lambda record: record.received_at
+                )
+                if result is None or len(records) == 0 or len(ready_times) == 0:
+                    failures += 1
+                    continue
+                record = records[-1]
+                superseded += sum(
+                    record.status in ("interrupted", "deleted") for record in records
+                )
+                ready_at = ready_times[-1]
+                samples["settle"].append(ready_at - saved_at)
+                samples["prepare"].append(record.received_at - ready_at)
+                samples["queue"].append(record.started_at - record.received_at)
+                samples["execute"].append(record.finished_at - record.started_at)
+                samples["deliver"].append(displayed_at - record.finished_at)
+                samples["total"].append(displayed_at - saved_at)
+        finally:
+            wall_seconds = time.perf_counter() - start
+            inference_manager.stop()
+
+    completed = len(samples["total"])
+    return {
+        "scenario": scenario._asdict(),
+        "iterations": iterations,
+        "completed": completed,
+        "failures": failures,
+        "superseded_prompts": superseded,
+        "throughput_per_s": completed / wall_seconds if wall_seconds > 0 else 0.0,
+        "stages": {stage: latency_summary(samples[stage]) for stage in STAGES},
+    }
+
+
+def main(args: argparse.Namespace):
+    server = MockComfyUI(
+        execution_delay=args.delay,
+        queue_depth=args.queue_depth,
+        image_size=(args.image_size, args.image_size),
+        preview_steps=args.preview_steps,
+    )
+    server.start()
+    results = []
+    try:
+        for name in args.scenarios:
+            result = run_scenario(
+                SCENARIOS[name],
+                server,
+                args.workflow_dir,
+                args.iterations,
+                args.warmup,
+                args.timeout,
+                args.psd_input_mode,
+                args.image_transport,
+            )
+            results.append(result)
+            total = result["stages"]["total"]
+            print(
+                f"{name:14s} total p50 {total.get('p50_ms', 0):8.1f} ms, "
+                f"p95 {total.get('p95_ms', 0):8.1f} ms, "
+                f"p99 {total.get('p99_ms', 0):8.1f} ms, "
+                f"{result['throughput_per_s']:.2f} results/s"
+            )
+            for stage in STAGES[:-1]:
+                summary = result["stages"][stage]
+                print(f"  {stage:8s} p50 {summary.get('p50_ms', 0):8.1f} ms")
+    finally:
+        server.stop()
+
+    if args.output is not None:
+        report = {
+            "revision": git_revision(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "config": {
+                "delay": args.delay,
+                "queue_depth": args.queue_depth,
+                "image_size": args.image_size,
+                "preview_steps": args.preview_steps,
+                "psd_input_mode": args.psd_input_mode,
+                "image_transport": args.image_transport,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS)
+    )
+    parser.add_argument("--iterations", default=10, type=int)
+    parser.add_argument("--warmup", default=1, type=int)
+    parser.add_argument("--delay", default=0.5, type=float)
+    parser.add_argument("--queue_depth", default=0, type=int)
+    parser.add_argument("--image_size", default=1024, type=int)
+    parser.add_argument("--preview_steps", default=0, type=int)
+    parser.add_argument("--timeout", default=60.0, type=float)
+    parser.add_argument("--psd_input_mode", default="layers", type=str)
+    parser.add_argument("--image_transport", default="base64", type=str)
+    parser.add_argument("-w", "--workflow_dir", default=DEFAULT_WORKFLOW_DIR, type=Path)
+    parser.add_argument("-o", "--output", default=None, type=Path)
+    main(parser.parse_args())
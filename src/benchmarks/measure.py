@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+
+class Measurement(NamedTuple):
+    seconds: list[float]
+    # tracemalloc は numpy の確保も追跡するが、PIL 内部の確保は追跡しないため RSS も併せて記録する
+    # trace_allocations=False で計測した場合は None
+    tracemalloc_peak_bytes: Optional[int]
+    peak_rss_delta_bytes: int
+
+    def summary(self) -> dict:
+        return {
+            "min_ms": min(self.seconds) * 1000,
+            "median_ms": statistics.median(self.seconds) * 1000,
+            "max_ms": max(self.seconds) * 1000,
+            "repeat": len(self.seconds),
+            "tracemalloc_peak_bytes": self.tracemalloc_peak_bytes,
+            "peak_rss_delta_bytes": self.peak_rss_delta_bytes,
+        }
+
+
+def latency_summary(seconds: list[float]) -> dict:
+    # 秒単位の計測値から、比較しやすい ms 単位のパーセンタイルを求める
+    if len(seconds) == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 95, 99])
+    return {
+        "count": len(seconds),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": statistics.fmean(seconds) * 1000,
+        "max_ms": max(seconds) * 1000,
+    }
+
+
+def _read_proc_status(key: str) -> int | None:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_bytes() -> int:
+    rss = _read_proc_status("VmRSS")
+    return rss if rss is not None else peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    peak = _read_proc_status("VmHWM")
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS は bytes、Linux は KiB 単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    # Linux ではピーク RSS (VmHWM) を現在の RSS にリセットできる
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def measure(
+    fn: Callable[[], object],
+    repeat: int = 3,
+    setup: Callable[[], object] | None = None,
+    trace_allocations: bool = True,
+) -> Measurement:
+    # ピーク RSS をリセットできない環境もあるため、時間計測より先に 1 回実行してメモリを計測する
+    # 細かい確保の多い処理は tracemalloc で 10 倍以上遅くなるため、trace_allocations=False で省略できる
+    if setup is not None:
+        setup()
+    reset_peak_rss()
+    rss_before = current_rss_bytes()
+    tracemalloc_peak = None
+    if trace_allocations:
+        tracemalloc.start()
+    fn()
+    if trace_allocations:
+        _, tracemalloc_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    peak_rss_delta = max(peak_rss_bytes() - rss_before, 0)
+
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return Measurement(
+        seconds=seconds,
+        tracemalloc_peak_bytes=tracemalloc_peak,
+        peak_rss_delta_bytes=peak_rss_delta,
+    )
+
+
+def run_isolated(fn: Callable, *args):
+    # 前のケースのピーク RSS の影響を受けないよう、ケースごとに新しいプロセスで計測する
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,369 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import struct
+import threading
+import time
+import uuid
+from typing import NamedTuple, Optional
+
+from aiohttp import web
+from PIL import Image
+
+# ベンチマーク用に ComfyUI の API を模したサーバー
+# /prompt で受け取ったプロンプトを 1 件ずつ execution_delay 秒かけて「実行」し、
+# ETN_SendImageWebSocket と同じ形式 (>II ヘッダー + PNG) のバイナリフレームで結果画像を送る
+# preview_steps を指定すると、実行中にステップごとの progress と JPEG のプレビュー画像を送る
+# queue_depth を指定すると、受け取ったプロンプトの前に他のクライアントのプロンプトが積まれている状態を再現する
+# model_load_delay を指定すると、直前と異なるチェックポイントのプロンプトの実行前にその秒数だけ待つ
+# $ cd src && python -m benchmarks.mock_comfyui --port 8188 --delay 2.0
+
+# comfyui-tooling-nodes の送信形式。1: PREVIEW_IMAGE, 2: PNG
+IMAGE_FRAME_HEADER = struct.pack(">II", 1, 2)
+# ComfyUI のサンプリング中のプレビューの送信形式。1: PREVIEW_IMAGE, 1: JPEG
+PREVIEW_FRAME_HEADER = struct.pack(">II", 1, 1)
+OUTPUT_NODE_TYPE = "ETN_SendImageWebSocket"
+
+
+class PromptRecord(NamedTuple):
+    prompt_id: str
+    client_id: str
+    received_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # "finished", "interrupted", "deleted" のいずれか。未完了の場合は None
+    status: Optional[str] = None
+
+
+class MockComfyUI:
+    def __init__(
+        self,
+        port: int = 0,
+        execution_delay: float = 1.0,
+        queue_depth: int = 0,
+        image_size: tuple[int, int] = (1024, 1024),
+        preview_steps: int = 0,
+        model_load_delay: float = 0.0,
+    ):
+        self.port = port
+        self.execution_delay = execution_delay
+        self.queue_depth = queue_depth
+        self.preview_steps = preview_steps
+        self.model_load_delay = model_load_delay
+        # 読み込み済みのチェックポイントと、読み込み直した回数
+        self.loaded_model: Optional[str] = None
+        self.model_loads = 0
+        self.records: dict[str, PromptRecord] = {}
+        self.bytes_received = 0
+        self._image_frame = IMAGE_FRAME_HEADER + _image_bytes(image_size, "PNG")
+        # プレビューは latent と同じく 1/8 の解像度で送る
+        self._preview_frame = PREVIEW_FRAME_HEADER + _image_bytes(
+            (max(image_size[0] // 8, 1), max(image_size[1] // 8, 1)), "JPEG"
+        )
+        self._output_nodes: dict[str, str] = {}
+        self._models: dict[str, Optional[str]] = {}
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._sockets: dict[str, web.WebSocketResponse] = {}
+        self._deleted: set[str] = set()
+        self._uploads: set[str] = set()
+        self._executing: Optional[str] = None
+        self._interrupt: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, args=(started,), name="mock-comfyui", daemon=True
+        )
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._loop is None or self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+            self.bytes_received = 0
+
+    def _run(self, started: threading.Event):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._startup())
+        started.set()
+        self._loop.run_forever()
+
+    async def _startup(self):
+        app = web.Application(client_max_size=2**30)
+        app.router.add_post("/prompt", self._prompt)
+        app.router.add_get("/system_stats", self._system_stats)
+        app.router.add_post("/interrupt", self._interrupt_handler)
+        app.router.add_post("/queue", self._queue_handler)
+        app.router.add_get("/queue", self._get_queue)
+        app.router.add_get("/history/{prompt_id}", self._history)
+        app.router.add_post("/upload/image", self._upload_image)
+        app.router.add_get("/ws", self._websocket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        await site.start()
+        # port=0 の場合は OS が割り当てたポートを使う
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._queue = asyncio.Queue()
+        self._interrupt = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._execute_loop())
+
+    async def _shutdown(self):
+        self._worker.cancel()
+        for ws in list(self._sockets.values()):
+            await ws.close()
+        await self._runner.cleanup()
+
+    def _update(self, prompt_id: str, **kwargs):
+        with self._lock:
+            if prompt_id in self.records:
+                self.records[prompt_id] = self.records[prompt_id]._replace(**kwargs)
+
+    async def _send(self, client_id: Optional[str], message: dict | bytes):
+        ws = self._sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            if isinstance(message, bytes):
+                await ws.send_bytes(message)
+            else:
+                await ws.send_str(json.dumps(message))
+        except ConnectionError:
+            pass
+
+    async def _send_status(self, client_id: Optional[str]):
+        await self._send(
+            client_id,
+            {
+                "type": "status",
+                "data": {"status": {"exec_info": {"queue_remaining": self._remaining}}},
+            },
+        )
+
+    @property
+    def _remaining(self) -> int:
+        return self._queue.qsize() + (1 if self._executing is not None else 0)
+
+    async def _execute_loop(self):
+        while True:
+            prompt_id, client_id = await self._queue.get()
+            model = self._models.pop(prompt_id, None)
+            if prompt_id in self._deleted:
+                self._output_nodes.pop(prompt_id, None)
+                self._update(
+                    prompt_id, status="deleted", finished_at=time.perf_counter()
+                )
+                continue
+
+            self._executing = prompt_id
+            self._interrupt.clear()
+            self._update(prompt_id, started_at=time.perf_counter())
+            await self._send_status(client_id)
+            message_data = {"prompt_id": prompt_id}
+            await self._send(
+                client_id, {"type": "execution_start", "data": message_data}
+            )
+            if model is not None and model != self.loaded_model:
+                await asyncio.sleep(self.model_load_delay)
+                self.loaded_model = model
+                self.model_loads += 1
+            await self._send(
+                client_id,
+                {"type": "executing", "data": {"node": "1", **message_data}},
+            )
+            interrupted = await self._sample(client_id, message_data)
+
+            if interrupted:
+                await self._send(
+                    client_id, {"type": "execution_interrupted", "data": message_data}
+                )
+                status = "interrupted"
+            else:
+                # 結果画像は出力ノードの実行中に送る
+                output_node = self._output_nodes.pop(prompt_id, "1")
+                await self._send(
+                    client_id,
+                    {
+                        "type": "executing",
+                        "data": {"node": output_node, **message_data},
+                    },
+                )
+                await self._send(client_id, self._image_frame)
+                await self._send(
+                    client_id,
+                    {"type": "executing", "data": {"node": None, **message_data}},
+                )
+                status = "finished"
+            self._executing = None
+            self._update(prompt_id, status=status, finished_at=time.perf_counter())
+            await self._send_status(client_id)
+
+    async def _sample(self, client_id: Optional[str], message_data: dict) -> bool:
+        # execution_delay 秒かけて実行し、中断された場合は True を返す
+        steps = max(self.preview_steps, 1)
+        for step in range(1, steps + 1):
+            try:
+                await asyncio.wait_for(
+                    self._interrupt.wait(), self.execution_delay / steps
+                )
+                return True
+            except asyncio.TimeoutError:
+                pass
+            if self.preview_steps > 0:
+                await self._send(
+                    client_id,
+                    {
+                        "type": "progress",
+                        "data": {
+                            "value": step,
+                            "max": steps,
+                            "node": "1",
+                            **message_data,
+                        },
+                    },
+                )
+                await self._send(client_id, self._preview_frame)
+        return False
+
+    async def _prompt(self, request: web.Request):
+        body = await request.read()
+        data = json.loads(body)
+        prompt_id = str(uuid.uuid4())
+        client_id = data.get("client_id")
+        output_nodes = [
+            node_id
+            for node_id, node in data.get("prompt", {}).items()
+            if node.get("class_type") == OUTPUT_NODE_TYPE
+        ]
+        models = [
+            node["inputs"].get("ckpt_name")
+            for node in data.get("prompt", {}).values()
+            if node.get("class_type") == "CheckpointLoaderSimple"
+        ]
+        with self._lock:
+            self.bytes_received += len(body)
+            self.records[prompt_id] = PromptRecord(
+                prompt_id, client_id, time.perf_counter()
+            )
+        if len(output_nodes) > 0:
+            self._output_nodes[prompt_id] = output_nodes[0]
+        if len(models) > 0:
+            self._models[prompt_id] = models[0]
+        # 他のクライアントのプロンプトが先に積まれている状態を再現する
+        for _ in range(self.queue_depth):
+            await self._queue.put((f"other-{uuid.uuid4()}", None))
+        await self._queue.put((prompt_id, client_id))
+        await self._send_status(client_id)
+        return web.json_response(
+            {"prompt_id": prompt_id, "number": len(self.records), "node_errors": {}}
+        )
+
+    async def _system_stats(self, request: web.Request):
+        return web.json_response({"system": {}, "devices": []})
+
+    async def _interrupt_handler(self, request: web.Request):
+        data = await request.json() if request.can_read_body else {}
+        prompt_id = data.get("prompt_id")
+        if self._executing is not None and prompt_id in (None, self._executing):
+            self._interrupt.set()
+        return web.json_response({})
+
+    async def _queue_handler(self, request: web.Request):
+        data = await request.json()
+        self._deleted.update(data.get("delete", []))
+        return web.json_response({})
+
+    async def _get_queue(self, request: web.Request):
+        # ComfyUI と同じく [番号, prompt_id, prompt, extra_data, outputs] の形式で返す
+        pending = [
+            [i, prompt_id, {}, {}, []]
+            for i, (prompt_id, _) in enumerate(list(self._queue._queue))
+            if prompt_id not in self._deleted
+        ]
+        running = [] if self._executing is None else [[0, self._executing, {}, {}, []]]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def _history(self, request: web.Request):
+        prompt_id = request.match_info["prompt_id"]
+        record = self.records.get(prompt_id)
+        if record is None or record.status is None:
+            return web.json_response({})
+        return web.json_response({prompt_id: {"status": {"status_str": record.status}}})
+
+    async def _upload_image(self, request: web.Request):
+        post = await request.post()
+        image = post["image"]
+        data = image.file.read()
+        with self._lock:
+            self.bytes_received += len(data)
+        self._uploads.add(image.filename)
+        return web.json_response(
+            {"name": image.filename, "subfolder": "", "type": "input"}
+        )
+
+    async def _websocket(self, request: web.Request):
+        ws = web.WebSocketResponse(max_msg_size=2**30)
+        await ws.prepare(request)
+        client_id = request.query.get("clientId", str(uuid.uuid4()))
+        self._sockets[client_id] = ws
+        await self._send_status(client_id)
+        async for _ in ws:
+            pass
+        if self._sockets.get(client_id) is ws:
+            del self._sockets[client_id]
+        return ws
+
+
+def _image_bytes(size: tuple[int, int], format: str) -> bytes:
+    buffered = io.BytesIO()
+    Image.new("RGB", size, (128, 128, 128)).save(buffered, format=format)
+    return buffered.getvalue()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", default=8188, type=int)
+    parser.add_argument("--delay", default=1.0, type=float)
+    parser.add_argument("--queue_depth", default=0, type=int)
+    parser.add_argument("--image_size", default=1024, type=int)
+    parser.add_argument("--preview_steps", default=0, type=int)
+    parser.add_argument("--model_load_delay", default=0.0, type=float)
+    args = parser.parse_args()
+    server = MockComfyUI(
+        args.port,
+        args.delay,
+        args.queue_depth,
+        (args.image_size, args.image_size),
+        args.preview_steps,
+        args.model_load_delay,
+    )
+    server.start()
+    print(f"mock ComfyUI is running on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import NamedTuple, Union
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.measure import git_revision, measure, run_isolated
+from benchmarks.synthetic_psd import (
+    SyntheticGroup,
+    SyntheticLayer,
+    random_layer,
+    save_psd,
+)
+from module.psd_compositor import PsdCompositor
+from utils.util import parse_psd, pil_to_base64, resize_target_resolution
+
+# ComfyUI に送るまでの前処理 (PSD の読み込み・合成・リサイズ・エンコード) を段階ごとに計測する
+# キャンバスの大きさ・レイヤー数・ビット深度・グループ・マスクの異なる PSD を乱数の種から毎回同じ内容で作り、
+# 段階ごとに新しいプロセスで実行時間・ピーク RSS・tracemalloc のピークを計測して JSON に出力する
+# 段階:
+#   open: PSDImage.open のみ, parse_psd: 従来の PIL の paste による合成,
+#   composite: PsdCompositor による合成 (レイヤーのキャッシュなし),
+#   resize: 合成結果を target_resolution にリサイズ, pil_to_base64: リサイズ後の画像の PNG・base64 エンコード
+# $ cd src && python -m benchmarks.preprocess_benchmark -o preprocess.json
+# 前回の結果と比べ、median か peak RSS が --tolerance を超えて悪化した段階があれば終了コード 1 で終了する
+# $ python -m benchmarks.preprocess_benchmark --baseline preprocess.json --tolerance 0.2
+
+STAGES = ("open", "parse_psd", "composite", "resize", "pil_to_base64")
+# この大きさ未満の計測値は揺れが大きいため、悪化の判定に使わない
+MIN_COMPARED_MS = 5.0
+MIN_COMPARED_BYTES = 16 * 1024 * 1024
+
+
+class CorpusCase(NamedTuple):
+    name: str
+    canvas_size: int
+    num_layers: int
+    depth: int = 8
+    # 0 の場合はグループを作らない。それ以外はこの枚数ごとにグループにまとめ、1 つおきに親グループで包む
+    group_size: int = 0
+    # 0 の場合はマスクを付けない。それ以外はこの枚数に 1 枚の割合でレイヤーマスクを付ける
+    mask_every: int = 0
+    # キャンバスに対するレイヤーの最大サイズの比率。レイヤー数が多いほど小さくして生成時間を抑える
+    layer_max_ratio: float = 0.6
+    seed: int = 0
+
+
+CORPUS = {
+    case.name: case
+    for case in [
+        CorpusCase("1k_10", 1024, 10),
+        CorpusCase(
+            "1k_300_nested", 1024, 300, group_size=10, mask_every=4, layer_max_ratio=0.2
+        ),
+        CorpusCase(
+            "2k_100_nested", 2048, 100, group_size=10, mask_every=4, layer_max_ratio=0.3
+        ),
+        CorpusCase(
+            "2k_100_nested_16bit",
+            2048,
+            100,
+            depth=16,
+            group_size=10,
+            mask_every=4,
+            layer_max_ratio=0.3,
+        ),
+        CorpusCase("4k_30", 4096, 30, layer_max_ratio=0.4),
+        CorpusCase(
+            "4k_30_masks_16bit", 4096, 30, depth=16, mask_every=2, layer_max_ratio=0.4
+        ),
+        CorpusCase(
+            "4k_300_nested", 4096, 300, group_size=20, mask_every=4, layer_max_ratio=0.1
+        ),
+        CorpusCase("8k_10", 8192, 10, layer_max_ratio=0.4),
+        CorpusCase("8k_10_16bit", 8192, 10, depth=16, layer_max_ratio=0.4),
+        CorpusCase(
+            "8k_300_nested",
+            8192,
+            300,
+            group_size=20,
+            mask_every=4,
+            layer_max_ratio=0.08,
+        ),
+    ]
+}
+
+
+def gradient_mask(size: tuple[int, int]) -> Image.Image:
+    # 上から下へ薄くなるマスク。圧縮が効きすぎない程度に階調を持たせる
+    mask = np.linspace(255, 0, size[1], dtype=np.uint8)[:, None]
+    return Image.fromarray(np.repeat(mask, size[0], axis=1))
+
+
+def create_items(case: CorpusCase) -> list[Union[SyntheticLayer, SyntheticGroup]]:
+    rng = np.random.default_rng(case.seed)
+    size = (case.canvas_size, case.canvas_size)
+    layers = []
+    for i in range(case.num_layers):
+        # 合成エンジンの通常合成以外の経路も通るよう、一部のレイヤーに合成モードと不透明度を設定する
+        kwargs = {}
+        if i % 5 == 4:
+            kwargs = {"blend_mode": "multiply", "opacity": 200}
+        layer = random_layer(
+            rng,
+            size,
+            f"layer_{i}",
+            min_ratio=case.layer_max_ratio / 4,
+            max_ratio=case.layer_max_ratio,
+            **kwargs,
+        )
+        if case.mask_every > 0 and i % case.mask_every == 0:
+            layer = layer._replace(mask=gradient_mask(layer.image.size))
+        layers.append(layer)
+    if case.group_size == 0:
+        return layers
+
+    items = []
+    for start in range(0, len(layers), case.group_size):
+        index = start // case.group_size
+        group = SyntheticGroup(
+            f"group_{index}", layers[start : start + case.group_size]
+        )
+        if index % 2 == 1:
+            group = SyntheticGroup(f"parent_{index}", [group])
+        items.append(group)
+    return items
+
+
+def corpus_path(corpus_dir: Path, case: CorpusCase) -> Path:
+    # 設定を変えた場合に古い PSD を使わないよう、ファイル名に設定のハッシュを含める
+    digest = hashlib.blake2b(repr(tuple(case)).encode(), digest_size=4).hexdigest()
+    return corpus_dir / f"{case.name}_{digest}.psd"
+
+
+def create_corpus_psd(corpus_dir: Path, case: CorpusCase) -> tuple[Path, float]:
+    path = corpus_path(corpus_dir, case)
+    if path.exists():
+        return path, 0.0
+    start = time.perf_counter()
+    # 保存の途中で中断した PSD を次回使わないよう、一時ファイルに書いてから置き換える
+    tmp_path = path.with_suffix(".tmp")
+    size = (case.canvas_size, case.canvas_size)
+    save_psd(tmp_path, size, create_items(case), depth=case.depth, with_composite=False)
+    tmp_path.replace(path)
+    return path, time.perf_counter() - start
+
+
+def composite_image(psd_path: Path) -> Image.Image:
+    # resize・pil_to_base64 の入力。大きなキャンバスの合成を段階ごとに繰り返さないよう、画素をファイルに残して使い回す
+    cache_path = psd_path.with_suffix(".composite.npy")
+    if cache_path.exists():
+        return Image.fromarray(np.load(cache_path))
+    image = PsdCompositor(input_mode="layers").composite(psd_path).image
+    np.save(cache_path, np.asarray(image))
+    return image
+
+
+def run_stage(
+    stage: str,
+    psd_path: Path,
+    repeat: int,
+    target_resolution: int,
+    trace_allocations: bool = True,
+) -> dict:
+    # 各段階の入力は計測の前に作り、計測には含めない
+    if stage == "open":
+        from psd_tools import PSDImage
+
+        def fn():
+            return PSDImage.open(psd_path)
+
+    elif stage == "parse_psd":
+
+        def fn():
+            return parse_psd(psd_path)
+
+    elif stage == "composite":
+
+        def fn():
+            return PsdCompositor(input_mode="layers").composite(psd_path)
+
+    elif stage == "resize":
+        image = composite_image(psd_path)
+
+        def fn():
+            return resize_target_resolution(image, target_resolution)
+
+    elif stage == "pil_to_base64":
+        resized = resize_target_resolution(composite_image(psd_path), target_resolution)
+
+        def fn():
+            return pil_to_base64(resized)
+
+    else:
+        raise ValueError(f"unknown stage: {stage}")
+    return measure(fn, repeat, trace_allocations=trace_allocations).summary()
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    # 同じケース・段階の前回の結果と比べ、悪化したものを返す
+    previous = {(r["case"], r["stage"]): r for r in baseline.get("results", [])}
+    regressions = []
+    changed = set()
+    for result in results:
+        before = previous.get((result["case"], result["stage"]))
+        if before is None:
+            continue
+        # 生成処理の変更で PSD の内容が変わった場合は比べられない
+        if before.get("file_bytes") != result["file_bytes"]:
+            if result["case"] not in changed:
+                print(f"{result['case']}: corpus changed, not compared")
+                changed.add(result["case"])
+            continue
+        for key, minimum in (
+            ("median_ms", MIN_COMPARED_MS),
+            ("peak_rss_delta_bytes", MIN_COMPARED_BYTES),
+        ):
+            if max(before[key], result[key]) < minimum:
+                continue
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append(
+                    f"{result['case']} {result['stage']} {key}: "
+                    f"{before[key]:.1f} -> {result[key]:.1f}"
+                )
+    return regressions
+
+
+def environment() -> dict:
+    from importlib.metadata import version
+
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "pillow": Image.__version__,
+        "psd_tools": version("psd-tools"),
+    }
+
+
+def main(args: argparse.Namespace):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # --corpus_dir を指定した場合は生成した PSD を残し、次回以降の生成を省略する
+        corpus_dir = args.corpus_dir or Path(tmp_dir)
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+        for name in args.cases:
+            case = CORPUS[name]
+            psd_path, generate_seconds = create_corpus_psd(corpus_dir, case)
+            print(
+                f"{name}: {case.canvas_size}px, {case.num_layers} layers, "
+                f"{case.depth} bit, {psd_path.stat().st_size / 2**20:.1f} MiB "
+                f"(generated in {generate_seconds:.1f} s)"
+            )
+            config = {k: v for k, v in case._asdict().items() if k != "name"}
+            for stage in args.stages:
+                summary = run_isolated(
+                    run_stage,
+                    stage,
+                    psd_path,
+                    args.repeat,
+                    args.target_resolution,
+                    not args.no_tracemalloc,
+                )
+                results.append(
+                    {
+                        "case": name,
+                        "stage": stage,
+                        **config,
+                        "file_bytes": psd_path.stat().st_size,
+                        **summary,
+                    }
+                )
+                line = (
+                    f"  {stage:14s} median {summary['median_ms']:9.1f} ms, "
+                    f"peak rss +{summary['peak_rss_delta_bytes'] / 2**20:7.1f} MiB"
+                )
+                if summary["tracemalloc_peak_bytes"] is not None:
+                    line += (
+                        f", tracemalloc "
+                        f"{summary['tracemalloc_peak_bytes'] / 2**20:7.1f} MiB"
+                    )
+                print(line)
+
+    if args.output is not None:
+        report = {
+            "revision": git_revision(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "environment": environment(),
+            "config": {
+                "repeat": args.repeat,
+                "target_resolution": args.target_resolution,
+                "tracemalloc": not args.no_tracemalloc,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cases", nargs="+", default=list(CORPUS), choices=list(CORPUS)
+    )
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--target_resolution", default=1024, type=int)
+    parser.add_argument("--corpus_dir", default=None, type=Path)
+    # 16 bit の PSD は tracemalloc で 10 倍以上遅くなるため、時間と RSS のみを計測する場合に指定する
+    parser.add_argument("--no_tracemalloc", action="store_true")
+    parser.add_argument("-o", "--output", default=None, type=Path)
+    parser.add_argument("--baseline", default=None, type=Path)
+    parser.add_argument("--tolerance", default=0.2, type=float)
+    main(parser.parse_args())
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import hashlib
+import io
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import (
+    BlendMode,
+    ChannelID,
+    Clipping,
+    Compression,
+    Resource,
+    SectionDivider,
+    SheetColorType,
+    Tag,
+)
+from psd_tools.psd import PSD
+from psd_tools.psd.header import FileHeader
+from psd_tools.psd.image_data import ImageData
+from psd_tools.psd.image_resources import ImageResources
+from psd_tools.psd.layer_and_mask import (
+    ChannelData,
+    ChannelDataList,
+    ChannelImageData,
+    ChannelInfo,
+    LayerAndMaskInformation,
+    LayerFlags,
+    LayerInfo,
+    LayerRecord,
+    LayerRecords,
+    MaskData,
+)
+from psd_tools.psd.tagged_blocks import TaggedBlocks
+
+MAX_CACHED_CHANNELS = 4096
+_compressed_channels: OrderedDict[tuple, bytes] = OrderedDict()
+
+BLEND_MODES = {
+    "normal": BlendMode.NORMAL,
+    "multiply": BlendMode.MULTIPLY,
+    "screen": BlendMode.SCREEN,
+    "overlay": BlendMode.OVERLAY,
+}
+
+
+class SyntheticLayer(NamedTuple):
+    name: str
+    image: Image.Image
+    offset: tuple[int, int] = (0, 0)
+    opacity: int = 255
+    blend_mode: str = "normal"
+    visible: bool = True
+    clipping: bool = False
+    mask: Optional[Image.Image] = None
+    # レイヤーパネルの色ラベル。SheetColorType の名前 (小文字)
+    color: str = "none"
+
+
+class SyntheticGroup(NamedTuple):
+    name: str
+    children: list[Union[SyntheticLayer, "SyntheticGroup"]]
+    visible: bool = True
+    color: str = "none"
+
+
+def _to_channel_bytes(channel: np.ndarray, depth: int) -> bytes:
+    if depth == 16:
+        return (channel.astype(">u2") * 257).tobytes()
+    return channel.astype(np.uint8).tobytes()
+
+
+def _channel_data(
+    channel: np.ndarray, depth: int, compression: Compression
+) -> ChannelData:
+    # 圧縮は Python 実装で遅いため、1 枚だけ描き替えた PSD を繰り返し作る場合に備えて結果を使い回す
+    raw = _to_channel_bytes(channel, depth)
+    height, width = channel.shape
+    key = (
+        hashlib.blake2b(raw, digest_size=16).digest(),
+        width,
+        height,
+        depth,
+        compression,
+    )
+    compressed = _compressed_channels.get(key)
+    if compressed is None:
+        data = ChannelData(compression=compression)
+        data.set_data(raw, width, height, depth)
+        compressed = data.data
+        _compressed_channels[key] = compressed
+        while len(_compressed_channels) > MAX_CACHED_CHANNELS:
+            _compressed_channels.popitem(last=False)
+    else:
+        _compressed_channels.move_to_end(key)
+    return ChannelData(compression=compression, data=compressed)
+
+
+class _RecordBuilder:
+    def __init__(self, depth: int, compression: Compression):
+        self._depth = depth
+        self._compression = compression
+        self._next_id = 1
+        self.records: list[LayerRecord] = []
+        self.channels: list[ChannelDataList] = []
+
+    def _tagged_blocks(
+        self,
+        name: str,
+        divider: Optional[SectionDivider] = None,
+        color: str = "none",
+    ):
+        tagged_blocks = TaggedBlocks()
+        tagged_blocks.set_data(Tag.UNICODE_LAYER_NAME, name)
+        tagged_blocks.set_data(Tag.LAYER_ID, self._next_id)
+        self._next_id += 1
+        if color != "none":
+            tagged_blocks.set_data(
+                Tag.SHEET_COLOR_SETTING, SheetColorType[color.upper()]
+            )
+        if divider is not None:
+            tagged_blocks.set_data(
+                Tag.SECTION_DIVIDER_SETTING,
+                divider,
+                signature=b"8BIM",
+                blend_mode=BlendMode.PASS_THROUGH,
+            )
+        return tagged_blocks
+
+    def _append(self, record: LayerRecord, channels: list[ChannelData]):
+        for info, data in zip(record.channel_info, channels):
+            info.length = data._length
+        self.records.append(record)
+        self.channels.append(ChannelDataList(channels))
+
+    def _empty_record(
+        self,
+        name: str,
+        visible: bool,
+        divider: SectionDivider,
+        color: str = "none",
+    ):
+        channels = [ChannelData(compression=Compression.RAW) for _ in range(4)]
+        record = LayerRecord(
+            channel_info=[
+                ChannelInfo(id=channel_id)
+                for channel_id in (
+                    ChannelID.TRANSPARENCY_MASK,
+                    ChannelID.CHANNEL_0,
+                    ChannelID.CHANNEL_1,
+                    ChannelID.CHANNEL_2,
+                )
+            ],
+            blend_mode=BlendMode.PASS_THROUGH
+            if divider != SectionDivider.BOUNDING_SECTION_DIVIDER
+            else BlendMode.NORMAL,
+            flags=LayerFlags(visible=visible),
+            name=name[:31],
+            tagged_blocks=self._tagged_blocks(name, divider, color),
+        )
+        self._append(record, channels)
+
+    def add(self, item: Union[SyntheticLayer, SyntheticGroup]):
+        # PSD のレイヤーレコードは下から上の順に並ぶ
+        if isinstance(item, SyntheticGroup):
+            self._empty_record(
+                "</Layer group>", True, SectionDivider.BOUNDING_SECTION_DIVIDER
+            )
+            for child in reversed(item.children):
+                self.add(child)
+            self._empty_record(
+                item.name, item.visible, SectionDivider.OPEN_FOLDER, item.color
+            )
+            return
+
+        pixels = np.asarray(item.image.convert("RGBA"))
+        height, width = pixels.shape[:2]
+        left, top = item.offset
+        channel_ids = [
+            ChannelID.TRANSPARENCY_MASK,
+            ChannelID.CHANNEL_0,
+            ChannelID.CHANNEL_1,
+            ChannelID.CHANNEL_2,
+        ]
+        channels = [
+            _channel_data(pixels[..., 3], self._depth, self._compression),
+            _channel_data(pixels[..., 0], self._depth, self._compression),
+            _channel_data(pixels[..., 1], self._depth, self._compression),
+            _channel_data(pixels[..., 2], self._depth, self._compression),
+        ]
+        mask_data = None
+        if item.mask is not None:
+            mask = np.asarray(item.mask.convert("L"))
+            channel_ids.append(ChannelID.USER_LAYER_MASK)
+            channels.append(_channel_data(mask, self._depth, self._compression))
+            mask_data = MaskData(
+                top=top,
+                left=left,
+                bottom=top + mask.shape[0],
+                right=left + mask.shape[1],
+                background_color=255,
+            )
+        record = LayerRecord(
+            top=top,
+            left=left,
+            bottom=top + height,
+            right=left + width,
+            channel_info=[ChannelInfo(id=channel_id) for channel_id in channel_ids],
+            blend_mode=BLEND_MODES[item.blend_mode],
+            opacity=item.opacity,
+            clipping=Clipping.NON_BASE if item.clipping else Clipping.BASE,
+            flags=LayerFlags(visible=item.visible),
+            mask_data=mask_data,
+            name=item.name[:31],
+            tagged_blocks=self._tagged_blocks(item.name, color=item.color),
+        )
+        self._append(record, channels)
+
+
+def random_layer(
+    rng: np.random.Generator,
+    canvas_size: tuple[int, int],
+    name: str,
+    min_ratio: float = 0.1,
+    max_ratio: float = 0.6,
+    **kwargs,
+) -> SyntheticLayer:
+    # 圧縮が効きすぎないよう、単色の矩形にグラデーションのアルファと少量のノイズを加える
+    width = max(int(canvas_size[0] * rng.uniform(min_ratio, max_ratio)), 1)
+    height = max(int(canvas_size[1] * rng.uniform(min_ratio, max_ratio)), 1)
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., :3] = rng.integers(0, 256, 3, dtype=np.uint8)
+    pixels[..., :3] += rng.integers(0, 8, (height, width, 1), dtype=np.uint8)
+    pixels[..., 3] = np.linspace(64, 255, width, dtype=np.uint8)[None, :]
+    left = int(rng.integers(-width // 4, canvas_size[0] - width // 2))
+    top = int(rng.integers(-height // 4, canvas_size[1] - height // 2))
+    return SyntheticLayer(name, Image.fromarray(pixels), (left, top), **kwargs)
+
+
+def _flatten(
+    items: list[Union[SyntheticLayer, SyntheticGroup]], visible: bool = True
+) -> list[SyntheticLayer]:
+    layers = []
+    for item in items:
+        if isinstance(item, SyntheticGroup):
+            layers += _flatten(item.children, visible and item.visible)
+        elif visible and item.visible:
+            layers.append(item)
+    return layers
+
+
+def flatten_layers(
+    size: tuple[int, int], items: list[Union[SyntheticLayer, SyntheticGroup]]
+) -> Image.Image:
+    # 埋め込み用の合成画像。通常合成のみ考慮した簡易的なもの
+    canvas = Image.new("RGBA", size, (255, 255, 255, 255))
+    for layer in reversed(_flatten(items)):
+        image = layer.image.convert("RGBA")
+        if layer.opacity != 255:
+            alpha = image.getchannel("A").point(lambda a: a * layer.opacity // 255)
+            image.putalpha(alpha)
+        canvas.alpha_composite(image, layer.offset)
+    return canvas
+
+
+def build_psd(
+    size: tuple[int, int],
+    items: list[Union[SyntheticLayer, SyntheticGroup]],
+    depth: int = 8,
+    with_composite: bool = True,
+    compression: Compression = Compression.RLE,
+) -> PSDImage:
+    assert depth in (8, 16), f"depth {depth} is not supported."
+    header = FileHeader(
+        width=size[0], height=size[1], depth=depth, channels=3, color_mode=3
+    )
+    builder = _RecordBuilder(depth, compression)
+    # items は上から下の順で受け取る
+    for item in reversed(items):
+        builder.add(item)
+
+    image_resources = ImageResources.new()
+    image_resources.get_data(Resource.VERSION_INFO).has_composite = with_composite
+    image_data = ImageData(compression=compression)
+    if with_composite:
+        merged = np.asarray(flatten_layers(size, items).convert("RGB"))
+    else:
+        merged = np.full((size[1], size[0], 3), 255, dtype=np.uint8)
+    image_data.set_data(
+        [_to_channel_bytes(merged[..., i], depth) for i in range(3)], header
+    )
+
+    layer_info = LayerInfo(
+        layer_count=len(builder.records),
+        layer_records=LayerRecords(builder.records),
+        channel_image_data=ChannelImageData(builder.channels),
+    )
+    return PSDImage(
+        PSD(
+            header=header,
+            image_resources=image_resources,
+            layer_and_mask_information=LayerAndMaskInformation(layer_info=layer_info),
+            image_data=image_data,
+        )
+    )
+
+
+def psd_bytes(*args, **kwargs) -> bytes:
+    # 保存処理の時間を計測に含めないよう、ファイルの中身を事前にメモリ上に作る
+    buffered = io.BytesIO()
+    build_psd(*args, **kwargs).save(buffered)
+    return buffered.getvalue()
+
+
+def save_psd(path: str | Path, *args, **kwargs) -> Path:
+    psd = build_psd(*args, **kwargs)
+    psd.save(str(path))
+    return Path(path)
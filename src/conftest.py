@@ -0,0 +1,2 @@
+# tests/ から src 直下のパッケージ (module, utils, benchmarks など) を import できるよう、
+# このディレクトリを rootdir として pytest に sys.path へ追加させる
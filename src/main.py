@@ -1,17 +1,274 @@
-from pathlib import Path
-from module.ui import build_ui
-import argparse
+import time
 
+# --profile_startup で計測する起動時間の起点。他の import より先に記録する
+# そのため以降の import は意図して先頭に置かず、E402 を個別に抑制する
+STARTED_AT = time.perf_counter()
 
-def main(psd_path, workflow_dir):
-    build_ui(psd_path, workflow_dir)
+from pathlib import Path  # noqa: E402
+from module.options import (  # noqa: E402
+    DEFAULT_CACHE_DIR,
+    DEFAULT_FULL_THRESHOLD,
+    DEFAULT_METRICS_HOST,
+    INPUT_MODES,
+    TRANSPORT_MODES,
+    VIEW_IMG_HEIGHT,
+    VIEW_IMG_WIDTH,
+)
+from utils.startup_profile import StartupProfiler, phase  # noqa: E402
+import argparse  # noqa: E402
+import sys  # noqa: E402
+
+
+def main(
+    psd_path,
+    workflow_dir,
+    psd_input_mode,
+    image_transport_mode,
+    comfyui_input_dir,
+    result_cache_dir,
+    result_cache_max_mb,
+    trace_path,
+    metrics_port,
+    metrics_host,
+    region_inference,
+    region_full_threshold,
+    progressive,
+    warmup,
+    variations,
+    multi_user,
+    max_in_flight,
+    psd_root,
+    session_timeout_min,
+    comfyui_urls,
+    profiler=None,
+):
+    # gradio の読み込みには数秒かかるため、PSD の監視を始めてから UI を組み立てる
+    # profiler を指定した場合は UI を起動せず、起動までの時間を計測して終了する
+    if multi_user:
+        with phase(profiler, "service"):
+            from module.inference_service import InferenceService
+
+            service = InferenceService(
+                workflow_dir,
+                image_transport_mode=image_transport_mode,
+                comfyui_input_dir=comfyui_input_dir,
+                result_cache_dir=result_cache_dir,
+                result_cache_max_bytes=result_cache_max_mb * 1024 * 1024,
+                trace_path=trace_path,
+                metrics_port=metrics_port,
+                metrics_host=metrics_host,
+                warmup=warmup,
+                max_in_flight=max_in_flight,
+                backend_urls=comfyui_urls,
+            )
+        stop = service.stop
+        with phase(profiler, "ui"):
+            from module.ui import build_multi_user_ui
+
+            ui = build_multi_user_ui(
+                service,
+                workflow_dir,
+                psd_root,
+                psd_input_mode,
+                region_inference,
+                region_full_threshold,
+                progressive,
+                variations,
+            )
+        if profiler is None:
+            service.start_janitor(session_timeout_min * 60)
+    else:
+        with phase(profiler, "watch"):
+            from module.inference_manager import InferenceManager
+
+            inference_manager = InferenceManager(
+                workflow_dir,
+                psd_path,
+                VIEW_IMG_HEIGHT,
+                VIEW_IMG_WIDTH,
+                psd_input_mode=psd_input_mode,
+                image_transport_mode=image_transport_mode,
+                comfyui_input_dir=comfyui_input_dir,
+                result_cache_dir=result_cache_dir,
+                result_cache_max_bytes=result_cache_max_mb * 1024 * 1024,
+                trace_path=trace_path,
+                metrics_port=metrics_port,
+                metrics_host=metrics_host,
+                region_inference=region_inference,
+                region_full_threshold=region_full_threshold,
+                progressive=progressive,
+                warmup=warmup,
+                variations=variations,
+                backend_urls=comfyui_urls,
+            )
+        stop = inference_manager.stop
+        with phase(profiler, "ui"):
+            from module.ui import build_ui
+
+            ui = build_ui(inference_manager)
+
+    try:
+        if profiler is None:
+            ui.launch()
+    finally:
+        stop()
+
+
+def batch(
+    psd_glob,
+    manifest,
+    output_dir,
+    workflow_dir,
+    psd_input_mode,
+    image_transport_mode,
+    comfyui_input_dir,
+    num_workers,
+    max_in_flight,
+    comfyui_urls,
+    profiler=None,
+):
+    with phase(profiler, "batch"):
+        from module.batch_runner import (
+            BatchRunner,
+            items_from_glob,
+            items_from_manifest,
+        )
+
+        if manifest is not None:
+            items = items_from_manifest(manifest, workflow_dir)
+        else:
+            items = items_from_glob(psd_glob, workflow_dir)
+        runner = BatchRunner(
+            output_dir,
+            input_mode=psd_input_mode,
+            transport_mode=image_transport_mode,
+            comfyui_input_dir=comfyui_input_dir,
+            num_workers=num_workers,
+            max_in_flight=max_in_flight,
+            backend_urls=comfyui_urls,
+        )
+    if profiler is None:
+        try:
+            runner.run(items)
+        finally:
+            runner.close()
+
+
+def add_common_arguments(parser: argparse.ArgumentParser, with_defaults: bool = True):
+    # batch のサブコマンドにも同じ引数を登録する。サブコマンド側は既定値を持たせず (SUPPRESS)、
+    # batch より前に指定した値を既定値で上書きしないようにする
+    def default(value):
+        return value if with_defaults else argparse.SUPPRESS
+
+    parser.add_argument(
+        "-w", "--workflow_dir", default=default("workflows/img2img_xl"), type=Path
+    )
+    parser.add_argument(
+        "--psd_input_mode", default=default("auto"), choices=INPUT_MODES, type=str
+    )
+    parser.add_argument(
+        "--image_transport",
+        default=default("base64"),
+        choices=TRANSPORT_MODES,
+        type=str,
+    )
+    parser.add_argument("--comfyui_input_dir", default=default(None), type=Path)
+    # 複数の ComfyUI を使う場合は繰り返し指定する (例: --comfyui_url http://gpu1:8188)
+    parser.add_argument(
+        "--comfyui_url",
+        dest="comfyui_urls",
+        action="append",
+        default=default(None),
+        type=str,
+    )
+    # UI・バッチ変換を起動せずに、起動までの各段階の時間と import の内訳を表示する
+    parser.add_argument(
+        "--profile_startup", action="store_true", default=default(False)
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--psd_path", required=True, type=Path)
+    parser.add_argument("-p", "--psd_path", default=None, type=Path)
+    add_common_arguments(parser)
+    parser.add_argument("--result_cache_dir", default=DEFAULT_CACHE_DIR, type=Path)
+    parser.add_argument("--result_cache_max_mb", default=1024, type=int)
+    parser.add_argument("--trace_path", default=None, type=Path)
+    parser.add_argument("--metrics_port", default=None, type=int)
+    parser.add_argument("--metrics_host", default=DEFAULT_METRICS_HOST, type=str)
+    parser.add_argument("--region_inference", action="store_true")
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--warmup", action="store_true")
+    parser.add_argument("--variations", default=1, type=int)
+    # 1 つの ComfyUI を複数の作業者で共有する。PSD は UI から開く
+    parser.add_argument("--multi_user", action="store_true")
+    parser.add_argument("--max_in_flight", default=2, type=int)
+    parser.add_argument("--psd_root", default=None, type=Path)
+    parser.add_argument("--session_timeout_min", default=30, type=float)
     parser.add_argument(
-        "-w", "--workflow_dir", default="workflows/img2img_xl", type=Path
+        "--region_full_threshold", default=DEFAULT_FULL_THRESHOLD, type=float
     )
+
+    # UI を起動せずに複数の PSD をまとめて変換する
+    subparsers = parser.add_subparsers(dest="command")
+    batch_parser = subparsers.add_parser("batch")
+    batch_input = batch_parser.add_mutually_exclusive_group(required=True)
+    batch_input.add_argument("--glob", dest="psd_glob", default=None, type=str)
+    batch_input.add_argument("--manifest", default=None, type=Path)
+    batch_parser.add_argument("-o", "--output_dir", required=True, type=Path)
+    add_common_arguments(batch_parser, with_defaults=False)
+    batch_parser.add_argument("--workers", default=None, type=int)
+    batch_parser.add_argument("--max_in_flight", default=argparse.SUPPRESS, type=int)
     args = parser.parse_args()
-    main(args.psd_path, args.workflow_dir)
+    profiler = None
+    if args.profile_startup:
+        profiler = StartupProfiler(STARTED_AT)
+
+    if args.command == "batch":
+        batch(
+            args.psd_glob,
+            args.manifest,
+            args.output_dir,
+            args.workflow_dir,
+            args.psd_input_mode,
+            args.image_transport,
+            args.comfyui_input_dir,
+            args.workers,
+            args.max_in_flight,
+            args.comfyui_urls,
+            profiler,
+        )
+    else:
+        if args.psd_path is None and not args.multi_user:
+            parser.error("the following arguments are required: -p/--psd_path")
+        # ブラウザから任意のファイルを開けないよう、複数人で使う場合は開ける範囲を必ず指定する
+        if args.multi_user and args.psd_root is None:
+            parser.error("--psd_root is required with --multi_user")
+        main(
+            args.psd_path,
+            args.workflow_dir,
+            args.psd_input_mode,
+            args.image_transport,
+            args.comfyui_input_dir,
+            args.result_cache_dir,
+            args.result_cache_max_mb,
+            args.trace_path,
+            args.metrics_port,
+            args.metrics_host,
+            args.region_inference,
+            args.region_full_threshold,
+            args.progressive,
+            args.warmup,
+            args.variations,
+            args.multi_user,
+            args.max_in_flight,
+            args.psd_root,
+            args.session_timeout_min,
+            args.comfyui_urls,
+            profiler,
+        )
+
+    if profiler is not None:
+        print(profiler.report())
+        # 目安を超えた場合は終了コードで知らせる
+        sys.exit(0 if profiler.within_budget() else 1)
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Callable, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+from PIL import Image
+
+from module.client import MAX_TRACKED_PROMPTS, Client, ClientMessage, PromptTiming
+from module.http_pool import DEFAULT_TIMEOUT, BackendUnavailable
+from module.workflow_manager import workflow_models
+
+if TYPE_CHECKING:
+    from module.workflow_manager import WorkflowInstance
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+DEFAULT_BACKEND_URL = "http://127.0.0.1:8188"
+# モデルの読み込みは生成 2 回分程度かかるとみなし、読み込み済みの ComfyUI のキューがその分長くても優先する
+MODEL_SWITCH_COST = 2
+# ComfyUI ごとに読み込み済みとみなすモデルの数。これより古いものは VRAM から追い出されたとみなす
+LOADED_MODELS_PER_BACKEND = 4
+# 停止中だった ComfyUI に後から送れるよう保持する、アップロードした画像の合計サイズの上限
+MAX_RETAINED_UPLOAD_BYTES = 256 * 1024 * 1024
+
+
+def split_url(url: str) -> tuple[str, str]:
+    # "http://host:port" を Client の ip と port に分ける。port を省略した場合は ComfyUI の既定値
+    parts = urlsplit(url if "://" in url else f"http://{url}")
+    assert parts.hostname is not None, f"invalid ComfyUI url: {url}"
+    return f"{parts.scheme}://{parts.hostname}", str(parts.port or 8188)
+
+
+def connect(
+    urls: Optional[list[str]] = None, timeout: float = DEFAULT_TIMEOUT
+) -> Client | BackendPool:
+    # ComfyUI が 1 つの場合は Client をそのまま使い、複数の場合は BackendPool で振り分ける
+    urls = list(dict.fromkeys(urls or [DEFAULT_BACKEND_URL]))
+    if len(urls) == 1:
+        ip, port = split_url(urls[0])
+        return Client(ip=ip, port=port, timeout=timeout)
+    return BackendPool(urls, timeout=timeout)
+
+
+class Backend:
+    def __init__(self, client: Client):
+        self.client = client
+        # このアプリから積んで、まだ完了していないプロンプト
+        self.pending: set[str] = set()
+        # 停止を検知して他で生成し直したプロンプト。復旧したらキューから削除する
+        self.abandoned: set[str] = set()
+        # 最近積んだプロンプトが読み込むモデル。新しいものほど後ろ
+        self.models: OrderedDict[str, None] = OrderedDict()
+        # アップロード済みの画像の名前
+        self.uploaded: set[str] = set()
+        self.last_selected = 0
+
+    @property
+    def load(self) -> int:
+        # status で届くキューの残り件数は他のクライアントの分も含むが、積んだ直後は反映されていない
+        return max(self.client.queue_remaining, len(self.pending))
+
+    def has_models(self, models: frozenset[str]) -> bool:
+        return all(model in self.models for model in models)
+
+    def use_models(self, models: frozenset[str]):
+        for model in models:
+            self.models[model] = None
+            self.models.move_to_end(model)
+        while len(self.models) > LOADED_MODELS_PER_BACKEND:
+            self.models.popitem(last=False)
+
+
+# 複数の ComfyUI を 1 つの Client と同じように扱い、プロンプトごとに積む先を選ぶモジュール
+# キューの残り件数が少なく、workflow のモデルを読み込み済みの ComfyUI を優先する
+# 停止した ComfyUI には積まず、待ち受け中のプロンプトは PromptLost で終わらせて他の ComfyUI で生成し直させる
+# アップロードした画像は稼働中のすべてに送り、送れなかった ComfyUI にはその画像を参照するプロンプトを積む前に送る
+class BackendPool:
+    def __init__(self, urls: list[str], timeout: float = DEFAULT_TIMEOUT):
+        assert len(urls) > 0, "at least one ComfyUI url is required."
+        self.url = ", ".join(urls)
+        self._lock = threading.Lock()
+        self._selections = itertools.count(1)
+        self._available = threading.Event()
+        self._recover_callbacks: list[Callable[[], None]] = []
+        self._backends: list[Backend] = []
+        # prompt_id ごとの積んだ先。待ち受けを終えるか取り消すまでは件数に関係なく保持する
+        self._routes: dict[str, Backend] = {}
+        # 待ち受けを終えたプロンプトの積んだ先。完了後の pop_timing・cancel で参照するため一定数残す
+        self._finished_routes: OrderedDict[str, Backend] = OrderedDict()
+        # アップロードした画像の名前ごとの (ファイル名, PNG)。古いものから破棄する
+        self._uploads: OrderedDict[str, tuple[str, bytes]] = OrderedDict()
+        self._upload_bytes = 0
+        for url in urls:
+            ip, port = split_url(url)
+            backend = Backend(Client(ip=ip, port=port, timeout=timeout))
+            backend.client.add_availability_callback(
+                lambda available, backend=backend: self._on_availability_changed(
+                    backend, available
+                )
+            )
+            self._backends.append(backend)
+        self._update_available()
+
+    @property
+    def backends(self) -> list[Client]:
+        return [backend.client for backend in self._backends]
+
+    @property
+    def available(self) -> bool:
+        return any(backend.client.available for backend in self._backends)
+
+    @property
+    def queue_remaining(self) -> int:
+        return sum(
+            backend.client.queue_remaining
+            for backend in self._backends
+            if backend.client.available
+        )
+
+    def add_recover_callback(self, callback: Callable[[], None]):
+        # いずれかの ComfyUI が停止から復旧したときに、イベントループのスレッドから呼ばれる
+        self._recover_callbacks.append(callback)
+
+    def remove_recover_callback(self, callback: Callable[[], None]):
+        if callback in self._recover_callbacks:
+            self._recover_callbacks.remove(callback)
+
+    def wait_available(self, timeout: Optional[float] = None) -> bool:
+        return self._available.wait(timeout)
+
+    def _update_available(self):
+        if self.available:
+            self._available.set()
+        else:
+            self._available.clear()
+
+    def _on_availability_changed(self, backend: Backend, available: bool):
+        self._update_available()
+        with self._lock:
+            # 再起動した場合はモデルも読み込み直しになる
+            backend.models.clear()
+            abandoned = list(backend.abandoned) if available else []
+            backend.abandoned.clear()
+            if not available:
+                backend.abandoned.update(backend.pending)
+        if not available:
+            logger.warning(
+                f"ComfyUI ({backend.client.url}) is unavailable, "
+                + f"{len(backend.abandoned)} prompts are moved to other backends"
+            )
+            backend.client.abandon_pending()
+            return
+
+        logger.info(f"ComfyUI ({backend.client.url}) recovered")
+        if len(abandoned) > 0:
+            # 他で生成し直したプロンプトが残っていれば、二重に生成しないよう削除する
+            # イベントループのスレッドから呼ばれるため、同期の API は別スレッドで呼ぶ
+            threading.Thread(
+                target=self._delete_abandoned,
+                args=(backend, abandoned),
+                name="delete-abandoned",
+                daemon=True,
+            ).start()
+        for callback in list(self._recover_callbacks):
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"Unhandled exception in recover callback, {e}")
+
+    def _delete_abandoned(self, backend: Backend, prompt_ids: list[str]):
+        try:
+            backend.client.delete_queued(prompt_ids)
+        except Exception as e:
+            logger.warning(f"failed to delete abandoned prompts: {e}")
+
+    def _candidates(self, models: frozenset[str]) -> list[Backend]:
+        # キューの残り件数 + モデルの読み込みの重みが小さい順。同じ場合は最も前に選んだものから
+        with self._lock:
+            backends = [
+                backend for backend in self._backends if backend.client.available
+            ]
+            return sorted(
+                backends,
+                key=lambda backend: (
+                    backend.load
+                    + (0 if backend.has_models(models) else MODEL_SWITCH_COST),
+                    backend.last_selected,
+                ),
+            )
+
+    def enqueue(self, workflow: dict | WorkflowInstance) -> str:
+        if isinstance(workflow, dict):
+            models = workflow_models(workflow)
+        else:
+            models = workflow.models
+        images = self._referenced_uploads(workflow)
+        last_error: Optional[Exception] = None
+        for backend in self._candidates(models):
+            with self._lock:
+                backend.last_selected = next(self._selections)
+            try:
+                self._upload_missing(backend, images)
+                prompt_id = backend.client.enqueue(workflow)
+            except (BackendUnavailable, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 停止した ComfyUI には積めないため、次の候補に積む
+                logger.warning(f"failed to enqueue to {backend.client.url}: {e!r}")
+                last_error = e
+                continue
+            with self._lock:
+                backend.pending.add(prompt_id)
+                backend.use_models(models)
+                self._routes[prompt_id] = backend
+            logger.debug(f"enqueue {prompt_id} to {backend.client.url}")
+            return prompt_id
+        raise BackendUnavailable(f"ComfyUI ({self.url}) is unavailable.") from (
+            last_error
+        )
+
+    def _route(self, prompt_id: str) -> Optional[Backend]:
+        with self._lock:
+            backend = self._routes.get(prompt_id)
+            if backend is None:
+                backend = self._finished_routes.get(prompt_id)
+            return backend
+
+    def _backend(self, prompt_id: str) -> Backend:
+        backend = self._route(prompt_id)
+        assert backend is not None, f"prompt {prompt_id} is not enqueued by this pool."
+        return backend
+
+    def _finish(self, backend: Backend, prompt_id: str):
+        with self._lock:
+            backend.pending.discard(prompt_id)
+            if self._routes.pop(prompt_id, None) is None:
+                return
+            self._finished_routes[prompt_id] = backend
+            while len(self._finished_routes) > MAX_TRACKED_PROMPTS:
+                self._finished_routes.popitem(last=False)
+
+    def polling(self, prompt_id) -> Image.Image:
+        return self.submit_polling(prompt_id).result()
+
+    def submit_polling(
+        self,
+        prompt_id,
+        on_event: Optional[Callable[[ClientMessage], None]] = None,
+    ) -> Future:
+        backend = self._backend(prompt_id)
+        future = backend.client.submit_polling(prompt_id, on_event)
+        future.add_done_callback(lambda _: self._finish(backend, prompt_id))
+        return future
+
+    def cancel(self, prompt_id: str):
+        backend = self._backend(prompt_id)
+        self._finish(backend, prompt_id)
+        backend.client.cancel(prompt_id)
+
+    def pop_timing(self, prompt_id: str) -> Optional[PromptTiming]:
+        backend = self._route(prompt_id)
+        if backend is None:
+            return None
+        return backend.client.pop_timing(prompt_id)
+
+    def upload_image(self, filename: str, data: bytes) -> str:
+        # どの ComfyUI に積むかは enqueue まで決まらないため、稼働中のすべてに送る
+        names = []
+        uploaded = []
+        for backend in self._backends:
+            if not backend.client.available:
+                continue
+            try:
+                names.append(backend.client.upload_image(filename, data))
+                uploaded.append(backend)
+            except (BackendUnavailable, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"failed to upload to {backend.client.url}: {e!r}")
+        if len(names) == 0:
+            raise BackendUnavailable(f"ComfyUI ({self.url}) is unavailable.")
+        name = names[0]
+        with self._lock:
+            if name not in self._uploads:
+                self._uploads[name] = (filename, data)
+                self._upload_bytes += len(data)
+            self._uploads.move_to_end(name)
+            for backend in uploaded:
+                backend.uploaded.add(name)
+            while self._upload_bytes > MAX_RETAINED_UPLOAD_BYTES:
+                evicted, (_, evicted_data) = self._uploads.popitem(last=False)
+                self._upload_bytes -= len(evicted_data)
+                for backend in self._backends:
+                    backend.uploaded.discard(evicted)
+        return name
+
+    def _referenced_uploads(self, workflow: dict | WorkflowInstance) -> list[str]:
+        # 画像の名前は内容のハッシュを含むため、workflow の JSON に含まれるかどうかで判定する
+        with self._lock:
+            if len(self._uploads) == 0:
+                return []
+            names = list(self._uploads)
+        if isinstance(workflow, dict):
+            prompt = json.dumps(workflow)
+        else:
+            prompt = workflow.to_json()
+        return [name for name in names if name in prompt]
+
+    def _upload_missing(self, backend: Backend, names: list[str]):
+        # アップロードした時点で停止していた ComfyUI には、積む前に画像を送る
+        for name in names:
+            with self._lock:
+                upload = self._uploads.get(name)
+                if upload is None or name in backend.uploaded:
+                    continue
+            backend.client.upload_image(*upload)
+            logger.debug(f"upload {name} to {backend.client.url} before enqueue")
+            with self._lock:
+                if name in self._uploads:
+                    backend.uploaded.add(name)
+
+    def health_check(self) -> bool:
+        return any(backend.client.health_check() for backend in self._backends)
+
+    def close(self):
+        for backend in self._backends:
+            backend.client.close()
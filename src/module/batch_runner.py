@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+from schemas.generate_settings import GenerateSettings, LayerSelection
+from module.backend_pool import BackendPool, connect
+from module.client import PromptLost
+from module.http_pool import BackendUnavailable
+from module.image_transport import (
+    EncodedImage,
+    ImageTransport,
+    TransportMode,
+    encode_image,
+)
+from module.psd_compositor import InputMode, PsdCompositor
+from module.workflow_manager import WorkflowManager
+from utils.util import resize_target_resolution
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+PROGRESS_FILE_NAME = "progress.jsonl"
+# ComfyUI が起動していない場合に、各 PSD を積む前に待つ時間 (秒)
+CONNECTION_TIMEOUT = 60.0
+
+
+class BatchItem(NamedTuple):
+    id: str
+    psd_path: Path
+    workflow_dir: Path
+    # settings.json の値を上書きする生成設定
+    settings: dict
+    output_name: str
+
+
+class PreparedInput(NamedTuple):
+    image: EncodedImage
+    size: tuple[int, int]
+    seconds: float
+
+
+class InFlight(NamedTuple):
+    item: BatchItem
+    prompt_id: str
+    future: Future
+    seed: int
+    # ComfyUI の停止でプロンプトが失われた場合に、合成し直さずに積み直すための入力
+    prepared: PreparedInput
+
+
+def create_item(
+    psd_path: Path,
+    workflow_dir: Path,
+    settings: Optional[dict] = None,
+    output_name: Optional[str] = None,
+    id: Optional[str] = None,
+) -> BatchItem:
+    settings = settings or {}
+    if id is None:
+        # 同じ PSD・workflow・設定の組は再開時に同じものとして扱う
+        id = hashlib.blake2b(
+            json.dumps(
+                [str(psd_path), str(workflow_dir), settings], sort_keys=True
+            ).encode(),
+            digest_size=8,
+        ).hexdigest()
+    if output_name is None:
+        output_name = f"{psd_path.stem}_{id}.png"
+    return BatchItem(id, psd_path, workflow_dir, settings, output_name)
+
+
+def items_from_glob(pattern: str, workflow_dir: Path) -> list[BatchItem]:
+    paths = sorted(glob.glob(pattern, recursive=True))
+    return [create_item(Path(path), workflow_dir) for path in paths]
+
+
+def items_from_manifest(manifest_path: Path, workflow_dir: Path) -> list[BatchItem]:
+    # 1 行 1 リクエストの JSONL。psd 以外は省略可能
+    # {"psd": "a.psd", "workflow_dir": "workflows/img2img_xl", "settings": {"prompt": "1girl"}, "output": "a.png", "id": "a"}
+    items = []
+    with open(manifest_path, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            request = json.loads(line)
+            items.append(
+                create_item(
+                    Path(request["psd"]),
+                    Path(request.get("workflow_dir", workflow_dir)),
+                    request.get("settings"),
+                    request.get("output"),
+                    request.get("id"),
+                )
+            )
+    return items
+
+
+def prepare_input(
+    psd_path: Path,
+    target_resolution: int,
+    input_mode: InputMode,
+    transport_mode: TransportMode,
+    input_layers: Optional[LayerSelection] = None,
+) -> PreparedInput:
+    # プロセスプールで実行する。PSD の合成・リサイズ・PNG エンコードまでを行う
+    start = time.perf_counter()
+    image = PsdCompositor(input_mode=input_mode).composite(psd_path, input_layers).image
+    image = resize_target_resolution(image, target_resolution)
+    return PreparedInput(
+        encode_image(image, transport_mode), image.size, time.perf_counter() - start
+    )
+
+
+def prepared_future(prepared: PreparedInput) -> Future:
+    # 準備済みの入力を、合成待ちの項目と同じ形で扱うための完了済みの Future
+    future: Future = Future()
+    future.set_result(prepared)
+    return future
+
+
+def load_progress(progress_path: Path) -> dict[str, dict]:
+    progress = {}
+    if progress_path.exists():
+        with open(progress_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断時に書きかけだった行は無視する
+                    continue
+                progress[record["id"]] = record
+    return progress
+
+
+# 複数の PSD をまとめて ComfyUI で変換するモジュール
+# PSD の合成・エンコードはプロセスプールで並列に行い、ComfyUI には常に max_in_flight 件のプロンプトを積んでおく
+# 結果は output_dir に保存し、完了した項目は progress.jsonl に追記して中断後に再開できるようにする
+class BatchRunner:
+    def __init__(
+        self,
+        output_dir: Path,
+        server_ip: str = "http://127.0.0.1",
+        port_port: str = "8188",
+        input_mode: InputMode = "auto",
+        transport_mode: TransportMode = "base64",
+        comfyui_input_dir: Optional[Path] = None,
+        num_workers: Optional[int] = None,
+        max_in_flight: int = 2,
+        backend_urls: Optional[list[str]] = None,
+    ):
+        assert max_in_flight > 0, "max_in_flight must be positive."
+        self._output_dir = output_dir
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+        self._progress_path = output_dir / PROGRESS_FILE_NAME
+        self._input_mode = input_mode
+        self._transport_mode = transport_mode
+        self._comfyui_input_dir = comfyui_input_dir
+        self._num_workers = num_workers or os.cpu_count() or 1
+        # 複数の ComfyUI を指定した場合は、max_in_flight 件ずつ積む
+        self._client = connect(backend_urls or [f"{server_ip}:{port_port}"])
+        self._max_in_flight = max_in_flight
+        if isinstance(self._client, BackendPool):
+            self._max_in_flight *= len(self._client.backends)
+        self._workflow_managers: dict[Path, WorkflowManager] = {}
+        self._settings: dict[Path, GenerateSettings] = {}
+
+    def run(self, items: list[BatchItem]) -> dict[str, int]:
+        progress = load_progress(self._progress_path)
+        self._terminate_partial_line()
+        pending = [
+            item for item in items if progress.get(item.id, {}).get("status") != "done"
+        ]
+        counts = {"done": 0, "skip": 0, "error": 0}
+        logger.info(f"{len(items) - len(pending)} / {len(items)} items already done")
+
+        # 子プロセスにイベントループのスレッドなどを引き継がないよう spawn で起動する
+        with ProcessPoolExecutor(
+            max_workers=self._num_workers, mp_context=get_context("spawn")
+        ) as pool:
+            # 合成済みの入力が ComfyUI の処理より先行しすぎないよう、投入数を制限する
+            max_prepared = self._num_workers + self._max_in_flight
+            preparing: list[tuple[BatchItem, Future]] = []
+            in_flight: list[InFlight] = []
+            while len(pending) > 0 or len(preparing) > 0 or len(in_flight) > 0:
+                while len(pending) > 0 and len(preparing) < max_prepared:
+                    item = pending.pop(0)
+                    preparing.append((item, self._submit_prepare(pool, item)))
+
+                # 入力の準備ができたものから ComfyUI に積む
+                while (
+                    len(preparing) > 0
+                    and preparing[0][1].done()
+                    and len(in_flight) < self._max_in_flight
+                ):
+                    item, future = preparing.pop(0)
+                    try:
+                        in_flight.append(self._enqueue(item, future.result()))
+                    except Exception as e:
+                        logger.exception(f"failed to request {item.psd_path}, {e}")
+                        self._record(item, "error", error=str(e))
+                        counts["error"] += 1
+
+                for job in [job for job in in_flight if job.future.done()]:
+                    in_flight.remove(job)
+                    status = self._finish(job)
+                    if status == "retry":
+                        preparing.insert(0, (job.item, prepared_future(job.prepared)))
+                        continue
+                    counts[status] += 1
+
+                self._wait(preparing, in_flight)
+
+        logger.info(
+            f"batch finished: {counts['done']} done, "
+            f"{counts['skip']} skipped, {counts['error']} errors"
+        )
+        return counts
+
+    def _workflow(self, workflow_dir: Path) -> tuple[WorkflowManager, GenerateSettings]:
+        if workflow_dir not in self._workflow_managers:
+            with open(workflow_dir / "settings.json", "r") as f:
+                self._settings[workflow_dir] = GenerateSettings(**json.load(f))
+            image_transport = ImageTransport(
+                self._transport_mode,
+                client=self._client,
+                comfyui_input_dir=self._comfyui_input_dir,
+            )
+            self._workflow_managers[workflow_dir] = WorkflowManager(
+                workflow_dir, image_transport
+            )
+        return self._workflow_managers[workflow_dir], self._settings[workflow_dir]
+
+    def _generate_settings(self, item: BatchItem) -> GenerateSettings:
+        _, generate_settings = self._workflow(item.workflow_dir)
+        return GenerateSettings(**{**generate_settings.model_dump(), **item.settings})
+
+    def _submit_prepare(self, pool: ProcessPoolExecutor, item: BatchItem) -> Future:
+        generate_settings = self._generate_settings(item)
+        return pool.submit(
+            prepare_input,
+            item.psd_path,
+            generate_settings.target_resolution,
+            self._input_mode,
+            self._transport_mode,
+            generate_settings.input_layers,
+        )
+
+    def _enqueue(self, item: BatchItem, prepared: PreparedInput) -> InFlight:
+        workflow_manager, _ = self._workflow(item.workflow_dir)
+        generate_settings = workflow_manager.resolve_settings(
+            self._generate_settings(item)
+        )
+        workflow = workflow_manager.create(prepared.image, generate_settings)
+        # UI と異なり保存を見送れないため、ComfyUI が復旧するまで待ってから積む
+        if not self._client.wait_available(CONNECTION_TIMEOUT):
+            raise BackendUnavailable("Connection timeout")
+        prompt_id = self._client.enqueue(workflow)
+        logger.debug(
+            f"{item.psd_path}: prepared in {prepared.seconds * 1000:.0f} ms, "
+            f"input image: {workflow.transport_stats}"
+        )
+        return InFlight(
+            item,
+            prompt_id,
+            self._client.submit_polling(prompt_id),
+            generate_settings.seed,
+            prepared,
+        )
+
+    def _finish(self, job: InFlight) -> str:
+        try:
+            generated_img = job.future.result()
+        except PromptLost as e:
+            # 停止した ComfyUI で失われたプロンプトは、稼働中の ComfyUI に積み直す
+            logger.warning(f"{job.item.psd_path}: {e}, retry")
+            return "retry"
+        except Exception as e:
+            logger.exception(f"generation failed for {job.item.psd_path}, {e}")
+            self._record(job.item, "error", prompt_id=job.prompt_id, error=str(e))
+            return "error"
+
+        if not isinstance(generated_img, Image.Image):
+            # 直前と同じプロンプトは ComfyUI 側で処理がスキップされ、画像が返らない
+            self._record(job.item, "skip", prompt_id=job.prompt_id)
+            return "skip"
+
+        output_path = self._output_dir / job.item.output_name
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        generated_img.save(output_path)
+        self._record(
+            job.item,
+            "done",
+            prompt_id=job.prompt_id,
+            seed=job.seed,
+            output=str(output_path),
+        )
+        logger.debug(f"saved {output_path}")
+        return "done"
+
+    def _terminate_partial_line(self):
+        # 中断時に書きかけだった行の後ろに追記すると、次の記録までその行と一緒に読めなくなるため改行で区切る
+        if not self._progress_path.exists():
+            return
+        with open(self._progress_path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def close(self):
+        self._client.close()
+
+    def _record(self, item: BatchItem, status: str, **kwargs):
+        record = {"id": item.id, "psd": str(item.psd_path), "status": status, **kwargs}
+        with open(self._progress_path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _wait(
+        self, preparing: list[tuple[BatchItem, Future]], in_flight: list[InFlight]
+    ):
+        # 次に状態が変わりうる Future のいずれかが完了するまで待つ
+        futures = [job.future for job in in_flight]
+        if len(preparing) > 0 and len(in_flight) < self._max_in_flight:
+            futures.append(preparing[0][1])
+        if len(futures) == 0:
+            return
+        wait(futures, return_when=FIRST_COMPLETED)
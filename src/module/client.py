@@ -3,18 +3,30 @@ from __future__ import annotations
 import asyncio
 import io
 import json
+import random
 import struct
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
 from enum import Enum
-from typing import NamedTuple, Optional
-from urllib import request
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional
 
 from PIL import Image
 from websockets import client as websockets_client
 from websockets import exceptions as websockets_exceptions
 
 from module.eventloop import AsyncApp
+from module.http_pool import (
+    DEFAULT_TIMEOUT,
+    BackendUnavailable,
+    HealthMonitor,
+    HttpPool,
+)
+
+if TYPE_CHECKING:
+    from module.workflow_manager import WorkflowInstance
 from logging import getLogger, StreamHandler, DEBUG
 
 logger = getLogger(__name__)
@@ -23,6 +35,27 @@ handler = StreamHandler()
 handler.setLevel(DEBUG)
 logger.addHandler(handler)
 
+RECONNECT_BACKOFF_MIN = 0.5
+RECONNECT_BACKOFF_MAX = 10.0
+MAX_TRACKED_PROMPTS = 64
+# 最終的な結果画像を送信するノード。これ以外のノードの実行中に届いた画像はプレビューとして扱う
+OUTPUT_NODE_TYPES = ("ETN_SendImageWebSocket",)
+# /prompt は入力画像を埋め込むため大きくなりうる。/upload/image も同様
+PROMPT_TIMEOUT = 30.0
+UPLOAD_TIMEOUT = 60.0
+# WebSocket の接続を待つ間に、ComfyUI の停止を確認する間隔 (秒)
+LISTEN_CHECK_INTERVAL = 0.5
+
+
+class PromptLost(BackendUnavailable):
+    # 待ち受け中に ComfyUI が再起動し、プロンプトがキューからも履歴からも消えた
+    pass
+
+
+class PromptStateEvicted(Exception):
+    # 待ち受けを始める前に受信したメッセージが、保持数の上限を超えて破棄された
+    pass
+
 
 class ClientEvent(Enum):
     progress = 0
@@ -31,6 +64,9 @@ class ClientEvent(Enum):
     error = 3
     connected = 4
     disconnected = 5
+    preview = 6
+    queued = 7
+    lost = 8
 
 
 class ClientMessage(NamedTuple):
@@ -40,148 +76,495 @@ class ClientMessage(NamedTuple):
     result: Optional[dict] = None
     error: Optional[str] = None
     queue_remaining: Optional[int] = 0
+    # progress の場合はサンプリングのステップ数
+    step: int = 0
+    total_steps: int = 0
+    # preview の場合は生成途中の画像
+    preview: Optional[Image.Image] = None
+
+
+class PromptTiming(NamedTuple):
+    # time.perf_counter() の値。ComfyUI 側でスキップされた場合などは None
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    # 実行開始までに観測したキューの残り件数の最大値 (自身を含む)
+    queue_position: int
+
+
+class PromptState:
+    def __init__(self):
+        self.queue: asyncio.Queue[ClientMessage] = asyncio.Queue()
+        self.images: list[Image.Image] = []
+        self.waiting = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.queue_position = 0
 
 
 class Client:
-    def __init__(self, ip="http://127.0.0.1", port="8188"):
+    def __init__(
+        self, ip="http://127.0.0.1", port="8188", timeout: float = DEFAULT_TIMEOUT
+    ):
         self.url = f"{ip}:{port}"
         self._id = str(uuid.uuid4())
-        self._connected = False
         self._async_app = AsyncApp()
+        # HTTP のリクエストは keep-alive の接続を使い回し、停止中はサーキットブレーカーで即座に失敗させる
+        self._http = HttpPool(self.url, timeout=timeout)
+        self._health_monitor = HealthMonitor(self._http)
+        self._available = threading.Event()
+        self._available.set()
+        self._recover_callbacks: list[Callable[[], None]] = []
+        self._http.breaker.add_callback(self._on_availability_changed)
 
-    def enqueue(self, workflow):
-        if not self._connected:
-            self._wait_connection()
-        data = {"prompt": workflow, "client_id": self._id}
-        data = json.dumps(data).encode("utf-8")
-        req = request.Request(f"{self.url}/prompt", data)
-        req = json.loads(request.urlopen(req).read())
-        return req["prompt_id"]
-
-    def _wait_connection(self, time_out=60):
-        wait_time = 0
-        self._connected = self.health_check()
-        while not self._connected:
-            self._connected = self.health_check()
-            if wait_time > time_out:
-                raise Exception("Connection timeout")
-            else:
-                print("waiting for connection with ComfyUI...")
-                time.sleep(1)
-                wait_time += 1
+        self._listen_task: Optional[asyncio.Task] = None
+        self._ws_connected: Optional[asyncio.Event] = None
+        self._prompts: OrderedDict[str, PromptState] = OrderedDict()
+        # 待ち受け前に状態を破棄したプロンプト。後から待ち受けた場合に、待ち続けずに失敗させる
+        self._evicted_prompts: OrderedDict[str, None] = OrderedDict()
+        self._executing_prompt_id: Optional[str] = None
+        self._executing_node: Optional[str] = None
+        self._queue_remaining = 0
+        self._timings: OrderedDict[str, PromptTiming] = OrderedDict()
+        # プロンプトごとの結果画像を送信するノードの ID
+        # enqueue するスレッドから書き込むため、イベントループ側の _prompts とは分けて持つ
+        self._output_nodes: OrderedDict[str, set[str]] = OrderedDict()
+        # 起動を待たずに死活確認を始め、ComfyUI の停止・復旧を検知する
+        self._async_app.run(self._start_health_monitor())
 
-    def health_check(self):
-        req = request.Request(f"{self.url}/system_stats")
-        try:
-            status = request.urlopen(req).status
-            if status == 200:
-                return True
-            return False
-        except Exception:
-            return False
-
-    async def _listen(self, prompt_id):
+    @property
+    def queue_remaining(self) -> int:
+        return self._queue_remaining
+
+    def pop_timing(self, prompt_id: str) -> Optional[PromptTiming]:
+        return self._timings.pop(prompt_id, None)
+
+    @property
+    def available(self) -> bool:
+        # ComfyUI が応答しているか。停止中の enqueue は待たずに BackendUnavailable になる
+        return self._http.breaker.allow()
+
+    def add_recover_callback(self, callback: Callable[[], None]):
+        # ComfyUI が停止から復旧したときに、イベントループのスレッドから呼ばれる
+        self._recover_callbacks.append(callback)
+
+    def remove_recover_callback(self, callback: Callable[[], None]):
+        if callback in self._recover_callbacks:
+            self._recover_callbacks.remove(callback)
+
+    def add_availability_callback(self, callback: Callable[[bool], None]):
+        # ComfyUI の停止 (False)・復旧 (True) を検知したときに、イベントループのスレッドから呼ばれる
+        self._http.breaker.add_callback(callback)
+
+    def wait_available(self, timeout: Optional[float] = None) -> bool:
+        # UI 以外 (バッチ処理など) で、ComfyUI が起動するまで待つ場合に使う
+        return self._available.wait(timeout)
+
+    def _on_availability_changed(self, available: bool):
+        if not available:
+            self._available.clear()
+            return
+        self._available.set()
+        for callback in list(self._recover_callbacks):
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"Unhandled exception in recover callback, {e}")
+
+    async def _start_health_monitor(self):
+        self._health_monitor.start()
+
+    def close(self):
+        self._async_app.run(self._close())
+
+    async def _close(self):
+        await self._health_monitor.stop()
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        await self._http.close()
+
+    def enqueue(self, workflow: dict | WorkflowInstance):
+        if not self.available:
+            raise BackendUnavailable(f"ComfyUI ({self.url}) is unavailable.")
+        if isinstance(workflow, dict):
+            prompt = json.dumps(workflow)
+            output_nodes = {
+                node_id
+                for node_id, node in workflow.items()
+                if node.get("class_type") in OUTPUT_NODE_TYPES
+            }
+        else:
+            # シリアライズ済みのテンプレートに値を差し込んだ JSON をそのまま送る
+            prompt = workflow.to_json()
+            output_nodes = set(workflow.output_nodes)
+        data = f'{{"prompt": {prompt}, "client_id": {json.dumps(self._id)}}}'
+        res = self._async_app.run(self._enqueue(data.encode("utf-8")))
+        prompt_id = res["prompt_id"]
+        self._output_nodes[prompt_id] = output_nodes
+        # 待ち受け中のプロンプトの分は、待ち受けの終了時に削除されるまで残す
+        for tracked_id in list(self._output_nodes):
+            if len(self._output_nodes) <= MAX_TRACKED_PROMPTS:
+                break
+            state = self._prompts.get(tracked_id)
+            if state is None or not state.waiting:
+                self._output_nodes.pop(tracked_id, None)
+        return prompt_id
+
+    async def _enqueue(self, data: bytes) -> dict:
+        # 実行開始のメッセージを取りこぼさないよう、キューに積む前に WebSocket を接続しておく
+        await self._ensure_listening()
+        # 同じプロンプトが二重に積まれないよう、送信前の接続エラー以外では再試行しない
+        return await self._http.request_json(
+            "POST",
+            "/prompt",
+            data=data,
+            headers={"Content-Type": "application/json"},
+            timeout=PROMPT_TIMEOUT,
+            idempotent=False,
+        )
+
+    def cancel(self, prompt_id: str):
+        # 実行中であれば中断し、キュー待ちであればキューから削除する
+        if self._executing_prompt_id == prompt_id:
+            self.interrupt(prompt_id)
+        else:
+            self.delete_queued([prompt_id])
+
+    def interrupt(self, prompt_id: Optional[str] = None):
+        # prompt_id を指定できない古い ComfyUI では実行中のプロンプトが中断される
+        data = {} if prompt_id is None else {"prompt_id": prompt_id}
+        self._post("/interrupt", data)
+
+    def delete_queued(self, prompt_ids: list[str]):
+        self._post("/queue", {"delete": prompt_ids})
+
+    def upload_image(self, filename: str, data: bytes) -> str:
+        # ComfyUI の input ディレクトリに保存し、LoadImage で参照する名前を返す
+        boundary = uuid.uuid4().hex
+        body = b"".join(
+            [
+                f"--{boundary}\r\n".encode(),
+                b'Content-Disposition: form-data; name="image"; '
+                + f'filename="{filename}"\r\n'.encode(),
+                b"Content-Type: image/png\r\n\r\n",
+                data,
+                f"\r\n--{boundary}\r\n".encode(),
+                b'Content-Disposition: form-data; name="overwrite"\r\n\r\ntrue',
+                f"\r\n--{boundary}--\r\n".encode(),
+            ]
+        )
+        res = self._async_app.run(
+            self._http.request_json(
+                "POST",
+                "/upload/image",
+                data=body,
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+                timeout=UPLOAD_TIMEOUT,
+            )
+        )
+        if res.get("subfolder"):
+            return f"{res['subfolder']}/{res['name']}"
+        return res["name"]
+
+    def _post(self, path: str, data: dict):
+        # /interrupt と /queue の削除は何度送っても結果が同じため、再試行してよい
+        self._async_app.run(
+            self._http.request(
+                "POST",
+                path,
+                data=json.dumps(data),
+                headers={"Content-Type": "application/json"},
+            )
+        )
+
+    def health_check(self) -> bool:
+        return self._async_app.run(self._http.probe("/system_stats"))
+
+    async def _ensure_listening(self, timeout: float = PROMPT_TIMEOUT):
+        # client_id ごとに 1 本の WebSocket を張り続け、受信は常駐タスクで行う
+        if self._listen_task is None or self._listen_task.done():
+            self._ws_connected = asyncio.Event()
+            self._listen_task = asyncio.get_running_loop().create_task(self._listen())
+        # ComfyUI の停止を検知したら、接続を待ち続けずに失敗させる
+        deadline = time.monotonic() + timeout
+        while not self._ws_connected.is_set():
+            if not self.available:
+                raise BackendUnavailable(f"ComfyUI ({self.url}) is unavailable.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                await asyncio.wait_for(
+                    self._ws_connected.wait(), min(remaining, LISTEN_CHECK_INTERVAL)
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def _listen(self):
         url = self.url.replace("http", "ws", 1)
-        async for websocket in websockets_client.connect(
-            f"{url}/ws?clientId={self._id}",
-            max_size=2**30,
-            read_limit=2**30,
-            ping_timeout=60,
-        ):
+        backoff = RECONNECT_BACKOFF_MIN
+        reconnected = False
+        while True:
             try:
-                async for msg in self._listen_main(websocket, prompt_id):
-                    yield msg
-            except websockets_exceptions.ConnectionClosedError as e:
+                async with websockets_client.connect(
+                    f"{url}/ws?clientId={self._id}",
+                    max_size=2**30,
+                    read_limit=2**30,
+                    ping_timeout=60,
+                ) as websocket:
+                    backoff = RECONNECT_BACKOFF_MIN
+                    self._ws_connected.set()
+                    if reconnected:
+                        asyncio.get_running_loop().create_task(
+                            self._recover_pending_prompts()
+                        )
+                    reconnected = True
+                    async for msg in websocket:
+                        self._route_message(msg)
+            except asyncio.CancelledError:
+                raise
+            except websockets_exceptions.ConnectionClosed as e:
                 logger.warning(f"Websocket connection closed: {str(e)}")
             except OSError as e:
-                msg = "Could not connect to websocket server " + f"at {url}: {str(e)}"
-            except asyncio.CancelledError:
-                await websocket.close()
-                break
+                logger.warning(
+                    "Could not connect to websocket server " + f"at {url}: {str(e)}"
+                )
             except Exception as e:
                 logger.exception(f"Unhandled exception in websocket listener, {e}")
 
-    async def _listen_main(
-        self,
-        websocket: websockets_client.WebSocketClientProtocol,
-        prompt_id: str,
-    ):
-        images = []
-        result = None
-
-        async for msg in websocket:
-            if isinstance(msg, bytes):
-                image = _extract_message_png_image(memoryview(msg))
-                if image is not None:
-                    images.append(image)
-
-            elif isinstance(msg, str):
-                msg = json.loads(msg)
-                if msg["type"] == "status":
-                    yield ClientMessage(
-                        event=ClientEvent.connected,
+            self._ws_connected.clear()
+            # 再接続は指数バックオフで行う
+            await asyncio.sleep(backoff * random.uniform(0.8, 1.2))
+            backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+    async def _recover_pending_prompts(self):
+        # 切断中に完了したプロンプトは完了通知を受け取れないため、履歴を確認して待ち状態を解除する
+        # ComfyUI が再起動した場合はキューからも消えているため、待ち続けないよう失敗させる
+        queued: Optional[set[str]] = None
+        for prompt_id, state in list(self._prompts.items()):
+            if not state.waiting:
+                continue
+            try:
+                history = await self._http.request_json("GET", f"/history/{prompt_id}")
+                if prompt_id not in history and queued is None:
+                    queued = await self._queued_prompt_ids()
+            except Exception as e:
+                logger.warning(f"Could not get history of {prompt_id}: {e}")
+                continue
+            if prompt_id in history:
+                logger.warning(f"{prompt_id} finished while websocket was disconnected")
+                state.queue.put_nowait(
+                    ClientMessage(
+                        event=ClientEvent.finished,
                         prompt_id=prompt_id,
-                        queue_remaining=msg["data"]["status"]["exec_info"][
-                            "queue_remaining"
-                        ],
+                        images=state.images,
                     )
+                )
+            elif queued is not None and prompt_id not in queued:
+                logger.warning(f"{prompt_id} was lost while websocket was disconnected")
+                state.queue.put_nowait(
+                    ClientMessage(event=ClientEvent.lost, prompt_id=prompt_id)
+                )
+
+    def abandon_pending(self):
+        # 待ち受け中のプロンプトを PromptLost で終わらせる
+        # 複数の ComfyUI を使う場合に、停止したものの復旧を待たずに他で生成し直すために使う
+        self._async_app.submit(self._abandon_pending())
 
-                # if msg["type"] == "progress":
-                #     progress = msg["data"]["value"]
-                #     yield ClientMessage(
-                #         ClientEvent.progress, prompt_id, progress
-                #     )
-
-                if (
-                    msg["type"] == "executing"
-                    and msg["data"]["node"] is None
-                    and msg["data"]["prompt_id"] == prompt_id
-                ):
-                    yield ClientMessage(
-                        event=ClientEvent.finished, prompt_id=prompt_id, images=images
+    async def _abandon_pending(self):
+        for prompt_id, state in list(self._prompts.items()):
+            if state.waiting:
+                state.queue.put_nowait(
+                    ClientMessage(
+                        event=ClientEvent.lost,
+                        prompt_id=prompt_id,
+                        error=f"{prompt_id} was abandoned, ComfyUI ({self.url}) stopped.",
                     )
+                )
 
-                if (
-                    msg["type"] == "executed"
-                    and msg["data"]["prompt_id"] == prompt_id
-                    and images != []
-                ):
-                    yield ClientMessage(
-                        event=ClientEvent.finished,
+    async def _queued_prompt_ids(self) -> set[str]:
+        # キューの各要素は [番号, prompt_id, prompt, ...] の形式
+        res = await self._http.request_json("GET", "/queue")
+        return {
+            item[1]
+            for key in ("queue_running", "queue_pending")
+            for item in res.get(key, [])
+        }
+
+    def _prompt_state(self, prompt_id: str, waiting: bool = False) -> PromptState:
+        state = self._prompts.get(prompt_id)
+        if state is None:
+            # 待ち受け前に届いたメッセージも取りこぼさないよう、初回受信時に作成する
+            state = PromptState()
+            state.waiting = waiting
+            self._prompts[prompt_id] = state
+            self._evict_prompt_states()
+        elif waiting:
+            state.waiting = True
+        return state
+
+    def _evict_prompt_states(self):
+        # 待ち受け中の状態は、待ち受けの終了時に削除されるため破棄しない
+        for prompt_id, state in list(self._prompts.items()):
+            if len(self._prompts) <= MAX_TRACKED_PROMPTS:
+                return
+            if state.waiting:
+                continue
+            del self._prompts[prompt_id]
+            self._evicted_prompts[prompt_id] = None
+            while len(self._evicted_prompts) > MAX_TRACKED_PROMPTS:
+                self._evicted_prompts.popitem(last=False)
+
+    def _route_message(self, msg: str | bytes):
+        if isinstance(msg, bytes):
+            # バイナリフレームには prompt_id が含まれないため、実行中のプロンプトに紐付ける
+            image = _extract_message_png_image(memoryview(msg))
+            if image is None or self._executing_prompt_id is None:
+                return
+            state = self._prompt_state(self._executing_prompt_id)
+            # 結果画像を送信するノードが不明な場合は、受信した画像をすべて結果として扱う
+            output_nodes = self._output_nodes.get(self._executing_prompt_id)
+            if output_nodes is None or self._executing_node in output_nodes:
+                state.images.append(image)
+            else:
+                # サンプラーなどが送る生成途中のプレビュー
+                state.queue.put_nowait(
+                    ClientMessage(
+                        event=ClientEvent.preview,
+                        prompt_id=self._executing_prompt_id,
+                        preview=image,
+                    )
+                )
+            return
+
+        msg = json.loads(msg)
+        data = msg.get("data", {})
+        if msg["type"] == "status":
+            self._queue_remaining = data["status"]["exec_info"]["queue_remaining"]
+            for prompt_id, state in self._prompts.items():
+                if state.started_at is None:
+                    state.queue_position = max(
+                        state.queue_position, self._queue_remaining
+                    )
+                    if state.waiting:
+                        state.queue.put_nowait(
+                            ClientMessage(
+                                event=ClientEvent.queued,
+                                prompt_id=prompt_id,
+                                queue_remaining=self._queue_remaining,
+                            )
+                        )
+            return
+
+        # 古い ComfyUI の progress には prompt_id が含まれないため、実行中のプロンプトとみなす
+        prompt_id = data.get("prompt_id")
+        if msg["type"] == "progress":
+            prompt_id = prompt_id or self._executing_prompt_id
+            if prompt_id is not None:
+                self._prompt_state(prompt_id).queue.put_nowait(
+                    ClientMessage(
+                        event=ClientEvent.progress,
                         prompt_id=prompt_id,
-                        images=images,
-                        result=result,
+                        step=data["value"],
+                        total_steps=data["max"],
                     )
+                )
+            return
+        if prompt_id is None:
+            return
+
+        if msg["type"] == "execution_start":
+            self._executing_prompt_id = prompt_id
+            self._prompt_state(prompt_id).started_at = time.perf_counter()
+        elif msg["type"] == "executing":
+            self._executing_node = data["node"]
+            if data["node"] is not None:
+                self._executing_prompt_id = prompt_id
+                return
+            self._executing_prompt_id = None
+            state = self._prompt_state(prompt_id)
+            state.finished_at = time.perf_counter()
+            state.queue.put_nowait(
+                ClientMessage(
+                    event=ClientEvent.finished,
+                    prompt_id=prompt_id,
+                    images=state.images,
+                    queue_remaining=self._queue_remaining,
+                )
+            )
+        elif msg["type"] == "execution_interrupted":
+            self._prompt_state(prompt_id).queue.put_nowait(
+                ClientMessage(event=ClientEvent.interrupted, prompt_id=prompt_id)
+            )
+        elif msg["type"] == "execution_error":
+            self._prompt_state(prompt_id).queue.put_nowait(
+                ClientMessage(
+                    event=ClientEvent.error,
+                    prompt_id=prompt_id,
+                    error=data.get("exception_message", "execution error"),
+                )
+            )
 
     def polling(self, prompt_id) -> Image.Image:
         return self._async_app.run(self._polling(prompt_id))
 
-    async def _polling(self, prompt_id) -> Image.Image | None:
-        results = await self._receive_images(prompt_id)
-        if isinstance(results, list) and isinstance(results[0], Image.Image):
+    def submit_polling(
+        self,
+        prompt_id,
+        on_event: Optional[Callable[[ClientMessage], None]] = None,
+    ) -> Future:
+        # 生成結果を待たずに Future を返す。cancel すると待ち受けも中断される
+        # on_event にはキュー待ち・進捗・プレビューのメッセージがイベントループのスレッドから渡される
+        return self._async_app.submit(self._polling(prompt_id, on_event))
+
+    async def _polling(
+        self,
+        prompt_id,
+        on_event: Optional[Callable[[ClientMessage], None]] = None,
+    ) -> Image.Image | None:
+        results = await self._receive_images(prompt_id, on_event)
+        if isinstance(results, list) and len(results) > 0:
             return results[0]
         else:
             return None
 
-    async def _receive_images(self, prompt_id):
-        async for msg in self._listen(prompt_id):
-            if msg.event is ClientEvent.finished and msg.prompt_id == prompt_id:
-                assert msg.images is not None
-                return msg.images
-            # if (
-            #     msg.event is ClientEvent.connected
-            #     and msg.prompt_id == prompt_id
-            #     and msg.queue_remaining == 0
-            # ):
-            #     return
-            # if (
-            #     msg.event is ClientEvent.progress
-            #     and msg.prompt_id == prompt_id
-            # ):
-            #     return msg.progress
-            if msg.event is ClientEvent.error and msg.prompt_id == prompt_id:
-                raise Exception(msg.error)
-        assert False, "Connection closed without receiving images"
+    async def _receive_images(
+        self,
+        prompt_id,
+        on_event: Optional[Callable[[ClientMessage], None]] = None,
+    ):
+        if prompt_id in self._evicted_prompts:
+            del self._evicted_prompts[prompt_id]
+            raise PromptStateEvicted(
+                f"messages of {prompt_id} were discarded before polling started."
+            )
+        state = self._prompt_state(prompt_id, waiting=True)
+        try:
+            await self._ensure_listening()
+            while True:
+                msg = await state.queue.get()
+                if msg.event is ClientEvent.finished:
+                    return msg.images
+                if msg.event is ClientEvent.interrupted:
+                    return None
+                if msg.event is ClientEvent.error:
+                    raise Exception(msg.error)
+                if msg.event is ClientEvent.lost:
+                    raise PromptLost(
+                        msg.error or f"{prompt_id} was lost by ComfyUI restart."
+                    )
+                if on_event is not None:
+                    try:
+                        on_event(msg)
+                    except Exception as e:
+                        logger.exception(f"Unhandled exception in event callback, {e}")
+        finally:
+            state = self._prompts.pop(prompt_id, state)
+            self._output_nodes.pop(prompt_id, None)
+            self._timings[prompt_id] = PromptTiming(
+                state.started_at, state.finished_at, state.queue_position
+            )
+            while len(self._timings) > MAX_TRACKED_PROMPTS:
+                self._timings.popitem(last=False)
 
 
 def _extract_message_png_image(data: memoryview) -> Optional[Image.Image]:
@@ -1,46 +1,116 @@
 import asyncio
+import atexit
+import threading
+from concurrent.futures import Future
+from typing import Coroutine, Optional
+from logging import getLogger, StreamHandler, DEBUG
 
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
 
-_loop = asyncio.new_event_loop()
-asyncio.set_event_loop(_loop)
 
+class EventLoopThread:
+    # asyncio のイベントループを専用スレッドで回し続け、他スレッドからコルーチンを投入するモジュール
+    def __init__(self, name: str = "event-loop"):
+        self._name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
 
-async def sleep(interval):
-    await asyncio.sleep(interval)
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        self.start()
+        assert self._loop is not None
+        return self._loop
 
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
 
-def run(future):
-    task = None
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                return
+            started = threading.Event()
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._loop, started),
+                name=self._name,
+                daemon=True,
+            )
+            self._thread.start()
+            started.wait()
 
-    def schedule():
-        nonlocal task
-        task = _loop.create_task(future)
-        _loop.stop()
+    def _run(self, loop: asyncio.AbstractEventLoop, started: threading.Event):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            # 停止時に残っているタスクはキャンセルしてから閉じる
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
 
-    if not _loop.is_running():
-        _loop.call_soon(schedule)
-        _loop.run_forever()
-    else:
-        task = _loop.create_task(future)
-    assert task, "Task was not scheduled"
-    return task
+    def submit(self, coro: Coroutine) -> Future:
+        # 返り値の Future を cancel するとループ側のタスクもキャンセルされる
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None):
+        assert (
+            threading.current_thread() is not self._thread
+        ), "ループのスレッド内から run を呼ぶとデッドロックします。await してください。"
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            if not self.is_running():
+                return
+            assert self._loop is not None and self._thread is not None
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning("event loop thread did not stop in time")
+            self._thread = None
+
+
+_event_loop_thread = EventLoopThread()
+atexit.register(_event_loop_thread.stop)
+
+
+def get_event_loop_thread() -> EventLoopThread:
+    return _event_loop_thread
+
+
+def submit(coro: Coroutine) -> Future:
+    return _event_loop_thread.submit(coro)
+
+
+def run(coro: Coroutine, timeout: Optional[float] = None):
+    return _event_loop_thread.run(coro, timeout)
 
 
 def stop():
-    global _loop
-    try:
-        _loop.stop()
-        _loop.close()
-    except Exception:
-        pass
+    _event_loop_thread.stop()
 
 
 class AsyncApp:
-    def __init__(self):
-        pass
-
-    def run(self, coro):
-        task = run(coro)
-        while not task.done():
-            _loop.run_until_complete(sleep(0.02))
-        return task.result()
+    def __init__(self, event_loop_thread: Optional[EventLoopThread] = None):
+        self._event_loop_thread = event_loop_thread or _event_loop_thread
+
+    def submit(self, coro: Coroutine) -> Future:
+        return self._event_loop_thread.submit(coro)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None):
+        return self._event_loop_thread.run(coro, timeout)
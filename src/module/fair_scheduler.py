@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    from module.backend_pool import BackendPool
+    from module.client import Client, ClientMessage
+    from module.workflow_manager import WorkflowInstance
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# 複数のセッションで GPU を共有する場合に、ComfyUI のキューに同時に積むプロンプトの既定数
+DEFAULT_MAX_IN_FLIGHT = 2
+# 順番を待つ間に、中断の必要 (新しい保存・停止) を確認する間隔 (秒)
+ABORT_CHECK_INTERVAL = 0.05
+
+
+class Superseded(Exception):
+    # 順番を待つ間に新しい保存が届いたため、プロンプトを積まずに取りやめた
+    pass
+
+
+# 複数のセッションが 1 つの ComfyUI を共有する場合に、キューに積む順番を決めるモジュール
+# ComfyUI のキューには max_in_flight 件までしか積まず、空きができたら最も長く順番が回っていないセッションに渡す
+# 1 人が連続して保存しても、他のセッションは 1 件ずつ交互に処理される
+class FairScheduler:
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        assert max_in_flight > 0, "max_in_flight must be positive."
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        self._slots = itertools.count()
+        # 使用中の枠とそのセッション
+        self._in_flight: dict[int, str] = {}
+        # 順番を待っているセッションと、待ち始めた順番
+        self._waiting: dict[str, int] = {}
+        self._arrivals = itertools.count()
+        # セッションごとに最後に枠を渡した時刻。小さいほど優先する
+        self._last_granted: dict[str, float] = {}
+
+    @property
+    def in_flight(self) -> int:
+        with self._cond:
+            return len(self._in_flight)
+
+    @property
+    def waiting(self) -> int:
+        with self._cond:
+            return len(self._waiting)
+
+    def _next_session(self) -> Optional[str]:
+        if len(self._waiting) == 0:
+            return None
+        return min(
+            self._waiting,
+            key=lambda session_id: (
+                self._last_granted.get(session_id, 0.0),
+                self._waiting[session_id],
+            ),
+        )
+
+    def acquire(
+        self, session_id: str, should_abort: Callable[[], bool] = lambda: False
+    ) -> int:
+        # 枠が空き、このセッションの順番になるまで待って枠の番号を返す
+        # 1 セッションにつき同時に待てるのは 1 件 (保存ごとに最新の 1 件だけを生成するため)
+        with self._cond:
+            assert (
+                session_id not in self._waiting
+            ), f"session {session_id} is already waiting."
+            self._waiting[session_id] = next(self._arrivals)
+            try:
+                while not (
+                    len(self._in_flight) < self.max_in_flight
+                    and self._next_session() == session_id
+                ):
+                    if should_abort():
+                        raise Superseded(f"session {session_id} has a newer save.")
+                    self._cond.wait(ABORT_CHECK_INTERVAL)
+                slot = next(self._slots)
+                self._in_flight[slot] = session_id
+                self._last_granted[session_id] = time.monotonic()
+                return slot
+            finally:
+                del self._waiting[session_id]
+                self._cond.notify_all()
+
+    def release(self, slot: int):
+        with self._cond:
+            if self._in_flight.pop(slot, None) is not None:
+                self._cond.notify_all()
+
+    def forget(self, session_id: str):
+        # 終了したセッションの記録を消す
+        with self._cond:
+            self._last_granted.pop(session_id, None)
+
+
+class SessionClient:
+    # 1 つのセッションから ComfyUI へのリクエストを FairScheduler を通して行う Client の代わり
+    # enqueue は順番が来るまで待ち、プロンプトの完了・取り消しで枠を返す。それ以外は Client に任せる
+    def __init__(
+        self,
+        client: Client | BackendPool,
+        scheduler: FairScheduler,
+        session_id: str,
+        should_abort: Callable[[], bool] = lambda: False,
+    ):
+        self._client = client
+        self._scheduler = scheduler
+        self.session_id = session_id
+        self.should_abort = should_abort
+        self._lock = threading.Lock()
+        self._slots: dict[str, int] = {}
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+    def enqueue(self, workflow: dict | WorkflowInstance) -> str:
+        slot = self._scheduler.acquire(self.session_id, self.should_abort)
+        try:
+            prompt_id = self._client.enqueue(workflow)
+        except BaseException:
+            self._scheduler.release(slot)
+            raise
+        with self._lock:
+            self._slots[prompt_id] = slot
+        return prompt_id
+
+    def submit_polling(
+        self,
+        prompt_id,
+        on_event: Optional[Callable[[ClientMessage], None]] = None,
+    ) -> Future:
+        future = self._client.submit_polling(prompt_id, on_event)
+        future.add_done_callback(lambda _: self._release(prompt_id))
+        return future
+
+    def cancel(self, prompt_id: str):
+        try:
+            self._client.cancel(prompt_id)
+        finally:
+            self._release(prompt_id)
+
+    def _release(self, prompt_id: str):
+        with self._lock:
+            slot = self._slots.pop(prompt_id, None)
+        if slot is not None:
+            self._scheduler.release(slot)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# inotify(7) の定数
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+class FileSignature(NamedTuple):
+    size: int
+    mtime_ns: int
+
+
+def get_file_signature(path: str | Path) -> Optional[FileSignature]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return FileSignature(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+class InotifyWatch:
+    # 保存時に一時ファイルからの rename を行うアプリがあるため、ファイルではなくディレクトリを監視する
+    def __init__(self, dir_path: str | Path):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(str(dir_path)), WATCH_MASK
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed: {dir_path}")
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def wait(self, timeout: Optional[float]) -> list[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        return self.read_names()
+
+    def read_names(self) -> list[str]:
+        names = []
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(buf):
+            _, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buf[offset : offset + name_len].rstrip(b"\0")
+            offset += name_len
+            names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
+
+
+# PSD の保存完了を検知し、保存 1 回につき 1 度だけ "file ready" を通知するモジュール
+# 変更検知後はサイズと mtime が settle_time 秒変化しなくなるまで待ち、書き込み途中のファイルを読まないようにする
+class FileWatcher:
+    def __init__(
+        self,
+        path: str | Path,
+        settle_time: float = 0.3,
+        poll_interval: float = 0.25,
+        use_inotify: bool = True,
+    ):
+        assert os.path.exists(path), f"{path} does not exist."
+        self.path = Path(path)
+        self._settle_time = settle_time
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify and sys.platform.startswith("linux")
+
+        self._callbacks: list[Callable[[FileSignature], None]] = []
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._inotify: Optional[InotifyWatch] = None
+        self._last_signature = get_file_signature(self.path)
+
+    @property
+    def backend(self) -> str:
+        return "inotify" if self._inotify is not None else "polling"
+
+    def add_callback(self, callback: Callable[[FileSignature], None]):
+        self._callbacks.append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self._use_inotify:
+            try:
+                self._inotify = InotifyWatch(self.path.resolve().parent)
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify is unavailable, fallback to polling: {e}")
+                self._inotify = None
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="file-watcher", daemon=True
+        )
+        self._thread.start()
+        logger.debug(f"watching {self.path} ({self.backend})")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def consume_ready(self) -> bool:
+        # 複数回の保存が溜まっていても 1 回分として扱う
+        if self._ready.is_set():
+            self._ready.clear()
+            return True
+        return False
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        if self._ready.wait(timeout):
+            self._ready.clear()
+            return True
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._wait_change():
+                continue
+            signature = self._wait_settled()
+            if signature is None or signature == self._last_signature:
+                continue
+            self._last_signature = signature
+            self._emit(signature)
+
+    def _wait_change(self) -> bool:
+        if self._inotify is not None:
+            names = self._inotify.wait(self._poll_interval)
+            return self.path.name in names
+        self._stop.wait(self._poll_interval)
+        return get_file_signature(self.path) != self._last_signature
+
+    def _wait_settled(self) -> Optional[FileSignature]:
+        signature = get_file_signature(self.path)
+        stable_since = time.monotonic()
+        while not self._stop.is_set():
+            remaining = self._settle_time - (time.monotonic() - stable_since)
+            if remaining <= 0 and signature is not None:
+                return signature
+            # 待機中に届いたイベントは stat で再確認するため中身は使わない
+            wait_time = min(max(remaining, 0.01), self._poll_interval)
+            if self._inotify is not None:
+                self._inotify.wait(wait_time)
+            else:
+                self._stop.wait(wait_time)
+            current = get_file_signature(self.path)
+            if current != signature:
+                signature = current
+                stable_since = time.monotonic()
+        return None
+
+    def _emit(self, signature: FileSignature):
+        logger.debug(f"file ready: {self.path} {signature}")
+        self._ready.set()
+        for callback in self._callbacks:
+            try:
+                callback(signature)
+            except Exception as e:
+                logger.exception(f"Unhandled exception in file watcher callback, {e}")
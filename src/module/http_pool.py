@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+import threading
+import time
+from enum import Enum
+from typing import Callable, NamedTuple, Optional
+
+import aiohttp
+
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# 接続の確立と、応答全体を受け取るまでの既定のタイムアウト (秒)
+CONNECT_TIMEOUT = 3.0
+DEFAULT_TIMEOUT = 10.0
+# keep-alive で保持する接続の数と、使われていない接続を閉じるまでの時間 (秒)
+POOL_LIMIT = 8
+KEEPALIVE_TIMEOUT = 30.0
+# バックエンドの死活確認の間隔 (秒)。停止中は短い間隔から徐々に延ばす
+HEALTH_INTERVAL = 2.0
+HEALTH_INTERVAL_DOWN_MIN = 0.5
+HEALTH_INTERVAL_DOWN_MAX = 5.0
+HEALTH_TIMEOUT = 2.0
+
+
+class BackendUnavailable(Exception):
+    # バックエンドが停止している (サーキットブレーカーが開いている) ためリクエストできない
+    pass
+
+
+class HttpError(Exception):
+    # 4xx の応答。リクエストの内容の誤りのため再試行しない
+    def __init__(self, status: int, body: str):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+class _ServerError(Exception):
+    # 5xx の応答。再起動中などの一時的な失敗として再試行する
+    pass
+
+
+class RetryPolicy(NamedTuple):
+    attempts: int = 3
+    backoff_min: float = 0.25
+    backoff_max: float = 4.0
+
+    def delay(self, attempt: int) -> float:
+        # 複数のリクエストが同時に再試行しないよう、指数バックオフに揺らぎを加える
+        backoff = min(self.backoff_min * 2**attempt, self.backoff_max)
+        return backoff * random.uniform(0.8, 1.2)
+
+
+class CircuitState(Enum):
+    closed = 0
+    open = 1
+    half_open = 2
+
+
+class CircuitBreaker:
+    # 連続して失敗したらリクエストを止め (open)、reset_timeout 後に 1 件だけ試す (half_open)
+    # 状態はイベントループのスレッドで更新し、他のスレッドからは allow() で参照する
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CircuitState.closed
+        self._failures = 0
+        self._opened_at = 0.0
+        self._callbacks: list[Callable[[bool], None]] = []
+
+    def add_callback(self, callback: Callable[[bool], None]):
+        # 閉じたとき (復旧) に True、開いたとき (停止) に False で呼ばれる
+        self._callbacks.append(callback)
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            if (
+                self._state is CircuitState.open
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                return CircuitState.half_open
+            return self._state
+
+    def allow(self) -> bool:
+        return self.state is not CircuitState.open
+
+    def record_success(self):
+        with self._lock:
+            recovered = self._state is not CircuitState.closed
+            self._state = CircuitState.closed
+            self._failures = 0
+        if recovered:
+            logger.info("backend recovered, circuit closed")
+            self._notify(True)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            half_open = (
+                self._state is CircuitState.open
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            )
+            if self._failures < self.failure_threshold and not half_open:
+                return
+            opened = self._state is not CircuitState.open
+            self._state = CircuitState.open
+            self._opened_at = time.monotonic()
+        if opened:
+            logger.warning("backend unavailable, circuit opened")
+            self._notify(False)
+
+    def trip(self):
+        # 死活確認で停止を検知した場合は、失敗回数によらず開く
+        with self._lock:
+            self._failures = self.failure_threshold - 1
+        self.record_failure()
+
+    def _notify(self, available: bool):
+        for callback in self._callbacks:
+            try:
+                callback(available)
+            except Exception as e:
+                logger.exception(f"Unhandled exception in circuit callback, {e}")
+
+
+# keep-alive の接続を使い回す aiohttp のセッションで、タイムアウト・再試行・サーキットブレーカー付きのリクエストを行うモジュール
+# セッションはイベントループのスレッドで作成し、すべてのリクエストを同じループで処理する
+class HttpPool:
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = DEFAULT_TIMEOUT,
+        retry: RetryPolicy = RetryPolicy(),
+        breaker: Optional[CircuitBreaker] = None,
+        limit: int = POOL_LIMIT,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retry = retry
+        self.breaker = breaker or CircuitBreaker()
+        self._limit = limit
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._limit, keepalive_timeout=KEEPALIVE_TIMEOUT
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout, connect=CONNECT_TIMEOUT
+                ),
+            )
+        return self._session
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[bytes | str] = None,
+        headers: Optional[dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        idempotent: bool = True,
+    ) -> bytes:
+        # idempotent でないリクエスト (/prompt など) は、送信前の接続エラーの場合だけ再試行する
+        if not self.breaker.allow():
+            raise BackendUnavailable(f"{self.base_url} is unavailable.")
+        session = await self._get_session()
+        client_timeout = None
+        if timeout is not None:
+            client_timeout = aiohttp.ClientTimeout(
+                total=timeout, connect=CONNECT_TIMEOUT
+            )
+        last_error: Optional[Exception] = None
+        for attempt in range(self.retry.attempts):
+            if attempt > 0:
+                await asyncio.sleep(self.retry.delay(attempt - 1))
+            try:
+                async with session.request(
+                    method,
+                    f"{self.base_url}{path}",
+                    data=data,
+                    headers=headers,
+                    timeout=client_timeout,
+                ) as response:
+                    body = await response.read()
+                    if response.status >= 500:
+                        raise _ServerError(f"HTTP {response.status} from {path}")
+                    # 4xx はバックエンドが応答しているため、成功として数える
+                    self.breaker.record_success()
+                    if response.status >= 400:
+                        raise HttpError(response.status, body.decode(errors="replace"))
+                    return body
+            except aiohttp.ClientConnectorError as e:
+                last_error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError, _ServerError) as e:
+                last_error = e
+                if not idempotent:
+                    break
+            logger.debug(f"{method} {path} failed ({attempt + 1}): {last_error!r}")
+
+        self.breaker.record_failure()
+        if not self.breaker.allow():
+            raise BackendUnavailable(f"{self.base_url} is unavailable.") from last_error
+        assert last_error is not None
+        raise last_error
+
+    async def request_json(self, method: str, path: str, **kwargs) -> dict:
+        return json.loads(await self.request(method, path, **kwargs))
+
+    async def probe(self, path: str, timeout: float = HEALTH_TIMEOUT) -> bool:
+        # 死活確認。サーキットブレーカーを通さず、再試行もしない
+        session = await self._get_session()
+        try:
+            async with session.get(
+                f"{self.base_url}{path}",
+                timeout=aiohttp.ClientTimeout(total=timeout, connect=timeout),
+            ) as response:
+                await response.read()
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class HealthMonitor:
+    # バックエンドの死活をバックグラウンドで確認し、サーキットブレーカーの状態に反映する
+    # 停止中は短い間隔で確認し、復旧したらすぐにブレーカーを閉じる
+    def __init__(
+        self, pool: HttpPool, path: str = "/system_stats", interval=HEALTH_INTERVAL
+    ):
+        self._pool = pool
+        self._path = path
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # イベントループのスレッドで呼ぶ
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        backoff = HEALTH_INTERVAL_DOWN_MIN
+        while True:
+            if await self._pool.probe(self._path):
+                self._pool.breaker.record_success()
+                backoff = HEALTH_INTERVAL_DOWN_MIN
+                await asyncio.sleep(self._interval)
+            else:
+                if self._pool.breaker.state is CircuitState.closed:
+                    logger.warning(f"waiting for connection with {self._pool.base_url}")
+                self._pool.breaker.trip()
+                await asyncio.sleep(backoff * random.uniform(0.8, 1.2))
+                backoff = min(backoff * 2, HEALTH_INTERVAL_DOWN_MAX)
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+from PIL import Image
+
+from module.options import TRANSPORT_MODES, TransportMode
+
+if TYPE_CHECKING:
+    from module.client import Client
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# PNG の圧縮レベル。デフォルト (6) に比べて 1 は数倍速く、サイズの増加は小さい
+FAST_COMPRESS_LEVEL = 1
+MAX_TRACKED_IMAGES = 256
+FILENAME_PREFIX = "psd_watch_"
+
+
+class TransportStats(NamedTuple):
+    mode: str
+    # /prompt 以外で ComfyUI に送ったバイト数も含めた、入力画像 1 枚分の送信量
+    bytes_sent: int
+    encode_seconds: float
+    # 同じ画像を送信済みで、エンコード・送信を省略したか
+    cached: bool = False
+
+    def __str__(self) -> str:
+        return (
+            f"{self.mode}: {self.bytes_sent / 1024:.1f} KiB sent, "
+            f"encode {self.encode_seconds * 1000:.1f} ms"
+            + (" (cached)" if self.cached else "")
+        )
+
+
+class EncodedImage(NamedTuple):
+    # 別プロセスなどで事前にエンコードした入力画像
+    png: bytes
+    digest: str
+
+
+def image_digest(image: Image.Image) -> str:
+    # PNG にエンコードする前の画素で判定し、送信済みの画像はエンコードも省略する
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}:{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def encode_png(image: Image.Image, compress_level: int = 6) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG", compress_level=compress_level)
+    return buffered.getvalue()
+
+
+def encode_image(image: Image.Image, mode: TransportMode) -> EncodedImage:
+    compress_level = 6 if mode == "base64" else FAST_COMPRESS_LEVEL
+    return EncodedImage(encode_png(image, compress_level), image_digest(image))
+
+
+# 入力画像を ComfyUI へ渡す方法を切り替えるモジュール
+# - base64: PNG を base64 にして /prompt の JSON に埋め込み、ETN_LoadImageBase64 で読む (従来の動作)
+# - base64_fast: base64 と同じだが、PNG を高速な圧縮レベルでエンコードする
+# - upload: 内容のハッシュをファイル名にして /upload/image に一度だけ送り、LoadImage で参照する
+# - local: ComfyUI と同じマシンで動かす場合に、ComfyUI の input ディレクトリへ直接書き込む
+class ImageTransport:
+    def __init__(
+        self,
+        mode: TransportMode = "base64",
+        client: Optional[Client] = None,
+        comfyui_input_dir: Optional[Path] = None,
+    ):
+        assert mode in TRANSPORT_MODES, f"transport mode {mode} is not supported."
+        assert (
+            mode != "upload" or client is not None
+        ), "upload mode requires ComfyUI client."
+        assert (
+            mode != "local" or comfyui_input_dir is not None
+        ), "local mode requires ComfyUI input directory."
+        self.mode = mode
+        self._client = client
+        self._comfyui_input_dir = comfyui_input_dir
+        # 送信済みの画像のハッシュと LoadImage で参照する名前
+        # 複数のセッションで共有する場合に備え、参照・更新はロックの中で行う
+        self._sent: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def input_node(
+        self, image: Image.Image | EncodedImage
+    ) -> tuple[str, TransportStats]:
+        # 入力画像ノードの JSON 文字列と送信の統計を返す。ノードの出力 (IMAGE, MASK) は LoadImage と共通
+        # 複数のセッションで共有するため、統計は属性に残さずに呼び出し元へ返す
+        if self.mode in ("base64", "base64_fast"):
+            start = time.perf_counter()
+            if isinstance(image, Image.Image):
+                image = encode_image(image, self.mode)
+            data = base64.b64encode(image.png).decode()
+            stats = TransportStats(self.mode, len(data), time.perf_counter() - start)
+            # base64 の文字はエスケープが不要なため、json.dumps を通さずに埋め込む
+            node = (
+                '{"inputs": {"image": "'
+                + data
+                + '"}, "class_type": "ETN_LoadImageBase64"}'
+            )
+        else:
+            name, stats = self._send(image)
+            node = json.dumps(
+                {
+                    "inputs": {"image": name, "upload": "image"},
+                    "class_type": "LoadImage",
+                }
+            )
+
+        return node, stats
+
+    def _send(self, image: Image.Image | EncodedImage) -> tuple[str, TransportStats]:
+        start = time.perf_counter()
+        if isinstance(image, Image.Image):
+            digest = image_digest(image)
+        else:
+            digest = image.digest
+        with self._lock:
+            name = self._sent.get(digest)
+            if name is not None:
+                self._sent.move_to_end(digest)
+        if name is not None:
+            return name, TransportStats(
+                self.mode, 0, time.perf_counter() - start, cached=True
+            )
+
+        if isinstance(image, Image.Image):
+            data = encode_png(image, FAST_COMPRESS_LEVEL)
+        else:
+            data = image.png
+        encode_seconds = time.perf_counter() - start
+        filename = f"{FILENAME_PREFIX}{digest}.png"
+        if self.mode == "upload":
+            assert self._client is not None
+            name = self._client.upload_image(filename, data)
+            bytes_sent = len(data)
+        else:
+            assert self._comfyui_input_dir is not None
+            path = self._comfyui_input_dir / filename
+            if not path.exists():
+                # ComfyUI が書き込み途中のファイルを読まないよう、別名で書いてから置き換える
+                tmp_path = path.with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                tmp_path.replace(path)
+            name = filename
+            bytes_sent = 0
+
+        with self._lock:
+            self._sent[digest] = name
+            while len(self._sent) > MAX_TRACKED_IMAGES:
+                self._sent.popitem(last=False)
+        return name, TransportStats(self.mode, bytes_sent, encode_seconds)
@@ -1,15 +1,21 @@
-import json
 from pathlib import Path
-import numpy as np
-from PIL import Image
 import os
-import gradio as gr
+import tempfile
+import threading
+from typing import Optional
+from PIL import Image
 
 from schemas.generate_settings import GenerateSettings
-from module.client import Client
-from module.workflow_manager import WorkflowManager
-from pydantic import BaseModel
-from utils.util import parse_psd, resize_target_resolution
+from module.fair_scheduler import SessionClient
+from module.file_watcher import FileWatcher
+from module.image_transport import TransportMode
+from module.inference_service import InferenceService
+from module.inference_worker import InferenceWorker, WorkerResult
+from module.psd_compositor import InputMode, PsdCompositor
+from module.region_inference import DEFAULT_FULL_THRESHOLD, RegionInference
+from module.result_cache import DEFAULT_CACHE_DIR, DEFAULT_DISK_MAX_BYTES
+from module.options import DEFAULT_METRICS_HOST
+from module.tracing import Tracer
 from logging import getLogger, StreamHandler, DEBUG
 
 logger = getLogger(__name__)
@@ -19,17 +25,6 @@ handler.setLevel(DEBUG)
 logger.addHandler(handler)
 
 
-class FileStatus(BaseModel):
-    path: str | Path
-    last_modified_time: float
-
-    def check_changed(self):
-        return os.path.getmtime(self.path) != self.last_modified_time
-
-    def update_status(self):
-        self.last_modified_time = os.path.getmtime(self.path)
-
-
 class InferenceManager:
     def __init__(
         self,
@@ -39,36 +34,168 @@ class InferenceManager:
         view_img_width: int,
         server_ip: str = "http://127.0.0.1",
         port_port: str = "8188",
+        psd_input_mode: InputMode = "auto",
+        image_transport_mode: TransportMode = "base64",
+        comfyui_input_dir: Optional[Path] = None,
+        result_cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+        result_cache_max_bytes: int = DEFAULT_DISK_MAX_BYTES,
+        trace_path: Optional[Path] = None,
+        metrics_port: Optional[int] = None,
+        metrics_host: str = DEFAULT_METRICS_HOST,
+        region_inference: bool = False,
+        region_full_threshold: float = DEFAULT_FULL_THRESHOLD,
+        progressive: bool = False,
+        warmup: bool = False,
+        variations: int = 1,
+        service: Optional[InferenceService] = None,
+        session_id: str = "default",
+        backend_urls: Optional[list[str]] = None,
     ):
-        assert (
-            workflow_dir / "workflow_api.json"
-        ).exists(), f"{workflow_dir}/workflow_api.json が見つかりません。"
-        assert (
-            workflow_dir / "settings.json"
-        ).exists(), f"{workflow_dir}/settings.json が見つかりません。"
-
         # gradio の仕様上、生成設定と結果画像の状態を保持したほうが扱いやすいため本クラスを作成
-        with open(workflow_dir / "settings.json", "r") as f:
-            config = json.load(f)
-        self._generate_settings = GenerateSettings(**config)
-        self._result_img = np.zeros([0, 0, 0])
-
         assert os.path.exists(file_path), f"{file_path} does not exist."
-        # PSD ファイルの状態を管理するモジュール
-        self._file_status = FileStatus(
-            path=file_path,
-            last_modified_time=os.path.getmtime(file_path),
-        )
-
-        self._processing = False
+        # ComfyUI の接続・workflow・キャッシュ・計測は、複数のセッションで共有できるよう InferenceService が持つ
+        # service を指定しない場合は、このセッション専用のものを作成する
+        self._owns_service = service is None
+        if service is None:
+            service = InferenceService(
+                workflow_dir,
+                server_ip=server_ip,
+                port_port=port_port,
+                backend_urls=backend_urls,
+                image_transport_mode=image_transport_mode,
+                comfyui_input_dir=comfyui_input_dir,
+                result_cache_dir=result_cache_dir,
+                result_cache_max_bytes=result_cache_max_bytes,
+                trace_path=trace_path,
+                metrics_port=metrics_port,
+                metrics_host=metrics_host,
+                warmup=warmup,
+            )
+        self._service = service
+        self.session_id = session_id
         self._view_img_height = view_img_height
         self._view_img_width = view_img_width
+        # UI に送る画像は表示サイズに縮小・圧縮したファイルとして結果ごとに 1 回だけ作成する
+        self._view_dir = tempfile.TemporaryDirectory(prefix="psd_watch_view_")
+        self._view_lock = threading.Lock()
+        self._view_version = -1
+        self._view_paths: list[Path] = []
+
+        # PSD ファイルの保存完了を監視するモジュール
+        self._file_watcher = FileWatcher(file_path)
+
+        self._client = service.client
+        self._workflow_registry = service.workflow_registry
+        self._workflow_name = workflow_dir.name
+        if self._workflow_name not in self._workflow_registry:
+            self._workflow_registry.add(workflow_dir, service.image_transport)
+        self._warmup = service.warmup
+        # UI から変更する生成設定は、他のセッションに影響しないよう workflow ごとに複製して持つ
+        self._settings = {
+            name: self._workflow_registry.get(name).generate_settings.model_copy(
+                deep=True
+            )
+            for name in self._workflow_registry.names
+        }
+        workflow = self._workflow_registry.get(self._workflow_name)
+        self._generate_settings = self._settings[self._workflow_name]
+
+        self._result_cache = service.result_cache
+        self._tracer = service.tracer
+
+        # 保存検知から生成結果の受信までをバックグラウンドで行うモジュール
+        # 変更のあったレイヤーのみの再合成、ComfyUI Workflow API の動的な変更、
+        # ComfyUI の API の監視を束ねる
+        client = service.session_client(session_id)
+        self._inference_worker = InferenceWorker(
+            file_watcher=self._file_watcher,
+            psd_compositor=PsdCompositor(
+                input_mode=psd_input_mode,
+                cache=service.layer_cache,
+                cache_namespace=session_id,
+            ),
+            workflow_manager=workflow.workflow_manager,
+            client=client,
+            generate_settings=self._generate_settings,
+            result_cache=self._result_cache,
+            tracer=self._tracer,
+            # 大きなキャンバスの一部だけを変更した場合に、変更範囲のみを生成する
+            region_inference=(
+                RegionInference(full_threshold=region_full_threshold)
+                if region_inference
+                else None
+            ),
+            # 下書きを先に生成し、続けて本生成する
+            progressive=progressive,
+            # シードを変えて複数案を生成し、格子状に並べて表示する
+            variations=variations,
+        )
+        if isinstance(client, SessionClient):
+            # 他のセッションの順番を待つ間に新しい保存が届いたら、古い保存は積まずに取りやめる
+            client.should_abort = lambda: (
+                self._file_watcher.is_ready() or self._inference_worker.stopping
+            )
+        self._file_watcher.start()
+        self._inference_worker.start()
+
+    @property
+    def file_watcher(self) -> FileWatcher:
+        return self._file_watcher
+
+    def stop(self):
+        self._inference_worker.stop()
+        self._file_watcher.stop()
+        if self._owns_service:
+            self._service.stop()
+        self._view_dir.cleanup()
+
+    @property
+    def workflow_names(self) -> list[str]:
+        return self._workflow_registry.names
 
-        # ComfyUI Workflow API を動的に変更するモジュール
-        self._workflow_manager = WorkflowManager(workflow_dir)
+    @property
+    def workflow_name(self) -> str:
+        return self._workflow_name
+
+    def workflow_settings(self, name: str) -> GenerateSettings:
+        return self._settings[name]
+
+    def switch_workflow(self, name: str):
+        # 再起動せずに workflow を切り替える。次の保存から新しい workflow で生成する
+        if name == self._workflow_name:
+            return
+        workflow = self._workflow_registry.get(name)
+        self._workflow_name = name
+        self._generate_settings = self._settings[name]
+        self._inference_worker.set_workflow(
+            workflow.workflow_manager, self._generate_settings
+        )
+        logger.debug(f"switch workflow to {name}")
+        if self._warmup:
+            self._workflow_registry.warm_up(name)
+
+    def request_full_regeneration(self):
+        self._inference_worker.request_full_regeneration()
+
+    @property
+    def progressive(self) -> bool:
+        return self._inference_worker.progressive
 
-        # ComfyUI の API を監視するクライアント
-        self._client = Client(ip=server_ip, port=port_port)
+    @progressive.setter
+    def progressive(self, progressive: bool):
+        self._inference_worker.progressive = progressive
+
+    @property
+    def variations(self) -> int:
+        return self._inference_worker.variations
+
+    @variations.setter
+    def variations(self, variations: int):
+        self._inference_worker.variations = variations
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer
 
     @property
     def generate_settings(self):
@@ -77,65 +204,63 @@ class InferenceManager:
     @generate_settings.setter
     def generate_settings(self, generate_settings: GenerateSettings):
         self._generate_settings = generate_settings
+        self._settings[self._workflow_name] = generate_settings
+        self._inference_worker.set_workflow(
+            self._workflow_registry.get(self._workflow_name).workflow_manager,
+            generate_settings,
+        )
 
-    def run(self):
-        status = "waiting"
-
-        # processing になったことを一旦 UI に伝える
-        if self._file_status.check_changed() and self._processing is False:
-            logger.debug("catch file change event.")
-            self._processing = True
-            status = "processing"
-        # processing になったことを UI に伝えたあとに処理を開始
-        elif self._file_status.check_changed() and self._processing is True:
-            input_img = parse_psd(self._file_status.path)
-            orig_hw_ratio = input_img.size[1] / input_img.size[0]
-            input_img = resize_target_resolution(
-                input_img, self._generate_settings.target_resolution
-            )
-
-            # workflow api にパラメータを設定
-            workflow = self._workflow_manager.create(
-                input_img=input_img,
-                generate_settings=self._generate_settings,
-            )
-
-            # ComfyUI に処理をリクエストし完了するまで待機
-            prompt_id = self._client.enqueue(workflow)
-            generated_img = self._client.polling(prompt_id)
-
-            if isinstance(generated_img, Image.Image):
-                status = "finished"
-                _result_img = generated_img.resize(
-                    (input_img.size[0], int(orig_hw_ratio * input_img.size[0])),
-                    Image.BICUBIC,
-                )
-                self._result_img = np.array(_result_img)
-                self._file_status.update_status()
-                self._processing = False
-
-                return (
-                    gr.update(
-                        value=self._result_img,
-                        height=self._view_img_height,
-                        width=self._view_img_width,
-                    ),
-                    gr.update(value=f"status: {status}"),
-                )
-
-            # 同設定の場合 ComfyUI の処理がスキップされるため、そのまま終了する
-            self._file_status.update_status()
-            self._processing = False
-            status = "skip"
+    def run(self, shown_version: int = -1):
+        # shown_version はタブごとに表示済みの結果の番号。変化がなければ画像は送らない
+        # gradio の読み込みには数秒かかるため、PSD の監視を始めたあと UI から呼ばれたときに読み込む
+        import gradio as gr
 
-        if self._result_img.size == 0:
-            return None, gr.update(value=f"status: {status}")
+        result = self._inference_worker.latest()
+        status = f"status: {result.status} ({self._result_cache.stats})"
+        latency = self._tracer.status_line()
+        if latency:
+            status += f"  \nlatency: {latency}"
+        if not self._client.available:
+            status += f"  \nComfyUI ({self._client.url}) is unavailable"
+        progress = gr.update(value=progress_html(result.progress))
+        if result.image is None or result.version == shown_version:
+            return gr.update(), gr.update(value=status), progress, shown_version
 
         return (
             gr.update(
-                value=self._result_img,
+                value=str(self._view_image_path(result)),
                 height=self._view_img_height,
                 width=self._view_img_width,
             ),
-            gr.update(value=f"status: {status}"),
+            gr.update(value=status),
+            progress,
+            result.version,
         )
+
+    def _view_image_path(self, result: WorkerResult) -> Path:
+        with self._view_lock:
+            if result.version > self._view_version:
+                image = Image.fromarray(result.image)
+                image.thumbnail(
+                    (self._view_img_width, self._view_img_height), Image.BICUBIC
+                )
+                # プレビューは頻繁に差し替わるため JPEG、最終結果は PNG にする
+                if result.preview:
+                    path = Path(self._view_dir.name) / f"view_{result.version}.jpg"
+                    image.convert("RGB").save(path, format="JPEG", quality=85)
+                else:
+                    path = Path(self._view_dir.name) / f"view_{result.version}.png"
+                    image.save(path, format="PNG", compress_level=1)
+                # 他のタブが読み込み中の可能性があるため、1 つ前のファイルまでは残す
+                self._view_paths.append(path)
+                while len(self._view_paths) > 2:
+                    self._view_paths.pop(0).unlink(missing_ok=True)
+                self._view_version = result.version
+            return self._view_paths[-1]
+
+
+def progress_html(progress: Optional[float]) -> str:
+    # 生成中のみサンプリングの進捗バーを表示する
+    if progress is None:
+        return ""
+    return f'<progress value="{progress:.3f}" max="1" style="width: 100%"></progress>'
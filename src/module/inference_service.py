@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from module.backend_pool import BackendPool, connect
+from module.client import Client
+from module.fair_scheduler import FairScheduler, SessionClient
+from module.image_transport import ImageTransport, TransportMode
+from module.psd_compositor import DEFAULT_CACHE_MAX_BYTES, LayerCache
+from module.result_cache import DEFAULT_CACHE_DIR, DEFAULT_DISK_MAX_BYTES, ResultCache
+from module.options import DEFAULT_METRICS_HOST
+from module.tracing import MetricsServer, Tracer
+from module.workflow_registry import WorkflowRegistry
+
+if TYPE_CHECKING:
+    from module.inference_manager import InferenceManager
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# UI からの問い合わせがこの時間 (秒) 途絶えたセッションは終了する
+DEFAULT_SESSION_TIMEOUT = 30 * 60
+JANITOR_INTERVAL = 30.0
+
+
+# 複数のセッション (InferenceManager) で共有する ComfyUI の接続・workflow・キャッシュ・計測をまとめるモジュール
+# 1 つのプロセスで複数の作業者の PSD を監視する場合は、セッションごとに監視・設定・結果を持ち、それ以外を共有する
+# max_in_flight を指定すると、ComfyUI のキューに積む順番を FairScheduler でセッション間で公平にする
+class InferenceService:
+    def __init__(
+        self,
+        workflow_dir: Path,
+        server_ip: str = "http://127.0.0.1",
+        port_port: str = "8188",
+        image_transport_mode: TransportMode = "base64",
+        comfyui_input_dir: Optional[Path] = None,
+        result_cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+        result_cache_max_bytes: int = DEFAULT_DISK_MAX_BYTES,
+        trace_path: Optional[Path] = None,
+        metrics_port: Optional[int] = None,
+        metrics_host: str = DEFAULT_METRICS_HOST,
+        warmup: bool = False,
+        max_in_flight: Optional[int] = None,
+        layer_cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        backend_urls: Optional[list[str]] = None,
+    ):
+        assert (
+            workflow_dir / "workflow_api.json"
+        ).exists(), f"{workflow_dir}/workflow_api.json が見つかりません。"
+        assert (
+            workflow_dir / "settings.json"
+        ).exists(), f"{workflow_dir}/settings.json が見つかりません。"
+        self.workflow_dir = workflow_dir
+
+        # ComfyUI の API を監視するクライアント。停止中は保存を見送り、復旧したら最新の保存を生成する
+        # backend_urls に複数の ComfyUI を指定した場合は、プロンプトごとに空いている ComfyUI に振り分ける
+        self.client = connect(backend_urls or [f"{server_ip}:{port_port}"])
+        # 入力画像を ComfyUI へ渡す方法を切り替えるモジュール
+        self.image_transport = ImageTransport(
+            image_transport_mode,
+            client=self.client,
+            comfyui_input_dir=comfyui_input_dir,
+        )
+
+        # workflow_dir と同じ階層の workflow をすべて読み込み、UI から切り替えられるようにする
+        self.workflow_registry = WorkflowRegistry(
+            workflow_dir.parent, self.image_transport, self.client
+        )
+        if workflow_dir.name not in self.workflow_registry:
+            self.workflow_registry.add(workflow_dir, self.image_transport)
+        self.warmup = warmup
+        # 最初の保存でモデルの読み込みを待たないよう、起動時に読み込ませておく
+        if warmup:
+            self.workflow_registry.warm_up(workflow_dir.name)
+
+        # 生成結果をメモリとディスクに保持するキャッシュ
+        self.result_cache = ResultCache(
+            result_cache_dir, disk_max_bytes=result_cache_max_bytes
+        )
+        # デコード済みのレイヤー画像のキャッシュ。セッション間でメモリの上限を共有する
+        self.layer_cache = LayerCache(layer_cache_max_bytes)
+
+        # 生成ごとの各段階の所要時間を記録し、必要であれば /metrics で公開する
+        self.tracer = Tracer(trace_path)
+        self._metrics_server: Optional[MetricsServer] = None
+        if metrics_port is not None:
+            self._metrics_server = MetricsServer(
+                self.tracer, metrics_port, metrics_host
+            )
+            self._metrics_server.start()
+
+        self.scheduler: Optional[FairScheduler] = None
+        if max_in_flight is not None:
+            # max_in_flight は ComfyUI 1 つあたりの件数
+            num_backends = 1
+            if isinstance(self.client, BackendPool):
+                num_backends = len(self.client.backends)
+            self.scheduler = FairScheduler(max_in_flight * num_backends)
+
+        self._lock = threading.Lock()
+        self._sessions: dict[str, InferenceManager] = {}
+        self._last_seen: dict[str, float] = {}
+        self._stop = threading.Event()
+        self._janitor: Optional[threading.Thread] = None
+
+    def session_client(self, session_id: str) -> Client | BackendPool | SessionClient:
+        if self.scheduler is None:
+            return self.client
+        return SessionClient(self.client, self.scheduler, session_id)
+
+    @property
+    def session_ids(self) -> list[str]:
+        with self._lock:
+            return list(self._sessions)
+
+    def open_session(
+        self,
+        session_id: str,
+        file_path: Path,
+        view_img_height: int,
+        view_img_width: int,
+        **options,
+    ) -> InferenceManager:
+        # 同じセッションで別の PSD を開き直した場合は、前の監視を終了する
+        from module.inference_manager import InferenceManager
+
+        self.close_session(session_id)
+        inference_manager = InferenceManager(
+            self.workflow_dir,
+            file_path,
+            view_img_height,
+            view_img_width,
+            service=self,
+            session_id=session_id,
+            **options,
+        )
+        with self._lock:
+            self._sessions[session_id] = inference_manager
+            self._last_seen[session_id] = time.monotonic()
+        logger.info(f"open session {session_id}: {file_path}")
+        return inference_manager
+
+    def session(self, session_id: str) -> Optional[InferenceManager]:
+        with self._lock:
+            inference_manager = self._sessions.get(session_id)
+            if inference_manager is not None:
+                self._last_seen[session_id] = time.monotonic()
+            return inference_manager
+
+    def close_session(self, session_id: str):
+        with self._lock:
+            inference_manager = self._sessions.pop(session_id, None)
+            self._last_seen.pop(session_id, None)
+        if inference_manager is None:
+            return
+        inference_manager.stop()
+        if self.scheduler is not None:
+            self.scheduler.forget(session_id)
+        logger.info(f"close session {session_id}")
+
+    def close_idle_sessions(self, timeout: float):
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                session_id
+                for session_id, last_seen in self._last_seen.items()
+                if now - last_seen > timeout
+            ]
+        for session_id in idle:
+            self.close_session(session_id)
+
+    def start_janitor(self, session_timeout: float = DEFAULT_SESSION_TIMEOUT):
+        # ブラウザを閉じたセッションは通知されないため、問い合わせの途絶えたものを定期的に終了する
+        if self._janitor is not None:
+            return
+
+        def run():
+            while not self._stop.wait(JANITOR_INTERVAL):
+                self.close_idle_sessions(session_timeout)
+
+        self._janitor = threading.Thread(
+            target=run, name="session-janitor", daemon=True
+        )
+        self._janitor.start()
+
+    def stop(self):
+        self._stop.set()
+        for session_id in self.session_ids:
+            self.close_session(session_id)
+        if self._janitor is not None:
+            self._janitor.join()
+            self._janitor = None
+        self.client.close()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
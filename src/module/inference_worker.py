@@ -0,0 +1,712 @@
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+from schemas.generate_settings import GenerateSettings
+from module.backend_pool import BackendPool
+from module.client import Client, ClientEvent, ClientMessage
+from module.fair_scheduler import SessionClient, Superseded
+from module.file_watcher import FileSignature, FileWatcher
+from module.http_pool import BackendUnavailable
+from module.psd_compositor import PsdCompositor
+from module.region_inference import RegionInference, RegionJob
+from module.result_cache import ResultCache, result_key
+from module.tracing import Trace, Tracer
+from module.workflow_manager import WorkflowInstance, WorkflowManager
+from utils.util import calc_target_size, make_grid, resize_target_resolution
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+
+class InferenceJob(NamedTuple):
+    prompt_id: str
+    future: Future
+    result_size: tuple[int, int]
+    source: str
+    trace: Trace
+    # enqueue が完了した時刻 (time.perf_counter())
+    enqueued_at: float
+    cache_key: Optional[str] = None
+    # 変更範囲のみを生成する場合の範囲と、貼り戻し先の情報
+    region: Optional[RegionJob] = None
+    # 2 段階生成の下書きかどうか
+    draft: bool = False
+    # シードを変えて複数案を生成する場合の何番目の案か
+    variation: Optional[int] = None
+
+
+class PassInput(NamedTuple):
+    # 下書き・本生成それぞれの入力画像と KSampler のステップ数
+    image: Image.Image
+    steps: Optional[int]
+    cache_key: Optional[str]
+    draft: bool
+
+
+class PreparedInput(NamedTuple):
+    # 1 回の保存に対する合成・変更範囲の計算結果。下書きと本生成で共有する
+    composite: Image.Image
+    result_size: tuple[int, int]
+    source: str
+    region: Optional[RegionJob]
+    generate_settings: GenerateSettings
+    # 保存を処理し始めた時点で選択されていた workflow
+    workflow_manager: WorkflowManager
+    # シードを変えて生成する案の数
+    variations: int = 1
+    # シードが -1 (ランダム) の場合は保存ごとに結果が変わるため、生成結果のキャッシュを読み書きしない
+    cacheable: bool = True
+
+
+class Variation(NamedTuple):
+    # 複数案のうち 1 つの生成設定。シードだけが異なる
+    index: int
+    generate_settings: GenerateSettings
+    cache_key: Optional[str]
+
+
+class WorkerResult(NamedTuple):
+    status: str
+    image: Optional[np.ndarray]
+    # 生成中のサンプリングの進捗 (0 - 1)。生成中でない場合は None
+    progress: Optional[float] = None
+    # image が更新されるたびに増える番号。UI は変化があったときだけ画像を送る
+    version: int = 0
+    # image が生成途中のプレビューかどうか
+    preview: bool = False
+
+
+# 保存検知 → PSD の合成 → ComfyUI へのリクエスト → 結果の受信をバックグラウンドで回すモジュール
+# 生成中に保存された場合は最新の保存だけを処理し、古いプロンプトは中断またはキューから削除する
+# UI は latest() で公開済みの状態と結果画像を読むだけにする
+class InferenceWorker:
+    def __init__(
+        self,
+        file_watcher: FileWatcher,
+        psd_compositor: PsdCompositor,
+        workflow_manager: WorkflowManager,
+        client: Client | BackendPool | SessionClient,
+        generate_settings: GenerateSettings,
+        result_cache: Optional[ResultCache] = None,
+        tracer: Optional[Tracer] = None,
+        region_inference: Optional[RegionInference] = None,
+        progressive: bool = False,
+        variations: int = 1,
+    ):
+        self.generate_settings = generate_settings
+        self._file_watcher = file_watcher
+        self._psd_compositor = psd_compositor
+        self._workflow_manager = workflow_manager
+        self._client = client
+        self._result_cache = result_cache
+        # 生成ごとの各段階の所要時間を集計するモジュール
+        self.tracer = tracer or Tracer()
+        self._ready_signature: Optional[FileSignature] = None
+        # 変更範囲のみを生成するモジュール。None の場合は常に全体を生成する
+        self._region_inference = region_inference
+        self._regenerate = threading.Event()
+        # ComfyUI の停止中に届いた保存があり、復旧したら最新の保存を生成する
+        self._recover_pending = False
+        # 低解像度・少ないステップ数の下書きを先に生成し、続けて本生成する
+        self.progressive = progressive
+        # 同じ入力画像からシードを変えて生成する案の数。2 以上の場合は結果を格子状に並べて表示する
+        self.variations = variations
+        self._variation_images: list[Optional[Image.Image]] = []
+
+        self._lock = threading.Lock()
+        self._status = "waiting"
+        self._result_img: Optional[np.ndarray] = None
+        self._progress: Optional[float] = None
+        self._version = 0
+        self._preview = False
+        # 進捗・プレビューを公開する対象のプロンプト。置き換えられたプロンプトのイベントは捨てる
+        self._active_prompt_ids: set[str] = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file_watcher.add_callback(self._on_file_ready)
+        self._client.add_recover_callback(self._on_backend_recovered)
+
+    def _on_file_ready(self, signature: FileSignature):
+        with self._lock:
+            self._ready_signature = signature
+        self._wake.set()
+
+    def _on_backend_recovered(self):
+        # 停止中の保存は PSD を読まずに見送っているため、復旧したら現在の (最新の) 保存を処理する
+        if not self._recover_pending:
+            return
+        self._recover_pending = False
+        logger.debug("ComfyUI recovered, process the latest save.")
+        self._regenerate.set()
+        self._wake.set()
+
+    def _defer_until_recovered(self):
+        self._recover_pending = True
+        self._publish("waiting for ComfyUI (the latest save is sent when it recovers)")
+        # 見送りを記録する前に復旧していた場合も取りこぼさない
+        if self._client.available:
+            self._on_backend_recovered()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="inference-worker", daemon=True
+        )
+        self._thread.start()
+
+    def set_workflow(
+        self, workflow_manager: WorkflowManager, generate_settings: GenerateSettings
+    ):
+        # 次の保存から使う workflow を切り替える。処理中の生成はそのまま完了させる
+        with self._lock:
+            self._workflow_manager = workflow_manager
+            self.generate_settings = generate_settings
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def request_full_regeneration(self):
+        # 保存を待たずに、現在の PSD の全体を生成し直す
+        if self._region_inference is not None:
+            self._region_inference.request_full()
+        self._regenerate.set()
+        self._wake.set()
+
+    def stop(self):
+        self._client.remove_recover_callback(self._on_backend_recovered)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self) -> WorkerResult:
+        with self._lock:
+            return WorkerResult(
+                status=self._status,
+                image=self._result_img,
+                progress=self._progress,
+                version=self._version,
+                preview=self._preview,
+            )
+
+    def _publish(
+        self,
+        status: Optional[str],
+        image: Optional[np.ndarray] = None,
+        progress: Optional[float] = None,
+        prompt_id: Optional[str] = None,
+        preview: bool = False,
+    ):
+        with self._lock:
+            if prompt_id is not None and prompt_id not in self._active_prompt_ids:
+                return
+            if status is not None:
+                self._status = status
+            if image is not None:
+                self._result_img = image
+                self._preview = preview
+                self._version += 1
+            self._progress = progress
+
+    def _activate_prompt(self, prompt_id: str, active: bool):
+        with self._lock:
+            if active:
+                self._active_prompt_ids.add(prompt_id)
+            else:
+                self._active_prompt_ids.discard(prompt_id)
+
+    def _on_client_event(
+        self,
+        prompt_id: str,
+        result_size: tuple[int, int],
+        region: Optional[RegionJob],
+        message: ClientMessage,
+        show_preview: bool = True,
+    ):
+        # イベントループのスレッドから呼ばれるため、重い処理はしない
+        if message.event is ClientEvent.queued:
+            self._publish(
+                f"queued ({message.queue_remaining} in queue)",
+                progress=0.0,
+                prompt_id=prompt_id,
+            )
+        elif message.event is ClientEvent.progress and message.total_steps > 0:
+            self._publish(
+                f"generating (step {message.step}/{message.total_steps})",
+                progress=message.step / message.total_steps,
+                prompt_id=prompt_id,
+            )
+        elif (
+            message.event is ClientEvent.preview
+            and message.preview is not None
+            and show_preview
+        ):
+            # プレビューは latent の解像度のため、結果画像と同じ大きさに拡大して差し替える
+            if region is not None and self._region_inference is not None:
+                preview_img = self._region_inference.preview(
+                    region, message.preview, result_size
+                )
+            else:
+                preview_img = np.array(
+                    message.preview.resize(result_size, Image.BILINEAR)
+                )
+            with self._lock:
+                progress = self._progress
+            self._publish(
+                None,
+                image=preview_img,
+                progress=progress,
+                prompt_id=prompt_id,
+                preview=True,
+            )
+
+    def _publish_image(
+        self,
+        image: Image.Image,
+        result_size: tuple[int, int],
+        status: str,
+        trace: Trace,
+        region: Optional[RegionJob] = None,
+        draft: bool = False,
+    ):
+        with trace.stage("result_resize"):
+            # 部分生成の結果は前回の結果に貼り戻してから表示する
+            # 下書きは表示するだけで、次の差分の基準となる前回の結果には反映しない
+            if region is not None and self._region_inference is not None:
+                if draft:
+                    image = self._region_inference.compose(region, image)
+                else:
+                    image = self._region_inference.merge(region, image)
+            result_img = np.array(image.resize(result_size, Image.BICUBIC))
+        # 下書きの表示後も本生成を待っているため、進捗バーは残す
+        self._publish(status, result_img, progress=0.0 if draft else None)
+
+    def _run(self):
+        jobs: list[InferenceJob] = []
+        while True:
+            # 条件の確認前に clear し、確認中に届いた通知を取りこぼさないようにする
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            saved = self._file_watcher.consume_ready()
+            if saved or self._consume_regenerate():
+                for job in jobs:
+                    self._supersede(job)
+                jobs = self._start_jobs(saved)
+                continue
+            if len(jobs) > 0 and jobs[0].future.done():
+                # 下書き → 本生成の順に ComfyUI のキューに積んでいるため、先頭から完了を処理する
+                job = jobs.pop(0)
+                self._finish_job(job)
+                if not job.draft:
+                    # 本生成が完了した後の下書きは不要なため取り消す。複数案の残りは待ち続ける
+                    for remaining in jobs:
+                        if remaining.draft:
+                            self._supersede(remaining)
+                    jobs = [remaining for remaining in jobs if not remaining.draft]
+                continue
+            self._wake.wait()
+
+        for job in jobs:
+            self._supersede(job)
+
+    def _consume_regenerate(self) -> bool:
+        if not self._regenerate.is_set():
+            return False
+        self._regenerate.clear()
+        return True
+
+    def _start_jobs(self, saved: bool) -> list[InferenceJob]:
+        # 保存から処理開始までの時間は、保存を受けて始める場合のみ記録する
+        # 再生成ボタンや復旧後の生成では最後の保存から時間が経っており、計測値を歪めるため記録しない
+        signature = None
+        if saved:
+            with self._lock:
+                signature, self._ready_signature = self._ready_signature, None
+        # ComfyUI の停止中は合成もせずに見送り、復旧後に最新の保存だけを生成する
+        if not self._client.available:
+            self._defer_until_recovered()
+            return []
+        self._publish("processing")
+        trace = self.tracer.start()
+        if signature is not None:
+            # 保存 (最後の書き込み) から処理開始までの時間
+            trace.add("settle", time.time() - signature.mtime_ns / 1e9)
+        jobs: list[InferenceJob] = []
+        try:
+            prepared = self._prepare(trace)
+            if prepared is None:
+                return []
+            # 本生成の結果が生成済みであれば、下書きは作らずにそのまま表示する
+            final_input = self._pass_input(prepared, trace, draft=False)
+            if prepared.variations > 1:
+                variations = self._variation_inputs(prepared, final_input, trace)
+                if len(variations) == 0:
+                    return []
+            elif self._publish_cached(prepared, final_input, trace):
+                return []
+
+            # ComfyUI は積まれた順に処理するため、下書き → 本生成の順に積む
+            if self.progressive:
+                draft_trace = self.tracer.start()
+                draft_trace.stages = dict(trace.stages)
+                draft_trace.attributes["draft"] = True
+                draft_input = self._pass_input(prepared, draft_trace, draft=True)
+                if not self._publish_cached(prepared, draft_input, draft_trace):
+                    jobs.append(self._request(prepared, draft_input, draft_trace))
+            if prepared.variations > 1:
+                jobs += self._request_variations(
+                    prepared, final_input, variations, trace
+                )
+            else:
+                jobs.append(self._request(prepared, final_input, trace))
+        except Superseded as e:
+            # 他のセッションの順番を待つ間に新しい保存が届いた
+            logger.debug(f"skip request, {e}")
+            for job in jobs:
+                self._supersede(job)
+            self.tracer.finish(trace, "superseded")
+            return []
+        except BackendUnavailable as e:
+            logger.warning(f"failed to request generation, {e}")
+            for job in jobs:
+                self._supersede(job)
+            self.tracer.finish(trace, "error")
+            self._defer_until_recovered()
+            return []
+        except Exception as e:
+            logger.exception(f"failed to request generation, {e}")
+            for job in jobs:
+                self._supersede(job)
+            self._publish("error")
+            self.tracer.finish(trace, "error")
+            return []
+        return jobs
+
+    def _prepare(self, trace: Trace) -> Optional[PreparedInput]:
+        # 途中で workflow が切り替わっても、1 回の保存の処理では同じ workflow・設定を使う
+        # UI は生成設定を直接書き換えるため、下書き・本生成・複数案・キャッシュのキーのすべてを複製から作る
+        with self._lock:
+            workflow_manager = self._workflow_manager
+            generate_settings = self.generate_settings.model_copy(deep=True)
+            variations = max(self.variations, 1)
+
+        with trace.stage("composite"):
+            composite_result = self._psd_compositor.composite(
+                self._file_watcher.path, generate_settings.input_layers
+            )
+        logger.debug(f"parsed psd from {composite_result.source}")
+        # 合成中に次の保存が完了していれば、リクエストせずに最新の保存を処理する
+        if self._file_watcher.is_ready():
+            logger.debug("newer save arrived while parsing, skip request.")
+            self.tracer.finish(trace, "superseded")
+            return None
+        target_resolution = generate_settings.target_resolution
+        composite_img = composite_result.image
+        orig_hw_ratio = composite_img.size[1] / composite_img.size[0]
+        region = None
+        # 複数案は案ごとに貼り戻し先が異なるため、常に全体を生成する
+        if self._region_inference is not None and variations == 1:
+            with trace.stage("resize"):
+                region = self._region_inference.plan(
+                    composite_img,
+                    generate_settings.model_dump_json()
+                    + workflow_manager.workflow_digest,
+                )
+        # 部分生成の場合も、表示する結果画像はキャンバス全体の大きさにする
+        result_width = calc_target_size(*composite_img.size, target_resolution)[0]
+        source = composite_result.source
+        if region is not None and region.crop_box is not None:
+            source += ", region"
+            trace.attributes["region"] = list(region.crop_box)
+        return PreparedInput(
+            composite=composite_img,
+            result_size=(result_width, int(orig_hw_ratio * result_width)),
+            source=source,
+            region=region,
+            generate_settings=workflow_manager.resolve_settings(generate_settings),
+            workflow_manager=workflow_manager,
+            variations=variations,
+            cacheable=generate_settings.seed != -1,
+        )
+
+    def _pass_input(
+        self, prepared: PreparedInput, trace: Trace, draft: bool
+    ) -> PassInput:
+        generate_settings = prepared.generate_settings
+        target_resolution = generate_settings.target_resolution
+        steps = None
+        if draft:
+            target_resolution = generate_settings.draft.target_resolution
+            steps = generate_settings.draft.steps
+        with trace.stage("resize"):
+            if prepared.region is not None and self._region_inference is not None:
+                input_img = self._region_inference.input_image(
+                    prepared.composite, prepared.region, target_resolution
+                )
+            else:
+                input_img = resize_target_resolution(
+                    prepared.composite, target_resolution
+                )
+
+        cache_key = None
+        if self._result_cache is not None and prepared.cacheable:
+            # ステップ数を変えた下書きは別の結果として扱う
+            cache_key = result_key(
+                input_img,
+                generate_settings,
+                prepared.workflow_manager.workflow_digest
+                + ("" if steps is None else f":steps={steps}"),
+            )
+        return PassInput(input_img, steps, cache_key, draft)
+
+    def _source(self, prepared: PreparedInput, pass_input: PassInput) -> str:
+        source = prepared.source
+        if prepared.region is not None and prepared.region.crop_box is not None:
+            source += f" {pass_input.image.size[0]}x{pass_input.image.size[1]}"
+        return source
+
+    def _publish_cached(
+        self, prepared: PreparedInput, pass_input: PassInput, trace: Trace
+    ) -> bool:
+        # 入力画像・設定・workflow が同じであれば生成済みの結果を使う
+        if self._result_cache is None or pass_input.cache_key is None:
+            return False
+        cached_img = self._result_cache.get(pass_input.cache_key)
+        if cached_img is None:
+            return False
+        logger.debug(f"result cache hit: {pass_input.cache_key}")
+        label = "draft" if pass_input.draft else "finished"
+        self._publish_image(
+            cached_img,
+            prepared.result_size,
+            f"{label} ({self._source(prepared, pass_input)}, cached)",
+            trace,
+            prepared.region,
+            pass_input.draft,
+        )
+        self.tracer.finish(trace, "draft" if pass_input.draft else "cached")
+        return True
+
+    def _variation_inputs(
+        self, prepared: PreparedInput, pass_input: PassInput, trace: Trace
+    ) -> list[Variation]:
+        # 各案の生成設定を作り、生成済みの案は結果を格子に並べて、未生成の案だけを返す
+        self._variation_images = [None] * prepared.variations
+        pending: list[Variation] = []
+        for index in range(prepared.variations):
+            generate_settings = prepared.generate_settings.model_copy(
+                update={"seed": prepared.generate_settings.seed + index}
+            )
+            cache_key = None
+            if self._result_cache is not None and prepared.cacheable:
+                cache_key = result_key(
+                    pass_input.image,
+                    generate_settings,
+                    prepared.workflow_manager.workflow_digest,
+                )
+                cached_img = self._result_cache.get(cache_key)
+                if cached_img is not None:
+                    self._variation_images[index] = cached_img
+                    continue
+            pending.append(Variation(index, generate_settings, cache_key))
+
+        if len(pending) < prepared.variations:
+            logger.debug(
+                f"result cache hit: {prepared.variations - len(pending)} variations"
+            )
+            self._publish_variations(
+                prepared.result_size,
+                f"({self._source(prepared, pass_input)}, cached)",
+                trace,
+            )
+        if len(pending) == 0:
+            self.tracer.finish(trace, "cached")
+        return pending
+
+    def _publish_variations(
+        self, result_size: tuple[int, int], detail: str, trace: Trace
+    ):
+        with trace.stage("result_resize"):
+            result_img = np.array(make_grid(self._variation_images, result_size))
+        done = sum(image is not None for image in self._variation_images)
+        total = len(self._variation_images)
+        if done < total:
+            # 残りの案を生成中のため、進捗バーは残す
+            self._publish(f"variations {done}/{total} {detail}", result_img, 0.0)
+        else:
+            self._publish(f"finished {detail}", result_img)
+
+    def _request_variations(
+        self,
+        prepared: PreparedInput,
+        pass_input: PassInput,
+        variations: list[Variation],
+        trace: Trace,
+    ) -> list[InferenceJob]:
+        # 入力画像は 1 回だけエンコードし、シードだけが異なるプロンプトを同じ接続で続けて積む
+        with trace.stage("encode"):
+            workflows = prepared.workflow_manager.create_variations(
+                input_img=pass_input.image,
+                settings_list=[variation.generate_settings for variation in variations],
+                steps=pass_input.steps,
+            )
+        jobs: list[InferenceJob] = []
+        for i, (variation, workflow) in enumerate(zip(variations, workflows)):
+            # 最初の案には合成・エンコードの時間を含め、他の案は送信以降の時間だけを記録する
+            variation_trace = trace if i == 0 else self.tracer.start()
+            variation_trace.attributes["variation"] = variation.index
+            jobs.append(
+                self._enqueue(
+                    prepared,
+                    pass_input._replace(cache_key=variation.cache_key),
+                    variation_trace,
+                    workflow,
+                    variation=variation.index,
+                )
+            )
+        return jobs
+
+    def _request(
+        self, prepared: PreparedInput, pass_input: PassInput, trace: Trace
+    ) -> InferenceJob:
+        # workflow api にパラメータを設定
+        with trace.stage("encode"):
+            workflow = prepared.workflow_manager.create(
+                input_img=pass_input.image,
+                generate_settings=prepared.generate_settings,
+                steps=pass_input.steps,
+            )
+        return self._enqueue(prepared, pass_input, trace, workflow)
+
+    def _enqueue(
+        self,
+        prepared: PreparedInput,
+        pass_input: PassInput,
+        trace: Trace,
+        workflow: WorkflowInstance,
+        variation: Optional[int] = None,
+    ) -> InferenceJob:
+        # ComfyUI に処理をリクエストし、完了はイベントループのスレッドで待つ
+        with trace.stage("enqueue"):
+            prompt_id = self._client.enqueue(workflow)
+        enqueued_at = time.perf_counter()
+        source = self._source(prepared, pass_input)
+        trace.prompt_id = prompt_id
+        trace.attributes["queue_position"] = self._client.queue_remaining
+        trace.attributes["source"] = source
+        trace.attributes["transport"] = str(workflow.transport_stats)
+        logger.debug(f"input image: {workflow.transport_stats}")
+        self._activate_prompt(prompt_id, True)
+        self._publish("executing", progress=0.0)
+        future = self._client.submit_polling(
+            prompt_id,
+            # 複数案のプレビューは格子の表示を置き換えてしまうため、進捗だけを表示する
+            on_event=lambda message: self._on_client_event(
+                prompt_id,
+                prepared.result_size,
+                prepared.region,
+                message,
+                show_preview=variation is None,
+            ),
+        )
+        future.add_done_callback(lambda _: self._wake.set())
+        return InferenceJob(
+            prompt_id=prompt_id,
+            future=future,
+            result_size=prepared.result_size,
+            source=source,
+            trace=trace,
+            enqueued_at=enqueued_at,
+            cache_key=pass_input.cache_key,
+            region=prepared.region,
+            draft=pass_input.draft,
+            variation=variation,
+        )
+
+    def _supersede(self, job: InferenceJob):
+        # 古い結果は不要なため待ち受けを止め、ComfyUI 側の処理も取り消す
+        logger.debug(f"supersede prompt {job.prompt_id}")
+        self._activate_prompt(job.prompt_id, False)
+        job.future.cancel()
+        try:
+            self._client.cancel(job.prompt_id)
+        except Exception as e:
+            logger.warning(f"failed to cancel prompt {job.prompt_id}: {e}")
+        self.tracer.finish(job.trace, "superseded")
+
+    def _finish_job(self, job: InferenceJob):
+        self._activate_prompt(job.prompt_id, False)
+        trace = job.trace
+        timing = self._client.pop_timing(job.prompt_id)
+        if timing is not None:
+            trace.attributes["queue_position"] = max(
+                timing.queue_position, trace.attributes.get("queue_position", 0)
+            )
+            if timing.started_at is not None:
+                trace.add("queue_wait", timing.started_at - job.enqueued_at)
+                if timing.finished_at is not None:
+                    trace.add("execution", timing.finished_at - timing.started_at)
+        self.tracer.queue_remaining = self._client.queue_remaining
+
+        try:
+            generated_img = job.future.result()
+        except BackendUnavailable as e:
+            # ComfyUI の再起動でプロンプトが失われた場合は、復旧後に生成し直す
+            logger.warning(f"generation failed, {e}")
+            self.tracer.finish(trace, "error")
+            self._defer_until_recovered()
+            return
+        except Exception as e:
+            logger.exception(f"generation failed, {e}")
+            self._publish("error")
+            self.tracer.finish(trace, "error")
+            return
+
+        if isinstance(generated_img, Image.Image):
+            # 受信した PNG は遅延デコードされるため、ここでデコードして計測する
+            with trace.stage("decode"):
+                generated_img.load()
+            if job.variation is not None:
+                self._finish_variation(job, generated_img)
+                return
+            label = "draft" if job.draft else "finished"
+            self._publish_image(
+                generated_img,
+                job.result_size,
+                f"{label} ({job.source})",
+                trace,
+                job.region,
+                job.draft,
+            )
+            # 下書きは本生成の所要時間の分布と分けて数える
+            self.tracer.finish(trace, "draft" if job.draft else "finished")
+            if self._result_cache is not None and job.cache_key is not None:
+                self._result_cache.put(job.cache_key, generated_img)
+        else:
+            # 同設定の場合 ComfyUI の処理がスキップされるため、そのまま終了する
+            self._publish("skip")
+            self.tracer.finish(trace, "skip")
+
+    def _finish_variation(self, job: InferenceJob, generated_img: Image.Image):
+        self._variation_images[job.variation] = generated_img
+        self._publish_variations(job.result_size, f"({job.source})", job.trace)
+        self.tracer.finish(job.trace, "finished")
+        if self._result_cache is not None and job.cache_key is not None:
+            self._result_cache.put(job.cache_key, generated_img)
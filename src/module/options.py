@@ -0,0 +1,20 @@
+from pathlib import Path
+from typing import Literal
+
+# コマンドライン引数の選択肢と既定値
+# main.py が引数を解釈するだけで PSD・画像・HTTP のライブラリを読み込まないよう、標準ライブラリのみに依存させる
+
+InputMode = Literal["merged", "layers", "auto"]
+INPUT_MODES = ("merged", "layers", "auto")
+TransportMode = Literal["base64", "base64_fast", "upload", "local"]
+TRANSPORT_MODES = ("base64", "base64_fast", "upload", "local")
+
+# UI に表示する結果画像の大きさ
+VIEW_IMG_HEIGHT, VIEW_IMG_WIDTH = 768, 768
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "psd-watch-inference" / "results"
+DEFAULT_DISK_MAX_BYTES = 1024 * 1024 * 1024
+# 変更範囲がキャンバスに対してこの割合を超えたら全体を生成し直す
+DEFAULT_FULL_THRESHOLD = 0.5
+# /metrics を公開するアドレス。他のマシンから取得する場合は --metrics_host 0.0.0.0 を指定する
+DEFAULT_METRICS_HOST = "127.0.0.1"
@@ -0,0 +1,432 @@
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Hashable, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.constants import BlendMode, SheetColorType, Tag
+
+from schemas.generate_settings import LayerFilter, LayerSelection
+from module.options import INPUT_MODES, InputMode
+from utils.blend import BlendEngine, BlendLayer
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+SUPPORTED_BLEND_MODES = {
+    BlendMode.NORMAL: "normal",
+    BlendMode.MULTIPLY: "multiply",
+    BlendMode.SCREEN: "screen",
+    BlendMode.OVERLAY: "overlay",
+}
+
+BBox = tuple[int, int, int, int]
+
+
+class CompositeResult(NamedTuple):
+    image: Image.Image
+    # 実際に使われた読み込み経路。"merged" または "layers"
+    source: str
+
+
+class StackEntry(NamedTuple):
+    key: Hashable
+    fingerprint: str
+    bbox: BBox
+    opacity: float
+    blend_mode: str
+    clipping: bool
+
+
+class LayerCacheEntry(NamedTuple):
+    fingerprint: str
+    image: Image.Image
+    nbytes: int
+
+
+class LayerCache:
+    # デコード済みレイヤー画像 (RGBA) の LRU キャッシュ。合計サイズが max_bytes を超えたら古いものから破棄する
+    # 複数のセッションで共有する場合は、各セッションの合成スレッドから呼ばれる
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, LayerCacheEntry] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, fingerprint: str) -> Optional[Image.Image]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.fingerprint != fingerprint:
+                return None
+            self._entries.move_to_end(key)
+            return entry.image
+
+    def put(self, key: Hashable, fingerprint: str, image: Image.Image):
+        nbytes = image.size[0] * image.size[1] * len(image.getbands())
+        with self._lock:
+            self._discard(key)
+            if nbytes > self._max_bytes:
+                return
+            self._entries[key] = LayerCacheEntry(fingerprint, image, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.nbytes
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+def layer_key(layer, index: int) -> Hashable:
+    # layer_id が割り振られていないファイルは名前と位置で識別する
+    if layer.layer_id != -1:
+        return layer.layer_id
+    return (layer.name, index)
+
+
+def layer_fingerprint(layer) -> str:
+    # デコード前のレコードと圧縮済みチャンネルデータから内容のハッシュを計算する
+    record = layer._record
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        repr(
+            (
+                record.top,
+                record.left,
+                record.bottom,
+                record.right,
+                record.blend_mode,
+                record.opacity,
+                record.clipping,
+                record.flags.visible,
+                record.mask_data,
+            )
+        ).encode()
+    )
+    for channel in layer._channels:
+        digest.update(channel.compression.value.to_bytes(2, "big"))
+        digest.update(channel.data)
+    return digest.hexdigest()
+
+
+def blend_mode_name(blend_mode: BlendMode) -> str:
+    # 未対応の合成モードは通常として扱う
+    return SUPPORTED_BLEND_MODES.get(blend_mode, "normal")
+
+
+def effective_opacity(layer) -> float:
+    # 親グループの不透明度も反映する
+    opacity = layer.opacity / 255.0
+    parent = layer.parent
+    while parent is not None and parent.kind != "psdimage":
+        opacity *= parent.opacity / 255.0
+        parent = parent.parent
+    return opacity
+
+
+def apply_layer_mask(image: Image.Image, layer) -> Image.Image:
+    # レイヤーマスクをアルファに焼き込む。マスク範囲外は background_color で埋める
+    mask = layer.mask
+    mask_image = mask.topil()
+    left, top = layer.offset
+    pixels = np.array(image)
+    height, width = pixels.shape[:2]
+    full_mask = np.full((height, width), mask.background_color, dtype=np.uint8)
+    if mask_image is not None:
+        overlap = intersect_bbox(mask.bbox, (left, top, left + width, top + height))
+        if overlap is not None:
+            mask_pixels = np.asarray(mask_image.convert("L"))
+            full_mask[
+                overlap[1] - top : overlap[3] - top,
+                overlap[0] - left : overlap[2] - left,
+            ] = mask_pixels[
+                overlap[1] - mask.top : overlap[3] - mask.top,
+                overlap[0] - mask.left : overlap[2] - mask.left,
+            ]
+    alpha = pixels[..., 3].astype(np.uint16) * full_mask // 255
+    pixels[..., 3] = alpha.astype(np.uint8)
+    return Image.fromarray(pixels, "RGBA")
+
+
+def color_label(layer) -> str:
+    # レイヤーパネルの色ラベル。設定ファイルと同じ小文字の名前で返す
+    tagged_blocks = layer.tagged_blocks
+    value = None
+    if tagged_blocks is not None:
+        value = tagged_blocks.get_data(Tag.SHEET_COLOR_SETTING)
+    if value is None:
+        return "none"
+    return SheetColorType(value).name.lower()
+
+
+def name_tags(name: str) -> set[str]:
+    # "線画 #input" のように、名前に空白区切りで書かれた #タグ を返す
+    return {word[1:] for word in name.split() if word.startswith("#") and len(word) > 1}
+
+
+def matches_filter(layer, layer_filter: LayerFilter) -> bool:
+    if any(fnmatch.fnmatchcase(layer.name, pattern) for pattern in layer_filter.names):
+        return True
+    if len(layer_filter.tags) > 0 and not name_tags(layer.name).isdisjoint(
+        layer_filter.tags
+    ):
+        return True
+    return len(layer_filter.colors) > 0 and color_label(layer) in layer_filter.colors
+
+
+class LayerSelector:
+    # settings.json の input_layers に従って合成するレイヤーを選ぶ。グループの判定は 1 回の合成の間保持する
+    def __init__(self, selection: LayerSelection):
+        self._selection = selection
+        self._groups: dict[int, tuple[bool, bool]] = {}
+
+    def _match(self, layer) -> tuple[bool, bool]:
+        # (include に一致したか, exclude に一致したか) を親グループの結果も含めて返す
+        parent = layer.parent
+        if parent is None or parent.kind == "psdimage":
+            included, excluded = False, False
+        elif id(parent) in self._groups:
+            included, excluded = self._groups[id(parent)]
+        else:
+            included, excluded = self._match(parent)
+            self._groups[id(parent)] = (included, excluded)
+        include = self._selection.include
+        return (
+            included or (include is not None and matches_filter(layer, include)),
+            excluded or matches_filter(layer, self._selection.exclude),
+        )
+
+    def selected(self, layer) -> bool:
+        included, excluded = self._match(layer)
+        return not excluded and (self._selection.include is None or included)
+
+    def selects_all(self, psd: PSDImage) -> bool:
+        # 表示中のレイヤーがすべて選ばれるか。レイヤーのレコードのみで判定し、画素はデコードしない
+        return all(
+            self.selected(layer)
+            for layer in psd.descendants()
+            if not layer.is_group() and layer.is_visible()
+        )
+
+
+def has_current_merged_image(psd: PSDImage) -> bool:
+    # 「互換性を優先」で保存されていない PSD は has_composite が False になり、白紙の合成画像が入っている
+    if not psd.has_preview():
+        return False
+    image_data = psd._record.image_data
+    return image_data is not None and len(image_data.data) > 0
+
+
+def union_bbox(bboxes: list[BBox]) -> Optional[BBox]:
+    bboxes = [bbox for bbox in bboxes if bbox[0] < bbox[2] and bbox[1] < bbox[3]]
+    if len(bboxes) == 0:
+        return None
+    return (
+        min(bbox[0] for bbox in bboxes),
+        min(bbox[1] for bbox in bboxes),
+        max(bbox[2] for bbox in bboxes),
+        max(bbox[3] for bbox in bboxes),
+    )
+
+
+def intersect_bbox(a: BBox, b: BBox) -> Optional[BBox]:
+    bbox = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None
+    return bbox
+
+
+class PsdCompositor:
+    # 前回の合成結果とデコード済みレイヤーを保持し、変更のあったレイヤーの範囲のみ再合成するモジュール
+    def __init__(
+        self,
+        input_mode: InputMode = "auto",
+        cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        cache: Optional[LayerCache] = None,
+        cache_namespace: Optional[str] = None,
+    ):
+        assert input_mode in INPUT_MODES, f"input_mode {input_mode} is not supported."
+        self._input_mode = input_mode
+        # 複数のセッションでキャッシュを共有する場合は、レイヤーの ID が重ならないようセッションごとに区別する
+        self._cache = cache or LayerCache(cache_max_bytes)
+        self._cache_namespace = cache_namespace
+        self._engine = BlendEngine()
+        self._canvas: Optional[Image.Image] = None
+        self._stack: list[StackEntry] = []
+
+    @property
+    def cache(self) -> LayerCache:
+        return self._cache
+
+    def reset(self):
+        self._cache.clear()
+        self._canvas = None
+        self._stack = []
+
+    @property
+    def input_mode(self) -> str:
+        return self._input_mode
+
+    def composite(
+        self, file_path: str | Path, selection: Optional[LayerSelection] = None
+    ) -> CompositeResult:
+        psd = PSDImage.open(file_path)
+
+        # 統合画像には表示中のレイヤーがすべて含まれるため、選ばれないレイヤーがある場合のみレイヤーから合成する
+        if selection is not None:
+            selector = LayerSelector(selection)
+            if not selector.selects_all(psd):
+                return CompositeResult(self._composite_layers(psd, selector), "layers")
+        if self._input_mode == "merged" or (
+            self._input_mode == "auto"
+            and (has_current_merged_image(psd) or len(psd) == 0)
+        ):
+            image = psd.topil()
+            if image is not None:
+                logger.debug("composite from merged image data")
+                return CompositeResult(image.convert("RGB"), "merged")
+            logger.warning("merged image data is not available, fallback to layers")
+
+        return CompositeResult(self._composite_layers(psd), "layers")
+
+    def _composite_layers(
+        self, psd: PSDImage, selector: Optional[LayerSelector] = None
+    ) -> Image.Image:
+        layers = {}
+        stack = []
+        clip_base_visible = False
+        for index, layer in enumerate(psd.descendants()):
+            if layer.is_group():
+                continue
+            # 選ばれなかったレイヤーは非表示と同じく扱い、ハッシュの計算もデコードもしない
+            visible = layer.is_visible() and (
+                selector is None or selector.selected(layer)
+            )
+            # クリッピングの基準レイヤーが非表示の場合、クリップされたレイヤーも表示しない
+            if not layer.clipping_layer:
+                clip_base_visible = visible
+            if not visible or (layer.clipping_layer and not clip_base_visible):
+                continue
+            key = layer_key(layer, index)
+            if self._cache_namespace is not None:
+                key = (self._cache_namespace, key)
+            fingerprint = layer_fingerprint(layer)
+            image = self._decode(layer, key, fingerprint)
+            if image is None:
+                if not layer.clipping_layer:
+                    clip_base_visible = False
+                continue
+            left, top = layer.offset
+            bbox = (left, top, left + image.size[0], top + image.size[1])
+            layers[key] = image
+            stack.append(
+                StackEntry(
+                    key,
+                    fingerprint,
+                    bbox,
+                    effective_opacity(layer),
+                    blend_mode_name(layer.blend_mode),
+                    layer.clipping_layer,
+                )
+            )
+
+        if selector is not None and len(stack) == 0:
+            logger.warning("no layers matched input_layers in settings.json")
+        dirty_bbox = self._find_dirty_bbox(psd.size, stack)
+        if self._canvas is None or dirty_bbox == (0, 0, *psd.size):
+            self._canvas = Image.new("RGB", psd.size, (255, 255, 255))
+            dirty_bbox = (0, 0, *psd.size)
+        if dirty_bbox is not None:
+            self._blend(stack, layers, dirty_bbox)
+        logger.debug(
+            f"composite {len(stack)} layers, dirty: {dirty_bbox}, "
+            f"cache: {len(self._cache)} layers / {self._cache.total_bytes} bytes"
+        )
+        self._stack = stack
+        return self._canvas.copy()
+
+    def _decode(self, layer, key: Hashable, fingerprint: str) -> Optional[Image.Image]:
+        image = self._cache.get(key, fingerprint)
+        if image is not None:
+            return image
+        try:
+            image = layer.topil()
+        except ValueError:
+            return None
+        if image is None:
+            return None
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if layer.has_mask() and not layer.mask.disabled:
+            image = apply_layer_mask(image, layer)
+        self._cache.put(key, fingerprint, image)
+        return image
+
+    def _find_dirty_bbox(self, size: tuple[int, int], stack: list[StackEntry]):
+        full_bbox = (0, 0, *size)
+        if self._canvas is None or self._canvas.size != size:
+            return full_bbox
+
+        prev_entries = set(self._stack)
+        entries = set(stack)
+        # 共通するレイヤーの重なり順が変わった場合は全体を再合成する
+        prev_order = [entry for entry in self._stack if entry in entries]
+        order = [entry for entry in stack if entry in prev_entries]
+        if prev_order != order:
+            return full_bbox
+
+        changed = [entry.bbox for entry in prev_entries ^ entries]
+        dirty_bbox = union_bbox(changed)
+        if dirty_bbox is None:
+            return None
+        return intersect_bbox(dirty_bbox, full_bbox)
+
+    def _blend(
+        self, stack: list[StackEntry], layers: dict[Hashable, Image.Image], bbox: BBox
+    ):
+        self._canvas.paste((255, 255, 255), bbox)
+        # 基準レイヤーと、それにクリッピングされたレイヤーをまとめて合成する
+        groups: list[tuple[BlendLayer, list[BlendLayer]]] = []
+        for entry in stack:
+            layer = BlendLayer(
+                layers[entry.key], entry.bbox[:2], entry.opacity, entry.blend_mode
+            )
+            if entry.clipping:
+                if len(groups) != 0:
+                    groups[-1][1].append(layer)
+                continue
+            groups.append((layer, []))
+
+        for layer, clip_layers in groups:
+            self._engine.blend(
+                self._canvas, layer, region=bbox, clip_layers=tuple(clip_layers)
+            )
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+from module.options import DEFAULT_FULL_THRESHOLD
+from module.psd_compositor import BBox
+from utils.util import resize_target_resolution
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# 変更範囲の周囲に含める余白 (キャンバスの px)。生成結果の境界を周囲になじませるために使う
+DEFAULT_PADDING = 64
+# 部分生成の結果を貼り戻す際に、境界からこの幅 (px) でぼかして合成する
+DEFAULT_FEATHER = 32
+# 画素値の差がこの値以下であれば変更とみなさない
+DEFAULT_DIFF_THRESHOLD = 8
+# 部分生成の解像度の下限。小さすぎる範囲は SDXL の品質が落ちるため拡大して生成する
+DEFAULT_MIN_RESOLUTION = 512
+# 部分生成の範囲の短辺は長辺のこの割合以上にする
+MIN_ASPECT = 0.25
+
+
+class RegionJob(NamedTuple):
+    # 生成に使った合成画像 (RGB, キャンバスの解像度)
+    composite: np.ndarray
+    # 部分生成する範囲。全体を生成する場合は None
+    crop_box: Optional[BBox]
+    # 生成設定と workflow を識別する文字列。変わった場合は全体を生成し直す
+    settings_key: str
+
+
+def find_dirty_bbox(
+    previous: np.ndarray, current: np.ndarray, threshold: int = DEFAULT_DIFF_THRESHOLD
+) -> Optional[BBox]:
+    # uint8 のまま差の絶対値を求め、いずれかのチャンネルが threshold を超えた画素を囲む矩形を返す
+    diff = np.maximum(previous, current) - np.minimum(previous, current)
+    changed = diff.max(axis=2) > threshold
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(changed.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+def _expand(start: int, end: int, length: int, limit: int) -> tuple[int, int]:
+    # [start, end) を中心を保ったまま length まで広げ、[0, limit) に収める
+    length = min(length, limit)
+    start = max(0, min(start - (length - (end - start)) // 2, limit - length))
+    return start, max(end, start + length)
+
+
+def pad_bbox(bbox: BBox, canvas_size: tuple[int, int], padding: int) -> BBox:
+    width, height = canvas_size
+    left, top = max(bbox[0] - padding, 0), max(bbox[1] - padding, 0)
+    right, bottom = min(bbox[2] + padding, width), min(bbox[3] + padding, height)
+    # 細長い範囲は生成できる解像度にならないため、短辺を広げる
+    min_side = int(max(right - left, bottom - top) * MIN_ASPECT)
+    left, right = _expand(left, right, max(right - left, min_side), width)
+    top, bottom = _expand(top, bottom, max(bottom - top, min_side), height)
+    return (left, top, right, bottom)
+
+
+def feather_mask(crop_box: BBox, canvas_size: tuple[int, int], feather: int):
+    # キャンバスの端に接していない辺だけを feather px かけて透明にする
+    width, height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+    x = np.arange(width, dtype=np.float32)
+    y = np.arange(height, dtype=np.float32)
+    dx = np.minimum(
+        x + 1 if crop_box[0] > 0 else np.inf,
+        width - x if crop_box[2] < canvas_size[0] else np.inf,
+    )
+    dy = np.minimum(
+        y + 1 if crop_box[1] > 0 else np.inf,
+        height - y if crop_box[3] < canvas_size[1] else np.inf,
+    )
+    alpha = np.clip(np.minimum(dx[None, :], dy[:, None]) / max(feather, 1), 0, 1)
+    return Image.fromarray((alpha * 255).astype(np.uint8), "L")
+
+
+# 前回の生成に使った合成画像との差分から変更範囲を求め、その範囲だけを生成して前回の結果に貼り戻すモジュール
+# 前回の結果 (base) は生成が完了したときだけ更新するため、途中で置き換えられた生成の変更も次の差分に含まれる
+class RegionInference:
+    def __init__(
+        self,
+        full_threshold: float = DEFAULT_FULL_THRESHOLD,
+        padding: int = DEFAULT_PADDING,
+        feather: int = DEFAULT_FEATHER,
+        diff_threshold: int = DEFAULT_DIFF_THRESHOLD,
+        min_resolution: int = DEFAULT_MIN_RESOLUTION,
+    ):
+        self.full_threshold = full_threshold
+        self.padding = padding
+        self.feather = feather
+        self.diff_threshold = diff_threshold
+        self.min_resolution = min_resolution
+        self._base_composite: Optional[np.ndarray] = None
+        self._base_output: Optional[Image.Image] = None
+        self._base_settings_key: Optional[str] = None
+        self._force_full = False
+        self._preview_base: Optional[tuple[tuple[int, int], np.ndarray]] = None
+
+    def request_full(self):
+        # 次の生成は変更範囲にかかわらず全体を生成する
+        self._force_full = True
+
+    def plan(self, composite: Image.Image, settings_key: str) -> RegionJob:
+        current = np.asarray(composite.convert("RGB"))
+        crop_box = None
+        if (
+            not self._force_full
+            and self._base_composite is not None
+            and self._base_composite.shape == current.shape
+            and self._base_settings_key == settings_key
+        ):
+            dirty_bbox = find_dirty_bbox(
+                self._base_composite, current, self.diff_threshold
+            )
+            # 変更がない場合は、保存し直して生成し直したいものとして全体を生成する
+            if dirty_bbox is not None:
+                crop_box = pad_bbox(dirty_bbox, composite.size, self.padding)
+                area = (crop_box[2] - crop_box[0]) * (crop_box[3] - crop_box[1])
+                if area > self.full_threshold * composite.size[0] * composite.size[1]:
+                    crop_box = None
+        self._force_full = False
+        logger.debug(f"region inference: {crop_box or 'full'}")
+        return RegionJob(current, crop_box, settings_key)
+
+    def input_image(
+        self, composite: Image.Image, job: RegionJob, target_resolution: int
+    ) -> Image.Image:
+        if job.crop_box is None:
+            return resize_target_resolution(composite, target_resolution)
+        crop = composite.crop(job.crop_box)
+        # 全体を生成する場合と同じ画素密度で生成し、GPU の処理量を変更範囲の面積に比例させる
+        area_ratio = (crop.size[0] * crop.size[1]) / (
+            composite.size[0] * composite.size[1]
+        )
+        resolution = target_resolution * math.sqrt(area_ratio)
+        resolution = min(max(resolution, self.min_resolution), target_resolution)
+        return resize_target_resolution(crop, int(resolution))
+
+    def merge(self, job: RegionJob, generated: Image.Image) -> Image.Image:
+        # 生成結果をキャンバスの解像度で base に反映し、反映後の画像を返す
+        output = self.compose(job, generated)
+        self._base_output = output
+        self._base_composite = job.composite
+        self._base_settings_key = job.settings_key
+        self._preview_base = None
+        return output
+
+    def compose(self, job: RegionJob, generated: Image.Image) -> Image.Image:
+        # base を更新せずに、生成結果を貼り戻した画像を返す
+        canvas_size = (job.composite.shape[1], job.composite.shape[0])
+        generated = generated.convert("RGB")
+        if (
+            job.crop_box is None
+            or self._base_output is None
+            or self._base_output.size != canvas_size
+        ):
+            output = generated.resize(canvas_size, Image.BICUBIC)
+        else:
+            crop_size = (
+                job.crop_box[2] - job.crop_box[0],
+                job.crop_box[3] - job.crop_box[1],
+            )
+            output = self._base_output.copy()
+            output.paste(
+                generated.resize(crop_size, Image.BICUBIC),
+                job.crop_box[:2],
+                feather_mask(job.crop_box, canvas_size, self.feather),
+            )
+        return output
+
+    def preview(
+        self, job: RegionJob, preview: Image.Image, result_size: tuple[int, int]
+    ) -> np.ndarray:
+        # 部分生成中のプレビューは、表示サイズの base の該当範囲に差し込んで表示する
+        base = self._base_output
+        if job.crop_box is None or base is None:
+            return np.array(preview.resize(result_size, Image.BILINEAR))
+        if self._preview_base is None or self._preview_base[0] != result_size:
+            self._preview_base = (
+                result_size,
+                np.array(base.resize(result_size, Image.BILINEAR)),
+            )
+        image = self._preview_base[1].copy()
+        scale_x, scale_y = result_size[0] / base.size[0], result_size[1] / base.size[1]
+        left, top = int(job.crop_box[0] * scale_x), int(job.crop_box[1] * scale_y)
+        right = max(int(job.crop_box[2] * scale_x), left + 1)
+        bottom = max(int(job.crop_box[3] * scale_y), top + 1)
+        patch = preview.convert("RGB").resize((right - left, bottom - top))
+        image[top:bottom, left:right] = np.asarray(patch)
+        return image
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+from schemas.generate_settings import GenerateSettings
+from module.image_transport import image_digest
+from module.options import DEFAULT_CACHE_DIR, DEFAULT_DISK_MAX_BYTES
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+DEFAULT_MEMORY_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CacheStats(NamedTuple):
+    memory_hits: int
+    disk_hits: int
+    misses: int
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def __str__(self) -> str:
+        return f"cache hit {self.hits} / miss {self.misses}"
+
+
+def result_key(
+    input_img: Image.Image, generate_settings: GenerateSettings, workflow_digest: str
+) -> str:
+    # リサイズ後の入力画素、シードを確定させた生成設定、workflow の内容から生成結果を特定する
+    assert generate_settings.seed != -1, "seed must be resolved before caching."
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(image_digest(input_img).encode())
+    digest.update(generate_settings.model_dump_json().encode())
+    digest.update(workflow_digest.encode())
+    return digest.hexdigest()
+
+
+# 生成結果をメモリとディスクの 2 段で保持する LRU キャッシュ
+# メモリはデコード済みの画像、ディスクは PNG で保持し、それぞれ合計サイズの上限を超えると古いものから削除する
+class ResultCache:
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+        memory_max_bytes: int = DEFAULT_MEMORY_MAX_BYTES,
+        disk_max_bytes: int = DEFAULT_DISK_MAX_BYTES,
+    ):
+        self._memory_max_bytes = memory_max_bytes
+        self._disk_max_bytes = disk_max_bytes
+        self._memory: OrderedDict[str, Image.Image] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+        # ディスクのエントリは更新時刻の古い順に並べる
+        self._cache_dir = cache_dir
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        # ロックの外で書き込み中のキー。同じ結果を二重に書き込まない
+        self._writing: set[str] = set()
+        if self._cache_dir is not None:
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            paths = sorted(
+                self._cache_dir.glob("*.png"), key=lambda path: path.stat().st_mtime
+            )
+            for path in paths:
+                self._disk[path.stem] = path.stat().st_size
+                self._disk_bytes += path.stat().st_size
+            self._evict_disk()
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._memory_hits, self._disk_hits, self._misses)
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                return image
+            if self._cache_dir is None or key not in self._disk:
+                self._misses += 1
+                return None
+
+        # UI の問い合わせごとに stats を参照するため、PNG のデコードはロックの外で行う
+        image = self._load_disk(key)
+        with self._lock:
+            if image is None:
+                if key in self._disk:
+                    self._disk_bytes -= self._disk.pop(key)
+                self._misses += 1
+                return None
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._disk_hits += 1
+            self._put_memory(key, image)
+            return image
+
+    def put(self, key: str, image: Image.Image):
+        with self._lock:
+            self._put_memory(key, image)
+            if self._cache_dir is None or key in self._disk or key in self._writing:
+                return
+            self._writing.add(key)
+
+        # PNG のエンコード・書き込みはロックの外で行い、索引とサイズの更新のみロックの中で行う
+        path = self._cache_dir / f"{key}.png"
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            image.save(tmp_path, format="PNG", compress_level=1)
+            tmp_path.replace(path)
+            nbytes = path.stat().st_size
+        except OSError as e:
+            logger.warning(f"failed to write result cache {path}: {e}")
+            with self._lock:
+                self._writing.discard(key)
+            return
+        with self._lock:
+            self._writing.discard(key)
+            self._disk[key] = nbytes
+            self._disk_bytes += nbytes
+            self._evict_disk()
+
+    def _put_memory(self, key: str, image: Image.Image):
+        nbytes = image.size[0] * image.size[1] * len(image.getbands())
+        if key in self._memory or nbytes > self._memory_max_bytes:
+            return
+        self._memory[key] = image
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self._memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= (
+                evicted.size[0] * evicted.size[1] * len(evicted.getbands())
+            )
+
+    def _load_disk(self, key: str) -> Optional[Image.Image]:
+        assert self._cache_dir is not None
+        path = self._cache_dir / f"{key}.png"
+        try:
+            with Image.open(path) as image:
+                image.load()
+            # 次回起動時にも LRU の順序を保てるよう更新時刻を更新する
+            os.utime(path)
+        except OSError as e:
+            logger.warning(f"failed to read result cache {path}: {e}")
+            return None
+        return image
+
+    def _evict_disk(self):
+        assert self._cache_dir is not None
+        while self._disk_bytes > self._disk_max_bytes and len(self._disk) > 0:
+            key, nbytes = self._disk.popitem(last=False)
+            self._disk_bytes -= nbytes
+            try:
+                (self._cache_dir / f"{key}.png").unlink()
+            except OSError:
+                pass
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+from module.options import DEFAULT_METRICS_HOST
+from utils.util import create_logger
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# 保存から表示までの処理段階。順番は処理の順
+STAGES = (
+    "settle",
+    "composite",
+    "resize",
+    "encode",
+    "enqueue",
+    "queue_wait",
+    "execution",
+    "decode",
+    "result_resize",
+    "total",
+)
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_WINDOW = 100
+METRIC_PREFIX = "psd_watch"
+
+
+class Trace:
+    # 1 回の生成の各段階の所要時間 (秒)
+    def __init__(self):
+        self.prompt_id: Optional[str] = None
+        self.started_at = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.attributes: dict[str, object] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        assert name in STAGES, f"stage {name} is not defined."
+        self.stages[name] = self.stages.get(name, 0.0) + max(seconds, 0.0)
+
+    def to_record(self) -> dict:
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "prompt_id": self.prompt_id,
+            "stages": {
+                name: self.stages[name] for name in STAGES if name in self.stages
+            },
+            **self.attributes,
+        }
+
+
+class StageHistogram:
+    # Prometheus 用の累積ヒストグラムと、UI 用の直近 window 件の値を保持する
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.recent) == 0:
+            return None
+        return float(np.quantile(np.asarray(self.recent), q))
+
+
+# 生成ごとの段階別の所要時間を集計し、JSONL のトレースと Prometheus 形式のメトリクスとして出力するモジュール
+class Tracer:
+    def __init__(self, trace_path: Optional[Path] = None, window: int = DEFAULT_WINDOW):
+        self._lock = threading.Lock()
+        self._histograms = {stage: StageHistogram(window) for stage in STAGES}
+        self._results: dict[str, int] = {}
+        # UI は数十 ms ごとに問い合わせるため、集計し直すのは生成の完了時のみにする
+        self._status_line = ""
+        self.queue_remaining = 0
+        self._trace_logger: Optional[logging.Logger] = None
+        if trace_path is not None:
+            self._trace_logger = create_logger(
+                "psd_watch_trace", trace_path, fmt="%(message)s"
+            )
+            self._trace_logger.propagate = False
+
+    def start(self) -> Trace:
+        return Trace()
+
+    def finish(self, trace: Trace, result: str):
+        # result は finished, cached, draft, skip, error, superseded のいずれか
+        trace.add("total", time.perf_counter() - trace.started_at)
+        trace.attributes["result"] = result
+        with self._lock:
+            self._results[result] = self._results.get(result, 0) + 1
+            # 中断された生成は所要時間の分布を歪めるため、件数のみ数える
+            if result in ("finished", "cached"):
+                for name, seconds in trace.stages.items():
+                    self._histograms[name].observe(seconds)
+                self._status_line = self._render_status_line()
+        if self._trace_logger is not None:
+            self._trace_logger.info(json.dumps(trace.to_record()))
+
+    def status_line(self) -> str:
+        with self._lock:
+            return self._status_line
+
+    def _render_status_line(self) -> str:
+        total = self._histograms["total"]
+        p50, p95 = total.quantile(0.5), total.quantile(0.95)
+        if p50 is None or p95 is None:
+            return ""
+        slowest = max(
+            (stage for stage in STAGES if stage != "total"),
+            key=lambda stage: self._histograms[stage].quantile(0.5) or 0.0,
+        )
+        slowest_p50 = self._histograms[slowest].quantile(0.5) or 0.0
+        return (
+            f"total p50 {p50:.2f}s / p95 {p95:.2f}s, "
+            f"slowest: {slowest} {slowest_p50:.2f}s"
+        )
+
+    def render_metrics(self) -> str:
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_seconds Time spent in each pipeline stage.",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in self._histograms.items():
+                for bound, count in zip(HISTOGRAM_BUCKETS, histogram.bucket_counts):
+                    lines.append(
+                        f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}'
+                )
+                lines.append(
+                    f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}'
+                )
+                lines.append(
+                    f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}'
+                )
+
+            lines += [
+                f"# HELP {METRIC_PREFIX}_stage_recent_seconds Quantiles over recent generations.",
+                f"# TYPE {METRIC_PREFIX}_stage_recent_seconds gauge",
+            ]
+            for stage, histogram in self._histograms.items():
+                for q in (0.5, 0.95, 0.99):
+                    value = histogram.quantile(q)
+                    if value is not None:
+                        lines.append(
+                            f'{METRIC_PREFIX}_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {value}'
+                        )
+
+            lines += [
+                f"# HELP {METRIC_PREFIX}_generations_total Generations by result.",
+                f"# TYPE {METRIC_PREFIX}_generations_total counter",
+            ]
+            for result, count in self._results.items():
+                lines.append(
+                    f'{METRIC_PREFIX}_generations_total{{result="{result}"}} {count}'
+                )
+            lines += [
+                f"# HELP {METRIC_PREFIX}_queue_remaining Prompts remaining in ComfyUI queue.",
+                f"# TYPE {METRIC_PREFIX}_queue_remaining gauge",
+                f"{METRIC_PREFIX}_queue_remaining {self.queue_remaining}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    # Prometheus から取得できるよう /metrics でメトリクスを返す HTTP サーバー
+    # 段階ごとの所要時間・結果ごとの生成数・ComfyUI のキューの残り件数から利用状況がわかるため、
+    # 既定では同じマシンからのみ受け付ける
+    def __init__(self, tracer: Tracer, port: int, host: str = DEFAULT_METRICS_HOST):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.render_metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-server", daemon=True
+        )
+        self._thread.start()
+        logger.debug(
+            f"serving metrics on {self._server.server_address[0]}:{self.port}/metrics"
+        )
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
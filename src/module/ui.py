@@ -6,8 +6,20 @@ from schemas.generate_settings import (
     text_setting,
 )
 from module.inference_manager import InferenceManager
+from module.inference_service import InferenceService
+from module.options import (
+    DEFAULT_FULL_THRESHOLD,
+    VIEW_IMG_HEIGHT,
+    VIEW_IMG_WIDTH,
+    InputMode,
+)
+from typing import Callable, Optional
 
-VIEW_IMG_HEIGHT, VIEW_IMG_WIDTH = 768, 768
+# UI から選べる複数案の数の上限
+MAX_VARIATIONS = 9
+# 複数人で使う場合の結果の問い合わせ間隔 (秒) と、同時に処理する UI のリクエスト数
+MULTI_USER_POLL_INTERVAL = 0.05
+MULTI_USER_CONCURRENCY = 8
 
 
 def set_optional_value(
@@ -18,14 +30,27 @@ def set_optional_value(
     generate_settings.optional_settings[node_name].params.inputs.value = value
 
 
-def build_optional_params_ui(inference_manager: InferenceManager):
-    optional_settings = inference_manager.generate_settings.optional_settings
+def build_optional_params_ui(
+    generate_settings: GenerateSettings,
+    settings_of: Optional[Callable[[gr.Request], Optional[GenerateSettings]]] = None,
+) -> list[tuple[str, gr.components.Component]]:
+    # workflow ごとに作成し、その workflow の生成設定を変更する
+    # settings_of を指定した場合は、操作したブラウザのセッションの生成設定を変更する
+    # 作成した入力欄をノード名と組にして返す
+    optional_settings = generate_settings.optional_settings
+    components = []
     for node_name, optional_param in optional_settings.items():
         # 変数毎に関数を作成する必要があるためスコープは for 配下
         def create_change_function(node_name):
-            return lambda x: set_optional_value(
-                inference_manager.generate_settings, node_name, x
-            )
+            if settings_of is None:
+                return lambda x: set_optional_value(generate_settings, node_name, x)
+
+            def change(x, request: gr.Request):
+                session_settings = settings_of(request)
+                if session_settings is not None:
+                    set_optional_value(session_settings, node_name, x)
+
+            return change
 
         if optional_param.type == "slider" and isinstance(
             optional_param.params, slider_setting
@@ -41,6 +66,7 @@ def build_optional_params_ui(inference_manager: InferenceManager):
                 inputs=[optional_slider],
                 outputs=None,
             )
+            components.append((node_name, optional_slider))
         elif optional_param.type == "text" and isinstance(
             optional_param.params, text_setting
         ):
@@ -52,20 +78,22 @@ def build_optional_params_ui(inference_manager: InferenceManager):
                 inputs=[optional_text],
                 outputs=None,
             )
+            components.append((node_name, optional_text))
+    return components
 
 
-def build_ui(
-    file_path: Path,
-    workflow_dir: Path,
-):
-    inference_manager = InferenceManager(
-        workflow_dir, file_path, VIEW_IMG_HEIGHT, VIEW_IMG_WIDTH
-    )
+def build_ui(inference_manager: InferenceManager) -> gr.Blocks:
+    # PSD の監視は gradio の読み込みより先に始められるよう、InferenceManager は呼び出し側で作る
     generate_settings = inference_manager.generate_settings
 
     with gr.Blocks() as ui:
         with gr.Row():
             with gr.Column(scale=1):
+                workflow_dropdown = gr.Dropdown(
+                    choices=inference_manager.workflow_names,
+                    value=inference_manager.workflow_name,
+                    label="workflow",
+                )
                 denoising_strength = gr.Slider(
                     minimum=0,
                     maximum=1,
@@ -78,32 +106,321 @@ def build_ui(
                 )
 
                 # UIに表示する変更可能な設定値リスト
-                build_optional_params_ui(inference_manager)
+                # workflow ごとに作成し、選択中の workflow のものだけを表示する
+                optional_groups = []
+                for name in inference_manager.workflow_names:
+                    with gr.Group(
+                        visible=name == inference_manager.workflow_name
+                    ) as optional_group:
+                        build_optional_params_ui(
+                            inference_manager.workflow_settings(name)
+                        )
+                    optional_groups.append(optional_group)
 
+                progressive_checkbox = gr.Checkbox(
+                    label="draft first", value=inference_manager.progressive
+                )
+                variations_slider = gr.Slider(
+                    minimum=1,
+                    maximum=MAX_VARIATIONS,
+                    step=1,
+                    value=inference_manager.variations,
+                    label="variations",
+                )
+                regenerate = gr.Button(value="regenerate")
                 status = gr.Markdown(value="status: none")
+                progress_bar = gr.HTML(value="")
             with gr.Column(scale=1):
                 image_output = gr.Image(height=VIEW_IMG_HEIGHT, width=VIEW_IMG_WIDTH)
 
+        # workflow を切り替えても、選択中の workflow の生成設定を変更する
         denoising_strength.change(
-            fn=lambda x: setattr(generate_settings, "denoising_strength", x),
+            fn=lambda x: setattr(
+                inference_manager.generate_settings, "denoising_strength", x
+            ),
             inputs=[denoising_strength],
             outputs=None,
         )
         prompt.change(
-            fn=lambda x: setattr(generate_settings, "prompt", x),
+            fn=lambda x: setattr(inference_manager.generate_settings, "prompt", x),
             inputs=[prompt],
             outputs=None,
         )
         negative_prompt.change(
-            fn=lambda x: setattr(generate_settings, "negative_prompt", x),
+            fn=lambda x: setattr(
+                inference_manager.generate_settings, "negative_prompt", x
+            ),
             inputs=[negative_prompt],
             outputs=None,
         )
+
+        def switch_workflow(name: str):
+            inference_manager.switch_workflow(name)
+            settings = inference_manager.generate_settings
+            return [
+                gr.update(value=settings.denoising_strength),
+                gr.update(value=settings.prompt),
+                gr.update(value=settings.negative_prompt),
+            ] + [
+                gr.update(visible=workflow_name == name)
+                for workflow_name in inference_manager.workflow_names
+            ]
+
+        workflow_dropdown.change(
+            fn=switch_workflow,
+            inputs=[workflow_dropdown],
+            outputs=[denoising_strength, prompt, negative_prompt] + optional_groups,
+        )
+        progressive_checkbox.change(
+            fn=lambda x: setattr(inference_manager, "progressive", x),
+            inputs=[progressive_checkbox],
+            outputs=None,
+        )
+        variations_slider.change(
+            fn=lambda x: setattr(inference_manager, "variations", int(x)),
+            inputs=[variations_slider],
+            outputs=None,
+        )
+        regenerate.click(
+            fn=lambda: inference_manager.request_full_regeneration(),
+            inputs=None,
+            outputs=None,
+        )
+        # タブごとに表示済みの結果の番号を保持し、新しい結果のときだけ画像を送る
+        shown_version = gr.State(-1)
         ui.load(
-            fn=lambda: inference_manager.run(),
-            inputs=[],
-            outputs=[image_output, status],
+            fn=inference_manager.run,
+            inputs=[shown_version],
+            outputs=[image_output, status, progress_bar, shown_version],
             every=0.01,
         )
     ui.queue()
-    ui.launch()
+    return ui
+
+
+def resolve_psd_path(path: str, psd_root: Path) -> Path:
+    # 作業者が入力したパスを検証する。サーバー上の任意のファイルを開けないよう、psd_root の配下のみ開ける
+    psd_path = Path(path.strip()).expanduser().resolve()
+    assert psd_path.suffix.lower() == ".psd", f"{psd_path} is not a PSD file."
+    assert psd_path.is_relative_to(
+        psd_root.resolve()
+    ), f"{psd_path} is outside of {psd_root}."
+    assert psd_path.is_file(), f"{psd_path} does not exist."
+    return psd_path
+
+
+def build_multi_user_ui(
+    service: InferenceService,
+    workflow_dir: Path,
+    psd_root: Path,
+    psd_input_mode: InputMode = "auto",
+    region_inference: bool = False,
+    region_full_threshold: float = DEFAULT_FULL_THRESHOLD,
+    progressive: bool = False,
+    variations: int = 1,
+) -> gr.Blocks:
+    # 1 つのプロセスで複数の作業者の PSD を監視する。ブラウザのタブごとに PSD・生成設定・結果を持ち、
+    # ComfyUI の接続・キャッシュを共有して、キューに積む順番は作業者間で公平にする
+    workflow_names = service.workflow_registry.names
+    default_settings = service.workflow_registry.get(
+        workflow_dir.name
+    ).generate_settings
+
+    def session(request: gr.Request) -> Optional[InferenceManager]:
+        return service.session(request.session_hash)
+
+    def session_setter(apply: Callable[[InferenceManager, object], None]):
+        # 操作したブラウザのセッションに値を反映する関数を作る。PSD を開く前の操作は無視する
+        def change(x, request: gr.Request):
+            inference_manager = session(request)
+            if inference_manager is not None:
+                apply(inference_manager, x)
+
+        return change
+
+    with gr.Blocks() as ui:
+        with gr.Row():
+            with gr.Column(scale=1):
+                with gr.Row():
+                    psd_path = gr.Textbox(label="PSD path", scale=4)
+                    open_button = gr.Button(value="open", scale=1)
+                workflow_dropdown = gr.Dropdown(
+                    choices=workflow_names, value=workflow_dir.name, label="workflow"
+                )
+                denoising_strength = gr.Slider(
+                    minimum=0,
+                    maximum=1,
+                    value=default_settings.denoising_strength,
+                    label="denoising strength",
+                )
+                prompt = gr.Textbox(label="prompt", value=default_settings.prompt)
+                negative_prompt = gr.Textbox(
+                    label="negative_prompt", value=default_settings.negative_prompt
+                )
+
+                optional_groups = []
+                # (workflow 名, ノード名, 入力欄)。PSD を開く前に変更した値を新しいセッションに反映するために使う
+                optional_inputs = []
+                for name in workflow_names:
+
+                    def settings_of(request: gr.Request, name=name):
+                        inference_manager = session(request)
+                        if inference_manager is None:
+                            return None
+                        return inference_manager.workflow_settings(name)
+
+                    with gr.Group(visible=name == workflow_dir.name) as optional_group:
+                        components = build_optional_params_ui(
+                            service.workflow_registry.get(name).generate_settings,
+                            settings_of,
+                        )
+                    optional_inputs += [
+                        (name, node_name, component)
+                        for node_name, component in components
+                    ]
+                    optional_groups.append(optional_group)
+
+                progressive_checkbox = gr.Checkbox(
+                    label="draft first", value=progressive
+                )
+                variations_slider = gr.Slider(
+                    minimum=1,
+                    maximum=MAX_VARIATIONS,
+                    step=1,
+                    value=variations,
+                    label="variations",
+                )
+                regenerate = gr.Button(value="regenerate")
+                status = gr.Markdown(value="status: open a PSD file")
+                progress_bar = gr.HTML(value="")
+            with gr.Column(scale=1):
+                image_output = gr.Image(height=VIEW_IMG_HEIGHT, width=VIEW_IMG_WIDTH)
+
+        shown_version = gr.State(-1)
+        settings_inputs = [
+            workflow_dropdown,
+            denoising_strength,
+            prompt,
+            negative_prompt,
+            progressive_checkbox,
+            variations_slider,
+        ]
+
+        # optional_values は optional_inputs と同じ順に並ぶ。gradio は位置引数の request に値を差し込むため先頭に置く
+        def open_psd(
+            request: gr.Request,
+            path,
+            workflow_name,
+            denoising,
+            prompt_text,
+            negative_prompt_text,
+            draft_first,
+            variation_count,
+            *optional_values,
+        ):
+            try:
+                psd_file = resolve_psd_path(path, psd_root)
+            except AssertionError as e:
+                return gr.update(value=f"status: {e}"), gr.update()
+            inference_manager = service.open_session(
+                request.session_hash,
+                psd_file,
+                VIEW_IMG_HEIGHT,
+                VIEW_IMG_WIDTH,
+                psd_input_mode=psd_input_mode,
+                region_inference=region_inference,
+                region_full_threshold=region_full_threshold,
+                progressive=draft_first,
+                variations=int(variation_count),
+            )
+            # PSD を開く前に UI で変更していた値を新しいセッションに反映する
+            inference_manager.switch_workflow(workflow_name)
+            settings = inference_manager.generate_settings
+            settings.denoising_strength = denoising
+            settings.prompt = prompt_text
+            settings.negative_prompt = negative_prompt_text
+            for (name, node_name, _), value in zip(optional_inputs, optional_values):
+                set_optional_value(
+                    inference_manager.workflow_settings(name), node_name, value
+                )
+            # 新しいセッションの結果の番号は 0 から始まるため、表示済みの番号を戻す
+            return gr.update(value=f"status: watching {psd_file}"), -1
+
+        open_button.click(
+            fn=open_psd,
+            inputs=[psd_path]
+            + settings_inputs
+            + [component for _, _, component in optional_inputs],
+            outputs=[status, shown_version],
+        )
+        denoising_strength.change(
+            fn=session_setter(
+                lambda m, x: setattr(m.generate_settings, "denoising_strength", x)
+            ),
+            inputs=[denoising_strength],
+            outputs=None,
+        )
+        prompt.change(
+            fn=session_setter(lambda m, x: setattr(m.generate_settings, "prompt", x)),
+            inputs=[prompt],
+            outputs=None,
+        )
+        negative_prompt.change(
+            fn=session_setter(
+                lambda m, x: setattr(m.generate_settings, "negative_prompt", x)
+            ),
+            inputs=[negative_prompt],
+            outputs=None,
+        )
+
+        def switch_workflow(name: str, request: gr.Request):
+            inference_manager = session(request)
+            settings = service.workflow_registry.get(name).generate_settings
+            if inference_manager is not None:
+                inference_manager.switch_workflow(name)
+                settings = inference_manager.generate_settings
+            return [
+                gr.update(value=settings.denoising_strength),
+                gr.update(value=settings.prompt),
+                gr.update(value=settings.negative_prompt),
+            ] + [
+                gr.update(visible=workflow_name == name)
+                for workflow_name in workflow_names
+            ]
+
+        workflow_dropdown.change(
+            fn=switch_workflow,
+            inputs=[workflow_dropdown],
+            outputs=[denoising_strength, prompt, negative_prompt] + optional_groups,
+        )
+        progressive_checkbox.change(
+            fn=session_setter(lambda m, x: setattr(m, "progressive", x)),
+            inputs=[progressive_checkbox],
+            outputs=None,
+        )
+        variations_slider.change(
+            fn=session_setter(lambda m, x: setattr(m, "variations", int(x))),
+            inputs=[variations_slider],
+            outputs=None,
+        )
+        regenerate.click(
+            fn=session_setter(lambda m, _: m.request_full_regeneration()),
+            inputs=[regenerate],
+            outputs=None,
+        )
+
+        def poll(shown_version: int, request: gr.Request):
+            inference_manager = session(request)
+            if inference_manager is None:
+                return gr.update(), gr.update(), gr.update(), shown_version
+            return inference_manager.run(shown_version)
+
+        # 作業者の人数分の問い合わせが届くため、1 人で使う場合より間隔を空ける
+        ui.load(
+            fn=poll,
+            inputs=[shown_version],
+            outputs=[image_output, status, progress_bar, shown_version],
+            every=MULTI_USER_POLL_INTERVAL,
+        )
+    ui.queue(concurrency_count=MULTI_USER_CONCURRENCY)
+    return ui
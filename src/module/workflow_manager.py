@@ -1,72 +1,270 @@
+from __future__ import annotations
+
 from pathlib import Path
 from PIL import Image
-from utils.util import pil_to_base64
+from typing import Any, NamedTuple, Optional
+import copy
+import hashlib
 import random
+import re
 import json
+import threading
 from schemas.generate_settings import GenerateSettings
+from module.client import OUTPUT_NODE_TYPES
+from module.image_transport import EncodedImage, ImageTransport, TransportStats
 
 DEFAULT_NODE_NAME_LIST = ["KSampler", "CLIPTextEncode", "ETN_LoadImageBase64"]
 ALLOW_MULTIPLE_NODES = ["CLIPTextEncode"]
+# テンプレートの JSON でリクエストごとに値を差し込む位置の目印
+SLOT_MARKER = "__psd_watch_slot_{}__"
+SLOT_PATTERN = re.compile(r'"__psd_watch_slot_(\d+)__"')
+# ComfyUI がモデルを読み込むノードの入力。複数の ComfyUI に振り分ける際に、読み込み済みのものを優先する
+MODEL_INPUT_KEYS = (
+    "ckpt_name",
+    "unet_name",
+    "vae_name",
+    "clip_name",
+    "lora_name",
+    "control_net_name",
+)
+
+
+class Slot(NamedTuple):
+    # リクエストごとに値を差し込む位置。key が None の場合はノード全体を差し替える
+    node_id: str
+    key: Optional[str] = None
+
+
+class WorkflowTemplate:
+    # workflow_api.json を一度だけシリアライズし、リクエストごとに変わる値の位置で分割したもの
+    # 生成したあとは変更しないため、複数のリクエストから同時に使ってよい
+    def __init__(self, workflow: dict, slots: list[Slot]):
+        self.slots = tuple(dict.fromkeys(slots))
+        self._slot_index = {slot: i for i, slot in enumerate(self.slots)}
+        self.output_nodes = frozenset(
+            node_id
+            for node_id, node in workflow.items()
+            if node.get("class_type") in OUTPUT_NODE_TYPES
+        )
+        self.models = workflow_models(workflow)
+
+        workflow = copy.deepcopy(workflow)
+        for i, slot in enumerate(self.slots):
+            if slot.key is None:
+                workflow[slot.node_id] = SLOT_MARKER.format(i)
+            else:
+                workflow[slot.node_id]["inputs"][slot.key] = SLOT_MARKER.format(i)
+        parts = SLOT_PATTERN.split(json.dumps(workflow))
+        self._fragments = tuple(parts[0::2])
+        self._order = tuple(int(i) for i in parts[1::2])
+
+    def instantiate(self, values: dict[Slot, str]) -> WorkflowInstance:
+        # values は各スロットの JSON 文字列
+        return WorkflowInstance(self, tuple(values[slot] for slot in self.slots))
+
+    def render(self, values: tuple[str, ...]) -> str:
+        parts = [self._fragments[0]]
+        for index, fragment in zip(self._order, self._fragments[1:]):
+            parts.append(values[index])
+            parts.append(fragment)
+        return "".join(parts)
+
+
+class WorkflowInstance(NamedTuple):
+    # 1 回のリクエスト用の workflow。テンプレートと差し込む値のみを持ち、workflow の dict は複製しない
+    template: WorkflowTemplate
+    values: tuple[str, ...]
+    # 入力画像の送信の統計。ログ・計測用
+    transport_stats: Optional[TransportStats] = None
+
+    @property
+    def output_nodes(self) -> frozenset[str]:
+        return self.template.output_nodes
+
+    @property
+    def models(self) -> frozenset[str]:
+        return self.template.models
+
+    def to_json(self) -> str:
+        return self.template.render(self.values)
+
+    def to_dict(self) -> dict:
+        return json.loads(self.to_json())
+
+
+class ParsedWorkflow(NamedTuple):
+    # workflow_api.json を読み込み、検証・ノードの特定まで済ませたもの。共有するため変更しない
+    workflow: dict
+    # 生成結果のキャッシュで workflow を識別するためのハッシュ
+    digest: str
+    node_id_dict: dict[str, str]
+    positive_prompt_node_id: str
+    negative_prompt_node_id: str
+
+
+# ファイルの内容のハッシュごとの検証済みの workflow
+# 起動時の検証・workflow の切り替え・バッチ変換で同じファイルを何度も読むため、同じプロセスの中では解析を 1 回にし、
+# 解析結果の dict を共有する。解析は同梱の workflow すべてで 1 ms 未満のため、起動時間を縮めるものではない
+_parsed_workflows: dict[str, ParsedWorkflow] = {}
+_parsed_lock = threading.Lock()
+
+
+def parse_workflow(path: Path) -> ParsedWorkflow:
+    data = path.read_bytes()
+    key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    with _parsed_lock:
+        parsed = _parsed_workflows.get(key)
+    if parsed is not None:
+        return parsed
+
+    workflow = json.loads(data)
+    node_id_dict = create_node_dict(workflow)
+    positive_prompt_node_id = trace_node_ids_by_key(
+        workflow, node_id_dict["KSampler"], "positive"
+    )
+    negative_prompt_node_id = trace_node_ids_by_key(
+        workflow, node_id_dict["KSampler"], "negative"
+    )
+    assert (
+        positive_prompt_node_id is not None
+    ), "ポジティブプロンプト（CLIPTextEncode）の特定に失敗しました。対応していない workflow です。"
+    assert (
+        negative_prompt_node_id is not None
+    ), "ネガティブプロンプト（CLIPTextEncode）の特定に失敗しました。対応していない workflow です。"
+    parsed = ParsedWorkflow(
+        workflow,
+        hashlib.blake2b(
+            json.dumps(workflow, sort_keys=True).encode(), digest_size=16
+        ).hexdigest(),
+        node_id_dict,
+        positive_prompt_node_id,
+        negative_prompt_node_id,
+    )
+    with _parsed_lock:
+        _parsed_workflows[key] = parsed
+    return parsed
 
 
 class WorkflowManager:
-    def __init__(self, workflow_dir):
+    def __init__(self, workflow_dir, image_transport: Optional[ImageTransport] = None):
+        # 入力画像の渡し方。デフォルトは workflow に base64 で埋め込む
+        self.image_transport = image_transport or ImageTransport()
         self.load_workflow(workflow_dir)
 
+    def resolve_settings(self, generate_settings: GenerateSettings) -> GenerateSettings:
+        # シードが -1 (ランダム) の場合は実際に使うシードに置き換えた設定を返す
+        if generate_settings.seed != -1:
+            return generate_settings
+        return generate_settings.model_copy(update={"seed": random.randint(0, 100000)})
+
     def create(
         self,
-        input_img: Image.Image,
+        input_img: Image.Image | EncodedImage,
         generate_settings: GenerateSettings,
-    ):
-        # Ksamplerの設定
-        if generate_settings.seed == -1:
-            seed = random.randint(0, 100000)
-        else:
-            seed = generate_settings.seed
-        self._workflow[self._node_id_dict["KSampler"]]["inputs"]["seed"] = seed
-        self._workflow[self._node_id_dict["KSampler"]]["inputs"][
-            "denoise"
-        ] = generate_settings.denoising_strength
-
-        # プロンプトの設定
-        self._workflow[self._positive_prompt_node_id]["inputs"][
-            "text"
-        ] = generate_settings.prompt
-        self._workflow[self._negative_prompt_node_id]["inputs"][
-            "text"
-        ] = generate_settings.negative_prompt
+        steps: Optional[int] = None,
+    ) -> WorkflowInstance:
+        # テンプレートは共有し、リクエストごとの値だけを持つ workflow を返す
+        image_node, stats = self.image_transport.input_node(input_img)
+        return self._instantiate(generate_settings, image_node, steps)._replace(
+            transport_stats=stats
+        )
+
+    def create_variations(
+        self,
+        input_img: Image.Image | EncodedImage,
+        settings_list: list[GenerateSettings],
+        steps: Optional[int] = None,
+    ) -> list[WorkflowInstance]:
+        # 入力画像は 1 回だけエンコードし、シードなどの設定だけが異なる workflow を作る
+        image_node, stats = self.image_transport.input_node(input_img)
+        return [
+            self._instantiate(generate_settings, image_node, steps)._replace(
+                transport_stats=stats
+            )
+            for generate_settings in settings_list
+        ]
 
+    def _instantiate(
+        self,
+        generate_settings: GenerateSettings,
+        image_node: str,
+        steps: Optional[int],
+    ) -> WorkflowInstance:
+        ksampler_id = self._node_id_dict["KSampler"]
+        values: dict[Slot, Any] = {
+            # Ksamplerの設定
+            Slot(ksampler_id, "seed"): self.resolve_settings(generate_settings).seed,
+            Slot(ksampler_id, "denoise"): generate_settings.denoising_strength,
+            # steps を指定しない場合は workflow_api.json の値を使う
+            Slot(ksampler_id, "steps"): steps or self._default_steps,
+            # プロンプトの設定
+            Slot(self._positive_prompt_node_id, "text"): generate_settings.prompt,
+            Slot(
+                self._negative_prompt_node_id, "text"
+            ): generate_settings.negative_prompt,
+        }
         # 追加パラメータの設定
         for optional_setting in generate_settings.optional_settings.values():
-            node_id = optional_setting.id
             param = optional_setting.params.inputs
-            self._workflow[node_id]["inputs"][param.name] = param.value
+            values[Slot(optional_setting.id, param.name)] = param.value
+        values = {slot: json.dumps(value) for slot, value in values.items()}
 
         #  入力画像の設定
-        self._workflow[self._node_id_dict["ETN_LoadImageBase64"]]["inputs"][
-            "image"
-        ] = pil_to_base64(input_img)
+        values[Slot(self._node_id_dict["ETN_LoadImageBase64"])] = image_node
 
-        return self._workflow
+        return self._template(self._slots(generate_settings)).instantiate(values)
+
+    def _template(self, slots: tuple[Slot, ...]) -> WorkflowTemplate:
+        # settings.json 以外の追加パラメータが指定された場合は、その組み合わせのテンプレートを作る
+        template = self._templates.get(slots)
+        if template is None:
+            template = WorkflowTemplate(self._workflow, list(slots))
+            self._templates[slots] = template
+        return template
 
     def load_workflow(self, workflow_dir: Path):
-        with open(workflow_dir / "workflow_api.json", "r") as f:
-            self._workflow = json.load(f)
+        parsed = parse_workflow(workflow_dir / "workflow_api.json")
+        self._workflow = parsed.workflow
+        self.workflow_digest = parsed.digest
+        self._node_id_dict = parsed.node_id_dict
+        self._default_steps = self._workflow[self._node_id_dict["KSampler"]]["inputs"][
+            "steps"
+        ]
+        self._positive_prompt_node_id = parsed.positive_prompt_node_id
+        self._negative_prompt_node_id = parsed.negative_prompt_node_id
 
-        self._node_id_dict = create_node_dict(self._workflow)
+        # settings.json の追加パラメータを含めたテンプレートを事前に作っておく
+        self._templates: dict[tuple[Slot, ...], WorkflowTemplate] = {}
+        settings_path = workflow_dir / "settings.json"
+        if settings_path.exists():
+            with open(settings_path, "r") as f:
+                generate_settings = GenerateSettings(**json.load(f))
+            self._template(self._slots(generate_settings))
 
-        self._positive_prompt_node_id = trace_node_ids_by_key(
-            self._workflow, self._node_id_dict["KSampler"], "positive"
-        )
-        self._negative_prompt_node_id = trace_node_ids_by_key(
-            self._workflow, self._node_id_dict["KSampler"], "negative"
-        )
-        assert (
-            self._positive_prompt_node_id is not None
-        ), "ポジティブプロンプト（CLIPTextEncode）の特定に失敗しました。対応していない workflow です。"
-        assert (
-            self._negative_prompt_node_id is not None
-        ), "ネガティブプロンプト（CLIPTextEncode）の特定に失敗しました。対応していない workflow です。"
+    def _slots(self, generate_settings: GenerateSettings) -> tuple[Slot, ...]:
+        ksampler_id = self._node_id_dict["KSampler"]
+        slots = [
+            Slot(ksampler_id, "seed"),
+            Slot(ksampler_id, "denoise"),
+            Slot(ksampler_id, "steps"),
+            Slot(self._positive_prompt_node_id, "text"),
+            Slot(self._negative_prompt_node_id, "text"),
+        ]
+        for optional_setting in generate_settings.optional_settings.values():
+            slots.append(Slot(optional_setting.id, optional_setting.params.inputs.name))
+        slots.append(Slot(self._node_id_dict["ETN_LoadImageBase64"]))
+        return tuple(dict.fromkeys(slots))
+
+
+def workflow_models(workflow: dict) -> frozenset[str]:
+    # workflow が読み込むモデルのファイル名
+    return frozenset(
+        value
+        for node in workflow.values()
+        if isinstance(node, dict)
+        for key, value in node.get("inputs", {}).items()
+        if key in MODEL_INPUT_KEYS and isinstance(value, str)
+    )
 
 
 def get_key_from_class_type(workflow, class_type):
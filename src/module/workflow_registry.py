@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import json
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+from schemas.generate_settings import GenerateSettings
+from module.client import Client
+from module.image_transport import ImageTransport
+from module.workflow_manager import WorkflowManager, parse_workflow
+from logging import getLogger, StreamHandler, DEBUG
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+handler = StreamHandler()
+handler.setLevel(DEBUG)
+logger.addHandler(handler)
+
+# ウォームアップ用のプロンプトの入力画像の大きさとステップ数。モデルの読み込みが目的のため最小限にする
+WARMUP_RESOLUTION = 256
+WARMUP_STEPS = 1
+
+
+class WorkflowEntry(NamedTuple):
+    name: str
+    workflow_dir: Path
+    workflow_manager: WorkflowManager
+    # UI から変更される生成設定。workflow ごとに保持し、切り替えても値を残す
+    generate_settings: GenerateSettings
+
+
+def validate_settings(workflow: dict, generate_settings: GenerateSettings):
+    for node_name, optional_setting in generate_settings.optional_settings.items():
+        node = workflow.get(optional_setting.id)
+        assert (
+            node is not None
+        ), f"{node_name} のノード {optional_setting.id} が workflow に存在しません。"
+        name = optional_setting.params.inputs.name
+        assert (
+            name in node["inputs"]
+        ), f"{node_name} のパラメータ {name} がノード {optional_setting.id} に存在しません。"
+
+
+def load_entry(workflow_dir: Path, image_transport: ImageTransport) -> WorkflowEntry:
+    with open(workflow_dir / "settings.json", "r") as f:
+        generate_settings = GenerateSettings(**json.load(f))
+    workflow_manager = WorkflowManager(workflow_dir, image_transport)
+    # WorkflowManager が解析した結果を再利用する
+    validate_settings(
+        parse_workflow(workflow_dir / "workflow_api.json").workflow, generate_settings
+    )
+    return WorkflowEntry(
+        workflow_dir.name, workflow_dir, workflow_manager, generate_settings
+    )
+
+
+# workflows/ 配下の workflow を起動時にすべて読み込んで検証し、UI から切り替えられるようにするモジュール
+# 切り替え時にはモデルの読み込みを済ませるため、小さな画像・1 ステップのプロンプトを ComfyUI に積める
+class WorkflowRegistry:
+    def __init__(
+        self,
+        workflows_root: Path,
+        image_transport: ImageTransport,
+        client: Optional[Client] = None,
+    ):
+        self._client = client
+        self._entries: dict[str, WorkflowEntry] = {}
+        for workflow_dir in sorted(workflows_root.iterdir()):
+            if not (workflow_dir / "workflow_api.json").exists():
+                continue
+            try:
+                entry = load_entry(workflow_dir, image_transport)
+            except Exception as e:
+                # 1 つの workflow の不備で起動できなくならないよう、読み込めないものは除外する
+                logger.warning(f"skip workflow {workflow_dir}: {e}")
+                continue
+            self._entries[entry.name] = entry
+        logger.debug(f"loaded workflows: {list(self._entries)}")
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def get(self, name: str) -> WorkflowEntry:
+        assert name in self._entries, f"workflow {name} is not loaded."
+        return self._entries[name]
+
+    def add(self, workflow_dir: Path, image_transport: ImageTransport) -> WorkflowEntry:
+        # workflows/ の外にある workflow を指定された場合も選択肢に加える
+        entry = load_entry(workflow_dir, image_transport)
+        self._entries[entry.name] = entry
+        return entry
+
+    def warm_up(self, name: str):
+        # ComfyUI にモデルを読み込ませるためのプロンプトを、UI を止めないよう別スレッドで積む
+        if self._client is None:
+            return
+        entry = self.get(name)
+        threading.Thread(
+            target=self._warm_up, args=(entry,), name="workflow-warmup", daemon=True
+        ).start()
+
+    def _warm_up(self, entry: WorkflowEntry):
+        try:
+            workflow = entry.workflow_manager.create(
+                Image.new("RGB", (WARMUP_RESOLUTION, WARMUP_RESOLUTION), "white"),
+                entry.generate_settings,
+                steps=WARMUP_STEPS,
+            )
+            prompt_id = self._client.enqueue(workflow)
+            # 結果は使わないが、完了を待ち受けて受信した画像を破棄する
+            self._client.submit_polling(prompt_id)
+            logger.debug(f"warm up {entry.name}: {prompt_id}")
+        except Exception as e:
+            logger.warning(f"failed to warm up {entry.name}: {e}")
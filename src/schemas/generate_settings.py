@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, Optional
 from pydantic import BaseModel
 
 
@@ -27,6 +27,31 @@ class OptionalSetting(BaseModel):
     params: text_setting | slider_setting
 
 
+LayerColor = Literal[
+    "none", "red", "orange", "yellow", "green", "blue", "violet", "gray"
+]
+
+
+class LayerFilter(BaseModel):
+    # レイヤー・グループの名前 (fnmatch 形式)、色ラベル、名前に含まれる #タグ のいずれかで一致させる
+    names: list[str] = []
+    colors: list[LayerColor] = []
+    tags: list[str] = []
+
+
+class LayerSelection(BaseModel):
+    # 合成に使うレイヤー。グループが一致した場合は中のレイヤーすべてが一致したものとする
+    # include を省略した場合はすべてのレイヤーを対象にし、exclude に一致したものを除く
+    include: Optional[LayerFilter] = None
+    exclude: LayerFilter = LayerFilter()
+
+
+class DraftSetting(BaseModel):
+    # 2 段階生成で先に表示する下書きの解像度と KSampler のステップ数
+    target_resolution: int = 512
+    steps: Optional[int] = 8
+
+
 class GenerateSettings(BaseModel):
     denoising_strength: float
     prompt: str
@@ -34,3 +59,5 @@ class GenerateSettings(BaseModel):
     seed: int
     target_resolution: int
     optional_settings: dict[str, OptionalSetting]
+    draft: DraftSetting = DraftSetting()
+    input_layers: Optional[LayerSelection] = None
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+from PIL import Image
+
+from benchmarks.mock_comfyui import MockComfyUI
+from module.backend_pool import BackendPool
+from module.client import MAX_TRACKED_PROMPTS
+from module.image_transport import encode_image
+
+
+def wait_until(condition, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.05)
+    raise TimeoutError(f"condition was not met in {timeout} s.")
+
+
+@pytest.fixture
+def servers():
+    servers = [MockComfyUI(execution_delay=0.01, image_size=(64, 64)) for _ in range(2)]
+    for server in servers:
+        server.start()
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_upload_reaches_backend_recovered_after_upload(servers):
+    # 画像のアップロード時に停止していた ComfyUI に、その画像を参照するプロンプトを積む前に画像を送る
+    first, second = servers
+    second.stop()
+    pool = BackendPool([first.url, second.url])
+    try:
+        encoded = encode_image(Image.new("RGB", (64, 64), "white"), "upload")
+        filename = f"psd_watch_{encoded.digest}.png"
+        name = pool.upload_image(filename, encoded.png)
+        assert filename in first._uploads
+        assert filename not in second._uploads
+
+        # 停止していた ComfyUI が復旧し、アップロード先だった ComfyUI が停止する
+        second.start()
+        first.stop()
+        wait_until(
+            lambda: pool.backends[1].available and not pool.backends[0].available
+        )
+
+        workflow = {
+            "1": {
+                "inputs": {"image": name, "upload": "image"},
+                "class_type": "LoadImage",
+            },
+            "2": {
+                "inputs": {"images": ["1", 0]},
+                "class_type": "ETN_SendImageWebSocket",
+            },
+        }
+        prompt_id = pool.enqueue(workflow)
+        assert prompt_id in second.records
+        assert filename in second._uploads
+        assert pool.submit_polling(prompt_id).result(30).size == (64, 64)
+    finally:
+        pool.close()
+
+
+def test_routes_of_outstanding_prompts_are_kept(servers):
+    # 追跡数の上限を超えて積んでも、待ち受け前のプロンプトの積んだ先を失わない
+    pool = BackendPool([server.url for server in servers])
+    try:
+        workflow = {
+            "1": {
+                "inputs": {"width": 64, "height": 64},
+                "class_type": "EmptyImage",
+            },
+            "2": {
+                "inputs": {"images": ["1", 0]},
+                "class_type": "ETN_SendImageWebSocket",
+            },
+        }
+        prompt_ids = [pool.enqueue(workflow) for _ in range(MAX_TRACKED_PROMPTS + 6)]
+        pool.cancel(prompt_ids[1])
+        futures = [
+            pool.submit_polling(prompt_id)
+            for prompt_id in prompt_ids
+            if prompt_id != prompt_ids[1]
+        ]
+        for future in futures:
+            assert future.result(60).size == (64, 64)
+        # 待ち受けを終えたものは、完了後の pop_timing のために一定数だけ残す
+        wait_until(lambda: len(pool._routes) == 0)
+        assert pool.pop_timing(prompt_ids[-1]) is not None
+    finally:
+        pool.close()
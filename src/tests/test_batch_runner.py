@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from benchmarks.mock_comfyui import MockComfyUI
+from benchmarks.synthetic_psd import random_layer, save_psd
+from module.batch_runner import (
+    PROGRESS_FILE_NAME,
+    BatchRunner,
+    items_from_glob,
+    load_progress,
+)
+
+WORKFLOW_DIR = Path(__file__).resolve().parents[2] / "workflows" / "img2img_xl"
+
+
+@pytest.fixture
+def server():
+    server = MockComfyUI(execution_delay=0.01, image_size=(64, 64))
+    server.start()
+    yield server
+    server.stop()
+
+
+def create_psds(psd_dir: Path, count: int):
+    rng = np.random.default_rng(0)
+    psd_dir.mkdir()
+    for i in range(count):
+        save_psd(psd_dir / f"{i}.psd", (128, 128), [random_layer(rng, (128, 128), "a")])
+
+
+def run_batch(server: MockComfyUI, psd_dir: Path, output_dir: Path) -> dict:
+    runner = BatchRunner(
+        output_dir, port_port=str(server.port), num_workers=1, max_in_flight=2
+    )
+    try:
+        return runner.run(items_from_glob(str(psd_dir / "*.psd"), WORKFLOW_DIR))
+    finally:
+        runner.close()
+
+
+def test_resume_skips_done_items(server, tmp_path):
+    psd_dir = tmp_path / "psd"
+    output_dir = tmp_path / "outputs"
+    create_psds(psd_dir, 3)
+    items = items_from_glob(str(psd_dir / "*.psd"), WORKFLOW_DIR)
+
+    counts = run_batch(server, psd_dir, output_dir)
+    assert counts == {"done": 3, "skip": 0, "error": 0}
+    assert len(server.records) == 3
+
+    # 2 件目は失敗し、3 件目の記録は書き込み途中で中断されたものとする
+    progress_path = output_dir / PROGRESS_FILE_NAME
+    lines = progress_path.read_text().splitlines()
+    records = {json.loads(line)["id"]: line for line in lines}
+    failed = {"id": items[1].id, "psd": str(items[1].psd_path), "status": "error"}
+    progress_path.write_text(
+        records[items[0].id]
+        + "\n"
+        + json.dumps(failed)
+        + "\n"
+        + records[items[2].id][: len(records[items[2].id]) // 2]
+    )
+    assert set(load_progress(progress_path)) == {items[0].id, items[1].id}
+
+    # 完了した 1 件目だけを飛ばし、失敗・中断した 2 件を生成し直す
+    counts = run_batch(server, psd_dir, output_dir)
+    assert counts == {"done": 2, "skip": 0, "error": 0}
+    assert len(server.records) == 5
+    progress = load_progress(progress_path)
+    assert all(progress[item.id]["status"] == "done" for item in items)
+    assert all((output_dir / item.output_name).exists() for item in items)
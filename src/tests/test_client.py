@@ -0,0 +1,42 @@
+from concurrent.futures import wait
+
+import pytest
+from PIL import Image
+
+from benchmarks.mock_comfyui import MockComfyUI
+from module.client import MAX_TRACKED_PROMPTS, Client, PromptStateEvicted
+
+WORKFLOW = {"1": {"class_type": "ETN_SendImageWebSocket", "inputs": {}}}
+
+
+@pytest.fixture
+def server():
+    server = MockComfyUI(execution_delay=0.01, image_size=(64, 64))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = Client(port=str(server.port))
+    yield client
+    client.close()
+
+
+def test_more_outstanding_prompts_than_tracked(client):
+    # 保持数の上限を超えて待ち受けても、すべての結果を受け取れる
+    prompt_ids = [client.enqueue(WORKFLOW) for _ in range(MAX_TRACKED_PROMPTS + 16)]
+    futures = [client.submit_polling(prompt_id) for prompt_id in prompt_ids]
+    done, not_done = wait(futures, timeout=30)
+    assert len(not_done) == 0
+    assert all(isinstance(future.result(), Image.Image) for future in done)
+
+
+def test_evicted_prompt_fails_instead_of_waiting(server, client):
+    # 待ち受けずに上限を超えて積んだ古いプロンプトは、待ち続けずに失敗する
+    prompt_ids = [client.enqueue(WORKFLOW) for _ in range(MAX_TRACKED_PROMPTS + 8)]
+    last = client.submit_polling(prompt_ids[-1])
+    assert isinstance(last.result(timeout=30), Image.Image)
+    with pytest.raises(PromptStateEvicted):
+        client.submit_polling(prompt_ids[0]).result(timeout=5)
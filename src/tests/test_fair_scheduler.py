@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from module.fair_scheduler import FairScheduler, SessionClient, Superseded
+
+
+def wait_until(condition, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f"condition was not met in {timeout} s.")
+
+
+def acquire_in_thread(scheduler: FairScheduler, session_id: str, granted: list):
+    def run():
+        granted.append((session_id, scheduler.acquire(session_id)))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_session_waiting_longest_goes_first():
+    # a が続けて保存しても、まだ順番が回っていない b に先に枠を渡す
+    scheduler = FairScheduler(max_in_flight=1)
+    slot = scheduler.acquire("a")
+    granted = []
+    threads = [acquire_in_thread(scheduler, "a", granted)]
+    wait_until(lambda: scheduler.waiting == 1)
+    threads.append(acquire_in_thread(scheduler, "b", granted))
+    wait_until(lambda: scheduler.waiting == 2)
+
+    scheduler.release(slot)
+    wait_until(lambda: len(granted) == 1)
+    assert granted[0][0] == "b"
+    assert scheduler.in_flight == 1
+
+    scheduler.release(granted[0][1])
+    wait_until(lambda: len(granted) == 2)
+    assert granted[1][0] == "a"
+    for thread in threads:
+        thread.join(1)
+
+
+def test_should_abort_stops_waiting_without_taking_a_slot():
+    scheduler = FairScheduler(max_in_flight=1)
+    slot = scheduler.acquire("a")
+    newer_save = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            scheduler.acquire("b", should_abort=newer_save.is_set)
+        except Superseded as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_until(lambda: scheduler.waiting == 1)
+    newer_save.set()
+    thread.join(1)
+    assert len(errors) == 1
+    assert scheduler.waiting == 0
+    assert scheduler.in_flight == 1
+
+    # 取りやめたセッションも次の保存で待ち直せる
+    scheduler.release(slot)
+    scheduler.release(scheduler.acquire("b"))
+    assert scheduler.in_flight == 0
+
+
+class FailingClient:
+    def enqueue(self, workflow):
+        raise ConnectionError("ComfyUI is down")
+
+
+def test_failed_enqueue_returns_the_slot():
+    scheduler = FairScheduler(max_in_flight=1)
+    client = SessionClient(FailingClient(), scheduler, "a")
+    with pytest.raises(ConnectionError):
+        client.enqueue({})
+    assert scheduler.in_flight == 0
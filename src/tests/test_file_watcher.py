@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+import pytest
+
+from module.file_watcher import FileWatcher, get_file_signature
+
+SETTLE_TIME = 0.2
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def watcher(request, tmp_path):
+    path = tmp_path / "a.psd"
+    path.write_bytes(b"\0" * 16)
+    watcher = FileWatcher(
+        path, settle_time=SETTLE_TIME, poll_interval=0.05, use_inotify=request.param
+    )
+    signatures = []
+    watcher.add_callback(signatures.append)
+    watcher.start()
+    if request.param and sys.platform.startswith("linux"):
+        assert watcher.backend == "inotify"
+    yield watcher, signatures
+    watcher.stop()
+
+
+def wait_events(signatures: list, count: int, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and len(signatures) < count:
+        time.sleep(0.01)
+    # 余分な通知が届かないことも確認するため、落ち着くまで待つ
+    time.sleep(SETTLE_TIME * 2)
+
+
+def test_burst_of_writes_is_one_event(watcher):
+    # 書き込みの間隔が settle_time より短い間は保存が続いているとみなす
+    watcher, signatures = watcher
+    with open(watcher.path, "ab") as f:
+        for _ in range(10):
+            f.write(b"\1" * 1024)
+            f.flush()
+            time.sleep(SETTLE_TIME / 4)
+    wait_events(signatures, 1)
+    assert signatures == [get_file_signature(watcher.path)]
+    assert watcher.consume_ready()
+    assert not watcher.consume_ready()
+
+
+def test_each_save_is_one_event(watcher):
+    watcher, signatures = watcher
+    for i in range(2):
+        # 一時ファイルに書いてから置き換えるアプリの保存
+        tmp_path = watcher.path.with_suffix(".tmp")
+        tmp_path.write_bytes(bytes([i]) * (1024 * (i + 1)))
+        os.replace(tmp_path, watcher.path)
+        wait_events(signatures, i + 1)
+    assert len(signatures) == 2
+    assert signatures[-1] == get_file_signature(watcher.path)
@@ -0,0 +1,123 @@
+import asyncio
+import socket
+import time
+
+import pytest
+from aiohttp import web
+
+from module.http_pool import (
+    BackendUnavailable,
+    CircuitBreaker,
+    CircuitState,
+    HttpPool,
+    RetryPolicy,
+)
+
+FAST_RETRY = RetryPolicy(attempts=3, backoff_min=0.01, backoff_max=0.01)
+
+
+def test_breaker_opens_after_threshold_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.1)
+    changes = []
+    breaker.add_callback(changes.append)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state is CircuitState.closed
+    breaker.record_failure()
+    assert breaker.state is CircuitState.open
+    assert not breaker.allow()
+    assert changes == [False]
+
+    # reset_timeout 後は 1 件だけ試せる。失敗すれば 1 回で開き直す
+    time.sleep(0.15)
+    assert breaker.state is CircuitState.half_open
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state is CircuitState.open
+    assert changes == [False]
+
+    time.sleep(0.15)
+    breaker.record_success()
+    assert breaker.state is CircuitState.closed
+    assert changes == [False, True]
+
+
+def test_trip_opens_regardless_of_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10.0)
+    breaker.trip()
+    assert breaker.state is CircuitState.open
+
+
+def closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def count_requests(pool: HttpPool) -> list:
+    # 実際に送ったリクエストの数を数える
+    session = await pool._get_session()
+    calls = []
+    request = session.request
+
+    def counting_request(*args, **kwargs):
+        calls.append(args)
+        return request(*args, **kwargs)
+
+    session.request = counting_request
+    return calls
+
+
+async def server_error_app(hits: list) -> web.AppRunner:
+    async def prompt(request: web.Request):
+        hits.append(request.path)
+        return web.Response(status=500)
+
+    app = web.Application()
+    app.router.add_post("/prompt", prompt)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+@pytest.mark.parametrize("idempotent, expected", [(False, 1), (True, 3)])
+def test_prompt_is_not_retried_after_server_error(idempotent, expected):
+    # サーバーに届いた可能性のあるリクエストは、二重に積まないよう再試行しない
+    async def run():
+        hits = []
+        runner = await server_error_app(hits)
+        port = runner.addresses[0][1]
+        pool = HttpPool(f"http://127.0.0.1:{port}", retry=FAST_RETRY)
+        try:
+            with pytest.raises(Exception):
+                await pool.request("POST", "/prompt", idempotent=idempotent)
+        finally:
+            await pool.close()
+            await runner.cleanup()
+        return hits
+
+    assert len(asyncio.run(run())) == expected
+
+
+def test_prompt_is_retried_after_connect_error():
+    # 接続できなかった場合は送信前のため、/prompt も再試行する
+    async def run():
+        pool = HttpPool(
+            f"http://127.0.0.1:{closed_port()}",
+            retry=FAST_RETRY,
+            breaker=CircuitBreaker(failure_threshold=1),
+        )
+        calls = await count_requests(pool)
+        try:
+            with pytest.raises(BackendUnavailable):
+                await pool.request("POST", "/prompt", idempotent=False)
+            # ブレーカーが開いた後は送信せずに失敗する
+            with pytest.raises(BackendUnavailable):
+                await pool.request("POST", "/prompt", idempotent=False)
+        finally:
+            await pool.close()
+        return calls
+
+    assert len(asyncio.run(run())) == FAST_RETRY.attempts
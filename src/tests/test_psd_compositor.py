@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic_psd import SyntheticLayer, save_psd
+from module.psd_compositor import PsdCompositor
+from schemas.generate_settings import GenerateSettings
+
+WORKFLOW_DIR = Path(__file__).resolve().parents[2] / "workflows" / "kataragi_lineart_xl"
+SIZE = (64, 64)
+
+
+def input_layers():
+    # 同梱の workflow と同じく #ref・#bg のレイヤーを除く設定
+    with open(WORKFLOW_DIR / "settings.json", "r", encoding="utf-8") as f:
+        selection = GenerateSettings(**json.load(f)).input_layers
+    assert selection is not None and len(selection.exclude.tags) > 0
+    return selection
+
+
+def solid_layer(name: str, color: tuple[int, int, int], **kwargs) -> SyntheticLayer:
+    return SyntheticLayer(name, Image.new("RGBA", SIZE, (*color, 255)), **kwargs)
+
+
+def test_selection_without_excluded_layers_uses_merged_image(tmp_path):
+    psd_path = save_psd(
+        tmp_path / "a.psd",
+        SIZE,
+        [
+            solid_layer("lineart", (255, 0, 0)),
+            # 非表示のレイヤーは統合画像に含まれないため、除外に一致しても統合画像を使える
+            solid_layer("reference #ref", (0, 0, 255), visible=False),
+        ],
+    )
+    result = PsdCompositor().composite(psd_path, input_layers())
+    assert result.source == "merged"
+    assert result.image.getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_selection_with_excluded_layers_composites_layers(tmp_path):
+    psd_path = save_psd(
+        tmp_path / "a.psd",
+        SIZE,
+        [
+            solid_layer("lineart", (255, 0, 0)),
+            solid_layer("reference #ref", (0, 0, 255)),
+        ],
+    )
+    result = PsdCompositor().composite(psd_path, input_layers())
+    assert result.source == "layers"
+    assert np.all(np.asarray(result.image) == (255, 0, 0))
@@ -0,0 +1,60 @@
+import numpy as np
+from PIL import Image
+
+from module.region_inference import RegionInference, pad_bbox
+
+SIZE = (1024, 1024)
+SETTINGS_KEY = "settings"
+
+
+def canvas(changed_box=None) -> Image.Image:
+    pixels = np.full((SIZE[1], SIZE[0], 3), 255, dtype=np.uint8)
+    if changed_box is not None:
+        left, top, right, bottom = changed_box
+        pixels[top:bottom, left:right] = 0
+    return Image.fromarray(pixels)
+
+
+def generated_base(region: RegionInference):
+    # 1 回目は全体を生成し、その結果を次の差分の基準にする
+    job = region.plan(canvas(), SETTINGS_KEY)
+    assert job.crop_box is None
+    region.merge(job, Image.new("RGB", (512, 512), "gray"))
+
+
+def test_small_change_is_cropped_with_padding():
+    region = RegionInference(padding=64)
+    generated_base(region)
+    job = region.plan(canvas((500, 500, 510, 510)), SETTINGS_KEY)
+    assert job.crop_box == (436, 436, 574, 574)
+
+
+def test_large_change_generates_full():
+    region = RegionInference(full_threshold=0.5)
+    generated_base(region)
+    job = region.plan(canvas((0, 0, 1024, 600)), SETTINGS_KEY)
+    assert job.crop_box is None
+
+
+def test_full_generation_without_usable_base():
+    region = RegionInference()
+    generated_base(region)
+    changed = canvas((500, 500, 510, 510))
+    # 設定・workflow が変わった場合
+    assert region.plan(changed, "other settings").crop_box is None
+    # 変更がない (保存し直した) 場合
+    assert region.plan(canvas(), SETTINGS_KEY).crop_box is None
+    # 全体の生成を指示された場合は次の 1 回だけ全体を生成する
+    region.request_full()
+    assert region.plan(changed, SETTINGS_KEY).crop_box is None
+    assert region.plan(changed, SETTINGS_KEY).crop_box is not None
+
+
+def test_pad_bbox_stays_inside_canvas():
+    assert pad_bbox((0, 0, 10, 10), SIZE, 64) == (0, 0, 74, 74)
+    assert pad_bbox((1014, 1014, 1024, 1024), SIZE, 64) == (950, 950, 1024, 1024)
+
+
+def test_pad_bbox_widens_thin_regions():
+    # 短辺を長辺の 1/4 まで、中心を保って広げる
+    assert pad_bbox((100, 500, 900, 502), SIZE, 0) == (100, 401, 900, 601)
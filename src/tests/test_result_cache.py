@@ -0,0 +1,91 @@
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.mock_comfyui import MockComfyUI
+from benchmarks.synthetic_psd import random_layer, save_psd
+from module.inference_manager import InferenceManager
+from module.result_cache import ResultCache
+
+WORKFLOW_DIR = Path(__file__).resolve().parents[2] / "workflows" / "img2img_xl"
+
+
+def wait_finished(server: MockComfyUI, count: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        statuses = [record.status for record in server.records.values()]
+        if statuses.count("finished") >= count:
+            return
+        time.sleep(0.05)
+    raise TimeoutError(f"{count} prompts did not finish in {timeout} s.")
+
+
+@pytest.fixture
+def server():
+    server = MockComfyUI(execution_delay=0.05, image_size=(64, 64))
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_random_seed_skips_result_cache(server, tmp_path):
+    # 同梱の settings.json はシードが -1 (ランダム) のため、同じ PSD の保存でも毎回生成し、結果を保存しない
+    rng = np.random.default_rng(0)
+    layers = [random_layer(rng, (256, 256), f"layer_{i}") for i in range(3)]
+    psd_path = save_psd(tmp_path / "a.psd", (256, 256), layers)
+    psd_bytes = psd_path.read_bytes()
+    cache_dir = tmp_path / "cache"
+    manager = InferenceManager(
+        WORKFLOW_DIR,
+        psd_path,
+        768,
+        768,
+        port_port=str(server.port),
+        result_cache_dir=cache_dir,
+    )
+    try:
+        assert manager.generate_settings.seed == -1
+        for count in (1, 2):
+            time.sleep(0.2)
+            psd_path.write_bytes(psd_bytes)
+            wait_finished(server, count)
+    finally:
+        manager.stop()
+
+    # 2 回目の保存もキャッシュを使わずに ComfyUI へ積まれている
+    assert len(server.records) == 2
+    assert list(cache_dir.glob("*.png")) == []
+
+
+def test_stats_does_not_wait_for_disk_write(tmp_path, monkeypatch):
+    # UI の問い合わせごとに参照する stats は、PNG の書き込み中も待たずに返る
+    cache = ResultCache(tmp_path)
+    image = Image.new("RGB", (64, 64), "white")
+    writing = threading.Event()
+    release = threading.Event()
+    save = image.save
+
+    def blocking_save(*args, **kwargs):
+        writing.set()
+        release.wait(10)
+        save(*args, **kwargs)
+
+    monkeypatch.setattr(image, "save", blocking_save)
+    put = threading.Thread(target=cache.put, args=("key", image))
+    put.start()
+    try:
+        assert writing.wait(10)
+        stats = threading.Thread(target=lambda: cache.stats)
+        stats.start()
+        stats.join(1)
+        assert not stats.is_alive()
+        # 書き込み中でもメモリからは取り出せる
+        assert cache.get("key") is image
+    finally:
+        release.set()
+        put.join()
+    assert (tmp_path / "key.png").exists()
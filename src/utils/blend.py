@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+BLEND_MODES = ("normal", "multiply", "screen", "overlay")
+
+BBox = tuple[int, int, int, int]
+
+
+class BlendLayer(NamedTuple):
+    # RGBA のレイヤー画像とキャンバス上の配置
+    image: Image.Image
+    position: tuple[int, int]
+    opacity: float = 1.0
+    mode: str = "normal"
+
+    @property
+    def bbox(self) -> BBox:
+        left, top = self.position
+        return (left, top, left + self.image.size[0], top + self.image.size[1])
+
+
+def _intersect(a: BBox, b: BBox) -> Optional[BBox]:
+    bbox = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None
+    return bbox
+
+
+def _crop(layer: BlendLayer, bbox: BBox) -> Image.Image:
+    if bbox == layer.bbox:
+        return layer.image
+    left, top = layer.position
+    return layer.image.crop(
+        (bbox[0] - left, bbox[1] - top, bbox[2] - left, bbox[3] - top)
+    )
+
+
+class BlendEngine:
+    # RGB のキャンバスにレイヤーを in place で合成する。
+    # 通常レイヤーは PIL の paste (C 実装) がもっとも速いためそのまま使い、
+    # 合成モード・クリッピングを伴うレイヤーはレイヤーの bbox 分だけ float32 の作業バッファで計算する。
+    # 作業バッファは使い回す
+    def __init__(self):
+        self._buffers: dict[str, np.ndarray] = {}
+
+    def _buffer(self, name: str, shape: tuple[int, ...]) -> np.ndarray:
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=np.float32)
+            self._buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+    def blend(
+        self,
+        canvas: Image.Image,
+        layer: BlendLayer,
+        region: Optional[BBox] = None,
+        clip_layers: tuple[BlendLayer, ...] = (),
+    ):
+        assert layer.mode in BLEND_MODES, f"blend mode {layer.mode} is not supported."
+        bbox = _intersect(layer.bbox, (0, 0, *canvas.size))
+        if bbox is not None and region is not None:
+            bbox = _intersect(bbox, region)
+        if bbox is None or layer.opacity <= 0:
+            return
+
+        src = _crop(layer, bbox)
+        if layer.mode == "normal" and len(clip_layers) == 0:
+            mask = src
+            if layer.opacity < 1.0:
+                mask = src.getchannel("A").point(
+                    [round(a * layer.opacity) for a in range(256)]
+                )
+            canvas.paste(src, bbox[:2], mask)
+            return
+
+        shape = (bbox[3] - bbox[1], bbox[2] - bbox[0])
+        color, alpha = self._load_layer("color", "alpha", src, 1.0)
+
+        # クリッピングされたレイヤーは基準レイヤーのアルファを保ったまま基準レイヤー上に合成する
+        for clip_layer in clip_layers:
+            clip_bbox = _intersect(clip_layer.bbox, bbox)
+            if clip_bbox is None or clip_layer.opacity <= 0:
+                continue
+            assert (
+                clip_layer.mode in BLEND_MODES
+            ), f"blend mode {clip_layer.mode} is not supported."
+            clip_color, clip_alpha = self._load_layer(
+                "clip_color",
+                "clip_alpha",
+                _crop(clip_layer, clip_bbox),
+                clip_layer.opacity,
+            )
+            _blend_over(
+                color[
+                    clip_bbox[1] - bbox[1] : clip_bbox[3] - bbox[1],
+                    clip_bbox[0] - bbox[0] : clip_bbox[2] - bbox[0],
+                ],
+                clip_color,
+                clip_alpha,
+                clip_layer.mode,
+            )
+
+        backdrop = self._buffer("backdrop", (*shape, 3))
+        np.multiply(
+            np.asarray(canvas.crop(bbox)), 1.0 / 255.0, out=backdrop, dtype=np.float32
+        )
+        alpha *= layer.opacity
+        _blend_over(backdrop, color, alpha, layer.mode)
+        backdrop *= 255.0
+        backdrop += 0.5
+        np.clip(backdrop, 0, 255, out=backdrop)
+        canvas.paste(Image.fromarray(backdrop.astype(np.uint8), "RGB"), bbox[:2])
+
+    def _load_layer(
+        self, color_name: str, alpha_name: str, image: Image.Image, opacity: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        pixels = np.asarray(image)
+        shape = pixels.shape[:2]
+        color = self._buffer(color_name, (*shape, 3))
+        np.multiply(pixels[..., :3], 1.0 / 255.0, out=color, dtype=np.float32)
+        alpha = self._buffer(alpha_name, (*shape, 1))
+        np.multiply(pixels[..., 3:4], opacity / 255.0, out=alpha, dtype=np.float32)
+        return color, alpha
+
+
+def _blend_over(backdrop: np.ndarray, color: np.ndarray, alpha: np.ndarray, mode: str):
+    # backdrop += alpha * (B(backdrop, color) - backdrop)。color は作業用として上書きされる
+    _blend_color(backdrop, color, mode)
+    color -= backdrop
+    color *= alpha
+    backdrop += color
+
+
+def _blend_color(backdrop: np.ndarray, color: np.ndarray, mode: str):
+    # color を B(backdrop, color) で上書きする
+    if mode == "normal":
+        return
+    if mode == "multiply":
+        color *= backdrop
+    elif mode == "screen":
+        # cb + cs - cb * cs
+        product = backdrop * color
+        color += backdrop
+        color -= product
+    elif mode == "overlay":
+        # cb <= 0.5: 2 * cb * cs, それ以外: 1 - 2 * (1 - cb) * (1 - cs)
+        low = 2.0 * backdrop * color
+        high = 1.0 - 2.0 * (1.0 - backdrop) * (1.0 - color)
+        np.copyto(color, np.where(backdrop <= 0.5, low, high))
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import builtins
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# 起動の各段階に到達するまでの時間の目安 (秒、main.py の実行開始から)
+# watch: PSD の監視を始めるまで, ui: UI を組み立てて起動する直前まで,
+# service: 複数人向けの共有モジュールを作るまで, batch: バッチ変換を始める直前まで
+STARTUP_BUDGET = {"watch": 1.5, "ui": 6.0, "service": 1.5, "batch": 1.5}
+# パッケージ単位でなくモジュール単位で集計する、このリポジトリのパッケージ
+LOCAL_PACKAGES = ("module", "schemas", "utils", "benchmarks")
+MAX_REPORTED_IMPORTS = 15
+
+
+class ImportProfiler:
+    # builtins.__import__ を差し替えて、初めて読み込まれたモジュールの読み込み時間を集計する
+    # 入れ子の import の時間は読み込まれた側に数える (python -X importtime の self に近い)
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+        self._original = None
+        self._local = threading.local()
+
+    def start(self):
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._import
+
+    def stop(self):
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def _key(self, name: str) -> str:
+        root = name.split(".")[0]
+        return name if root in LOCAL_PACKAGES else root
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # 相対 import と読み込み済みのモジュールは、呼び出し元の時間に含める
+        if level != 0 or name in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            key = self._key(name)
+            self.seconds[key] = self.seconds.get(key, 0.0) + elapsed - children
+            if len(stack) > 0:
+                stack[-1] += elapsed
+
+
+class StartupProfiler:
+    # --profile_startup で使う。段階ごとの到達時間と import の内訳を集計し、目安と比べる
+    def __init__(self, started_at: float, budget: Optional[dict[str, float]] = None):
+        self._started_at = started_at
+        self._budget = budget or STARTUP_BUDGET
+        self._imports = ImportProfiler()
+        self.phases: dict[str, float] = {}
+        self._imports.start()
+
+    @contextmanager
+    def phase(self, name: str):
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - self._started_at
+
+    def within_budget(self) -> bool:
+        return all(
+            seconds <= self._budget.get(name, float("inf"))
+            for name, seconds in self.phases.items()
+        )
+
+    def report(self) -> str:
+        self._imports.stop()
+        lines = ["startup profile (seconds since main.py started)"]
+        for name, seconds in self.phases.items():
+            budget = self._budget.get(name)
+            if budget is None:
+                lines.append(f"  {name:10s} {seconds:6.2f} s")
+                continue
+            verdict = "ok" if seconds <= budget else "OVER BUDGET"
+            lines.append(
+                f"  {name:10s} {seconds:6.2f} s / budget {budget:4.1f} s  {verdict}"
+            )
+        imports = sorted(self._imports.seconds.items(), key=lambda item: -item[1])
+        total = sum(seconds for _, seconds in imports)
+        lines.append(f"imports: {total:.2f} s in total, slowest:")
+        for name, seconds in imports[:MAX_REPORTED_IMPORTS]:
+            lines.append(f"  {name:40s} {seconds * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+
+@contextmanager
+def phase(profiler: Optional[StartupProfiler], name: str):
+    # profiler が None の場合は何もしない
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
@@ -15,15 +15,15 @@ def pil_to_base64(img: Image.Image):
     return base64.b64encode(buffered.getvalue()).decode()
 
 
-def create_logger(name: str, path: Path):
+def create_logger(
+    name: str, path: Path, fmt: str = "%(asctime)s %(levelname)s %(message)s"
+):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
     file_handler = logging.handlers.RotatingFileHandler(
         path, encoding="utf-8", maxBytes=10 * 1024 * 1024, backupCount=4
     )
-    file_handler.setFormatter(
-        logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-    )
+    file_handler.setFormatter(logging.Formatter(fmt))
     logger.addHandler(file_handler)
     return logger
 
@@ -47,6 +47,20 @@ def resize_target_resolution(
     return image.resize((resized_w, resized_h), Image.BICUBIC)
 
 
+def make_grid(images: list[Image.Image | None], size: tuple[int, int]) -> Image.Image:
+    # 複数の画像を size に収まる格子状に並べる。None の枠は灰色のままにする
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    tile_w, tile_h = size[0] // columns, size[1] // rows
+    grid = Image.new("RGB", (tile_w * columns, tile_h * rows), (128, 128, 128))
+    for i, image in enumerate(images):
+        if image is None:
+            continue
+        tile = image.convert("RGB").resize((tile_w, tile_h), Image.BICUBIC)
+        grid.paste(tile, ((i % columns) * tile_w, (i // columns) * tile_h))
+    return grid
+
+
 def parse_psd(file_path) -> Image.Image:
     psd = PSDImage.open(file_path)
     image = Image.new("RGBA", psd.size, (255, 255, 255, 255))